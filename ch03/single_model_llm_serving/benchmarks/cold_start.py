@@ -0,0 +1,81 @@
+"""Startup time and memory of N worker replicas with and without the model snapshot cache.
+
+Starts the replicas three ways: loading from the hub with the cache off,
+from an empty cache (the first replica saves the snapshot, the others wait
+for it), and from the warm cache, where every replica memory-maps the same
+weights file. Memory is measured after one forward on every replica: each
+worker's resident set (RSS) and its proportional share (PSS), which splits
+pages shared between processes among them, so with mapped weights RSS
+stays high per process while the total PSS drops. Linux only, as it reads
+/proc.
+
+    python benchmarks/cold_start.py
+    python benchmarks/cold_start.py --num-workers 4 --precision bf16
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, Optional
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from llm.config import CacheConfig, EngineConfig, ExecutorConfig, ModelCacheConfig, PrecisionConfig
+from llm.model_executor import ModelExecutor
+from llm.sampling_params import SamplingParams
+
+def memory_mb(pid: int) -> Dict[str, float]:
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        fields = dict(line.split(':', 1) for line in f if ':' in line and not line.startswith(' '))
+    return {key: int(fields[key].split()[0]) / 1024 for key in ('Rss', 'Pss')}
+
+def start_replicas(model: str, num_workers: int, precision: str, cache_path: Optional[str]) -> Dict[str, float]:
+    executor = ModelExecutor(
+        ExecutorConfig(num_workers=num_workers, threads_per_worker=1),
+        # The KV cache is not what this measures
+        cache_config=CacheConfig(memory_bytes=num_workers * 16 * 2**20),
+        precision_config=PrecisionConfig(default=precision),
+        model_cache_config=ModelCacheConfig(path=cache_path)
+    )
+    try:
+        start = time.perf_counter()
+        executor.setup_workers(model)
+        ready = time.perf_counter() - start
+        # Mapped weights only count once a forward touched them
+        executor.execute_forward_batch([
+            {'request_id': f"warmup-{replica.index}", 'replica': replica.index, 'token_ids': [2, 100, 200],
+             'block_table': [0], 'sampling_params': SamplingParams(temperature=0)}
+            for replica in executor.replicas
+        ])
+        memory = [memory_mb(replica.process.pid) for replica in executor.replicas]
+        phases = [stats['startup_s'] for stats in executor.get_stats()]
+    finally:
+        executor.shutdown()
+    return {
+        'ready_s': ready,
+        'load_s': max(p.get('from_pretrained', 0) + p.get('snapshot', 0) + p.get('map_weights', 0) for p in phases),
+        'rss_mb': sum(m['Rss'] for m in memory),
+        'pss_mb': sum(m['Pss'] for m in memory),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', default=os.path.join(ROOT, 'config', 'engine.json'))
+    parser.add_argument('--num-workers', type=int, default=2)
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16', 'int8'])
+    args = parser.parse_args()
+
+    logging.disable(logging.DEBUG)
+    config = EngineConfig.load(args.config)
+    print(f"{args.num_workers} replicas of {config.model} in {args.precision}")
+    print(f"{'load':>6} {'ready s':>8} {'weights s':>9} {'total RSS MB':>12} {'total PSS MB':>12}")
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for name, path in (('hub', None), ('cold', cache_dir), ('warm', cache_dir)):
+            result = start_replicas(config.model, args.num_workers, args.precision, path)
+            print(f"{name:>6} {result['ready_s']:>8.2f} {result['load_s']:>9.2f} "
+                  f"{result['rss_mb']:>12.1f} {result['pss_mb']:>12.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Decode step latency per shape bucket, eager against compiled forwards.
+
+Runs batched greedy decode steps through ModelWorker's paged KV cache for
+every batch size and context length of the config's compile buckets, once
+per mode, and prints each mode's compile time and mean step latency per
+bucket. Eager-mode Python overhead is a large share of a decode step for
+a small model, so the gap is widest for small batches.
+
+    python benchmarks/compiled_decode.py
+    python benchmarks/compiled_decode.py --modes eager torchscript inductor --batch-sizes 1 8 --context-lengths 128
+"""
+import argparse
+import logging
+import os
+import sys
+from typing import Dict, List
+
+import torch
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from llm.config import CompileConfig, EngineConfig
+from llm.model_worker import ModelWorker
+from llm.sampling_params import SamplingParams
+
+def decode_latencies(worker: ModelWorker, batch_sizes: List[int], context_lengths: List[int],
+                     num_steps: int) -> Dict[str, float]:
+    """Mean milliseconds of a decode step, per bucket label."""
+    for batch_size in batch_sizes:
+        for context_length in context_lengths:
+            # Contexts end just inside the bucket, so every step stays in it
+            prompt_length = context_length - num_steps
+            blocks_per_sequence = context_length // worker.block_size + 1
+            batch = []
+            for handle in range(batch_size):
+                token_ids = torch.randint(4, worker.model.config.vocab_size, (prompt_length,)).tolist()
+                worker.add_sequences([(handle, SamplingParams(temperature=0), token_ids, prompt_length)])
+                batch.append({'request_id': handle, 'context_len': 0, 'token_ids': token_ids,
+                              'block_table': list(range(handle * blocks_per_sequence, (handle + 1) * blocks_per_sequence))})
+            results = worker.generate_forward_batch(batch)
+            for _ in range(num_steps):
+                for p, result in zip(batch, results):
+                    p['context_len'] += len(p['token_ids'])
+                    p['token_ids'] = result['token_ids']
+                results = worker.generate_forward_batch(batch)
+    return worker.get_stats()['compile']['step_latency_ms']
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', default=os.path.join(ROOT, 'config', 'engine.json'))
+    parser.add_argument('--modes', nargs='+', default=['eager', 'torchscript'], choices=['eager', 'torchscript', 'inductor'])
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--context-lengths', type=int, nargs='+', default=[128, 512])
+    parser.add_argument('--decode-steps', type=int, default=16)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    config = EngineConfig.load(args.config)
+    cache_config = config.cache
+
+    latencies: Dict[str, Dict[str, float]] = {}
+    for mode in args.modes:
+        compile_config = CompileConfig(mode=None if mode == 'eager' else mode, batch_sizes=args.batch_sizes,
+                                       context_lengths=args.context_lengths)
+        worker = ModelWorker(config.model, cache_config, precision_config=config.precision,
+                             model_cache_config=config.model_cache, compile_config=compile_config)
+        latencies[mode] = decode_latencies(worker, args.batch_sizes, args.context_lengths, args.decode_steps)
+        print(f"{mode}: compiled in {worker.steps.compile_s:.1f}s")
+
+    print(f"{'rows x new x context':>20} " + " ".join(f"{mode + ' ms':>14}" for mode in args.modes))
+    # Prefill forwards run eagerly under 'other'
+    labels = [label for label in latencies[args.modes[0]] if label != 'other']
+    for label in sorted(labels, key=lambda label: [int(n) for n in label.split('x')]):
+        print(f"{label:>20} " + " ".join(f"{latencies[mode].get(label, float('nan')):>14.2f}" for mode in args.modes))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Round-trip latency of one engine step between ModelExecutor and ModelWorker.
+
+Compares the previous transport (pickled lists of dicts over two mp.Queues)
+with the shared-memory ring buffers in llm/shm_transport.py. Both workers
+just echo one token per sequence, so the numbers are pure IPC overhead.
+
+    python benchmarks/ipc_roundtrip.py --iterations 200
+"""
+import argparse
+import multiprocessing as mp
+import os
+import statistics
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from llm.shm_transport import ShmChannel
+
+BATCH_SIZES = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+
+def queue_worker(task_queue: mp.Queue, result_queue: mp.Queue):
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        _, prompts = task
+        result_queue.put(('stream', [{'request_id': p['request_id'], 'token_id': 0} for p in prompts]))
+
+def shm_worker(channel: ShmChannel):
+    while True:
+        task = channel.recv_task()
+        if task is None:
+            break
+        handles, _, _, _, _, _ = channel.read_batch(task[1], task[2])
+        channel.send_tokens([[0]] * len(handles))
+
+def bench_queue(batch_size: int, prompt_len: int, iterations: int) -> list:
+    task_queue, result_queue = mp.Queue(), mp.Queue()
+    process = mp.Process(target=queue_worker, args=(task_queue, result_queue))
+    process.start()
+    prompts = [{'request_id': str(uuid.uuid4()), 'token_ids': list(range(prompt_len))} for _ in range(batch_size)]
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        task_queue.put(('forward', prompts))
+        result_queue.get()
+        samples.append(time.perf_counter() - start)
+    task_queue.put(None)
+    process.join()
+    return samples
+
+def bench_shm(batch_size: int, prompt_len: int, iterations: int) -> list:
+    # Each sequence also sends the block table for its tokens, 16 per block
+    num_blocks = prompt_len // 16 + 1
+    channel = ShmChannel(
+        request_capacity=2 * (1 + 6 * batch_size + batch_size * (prompt_len + num_blocks)),
+        response_capacity=4 * batch_size
+    )
+    process = mp.Process(target=shm_worker, args=(channel,))
+    process.start()
+    handles = list(range(batch_size))
+    context_lens = [0] * batch_size
+    token_id_lists = [list(range(prompt_len)) for _ in range(batch_size)]
+    block_tables = [list(range(num_blocks)) for _ in range(batch_size)]
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        channel.send_batch(handles, context_lens, token_id_lists, block_tables)
+        channel.recv_tokens(batch_size)
+        samples.append(time.perf_counter() - start)
+    channel.send(None)
+    process.join()
+    channel.close(unlink=True)
+    return samples
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--prompt-lens', type=int, nargs='+', default=[1, 128],
+                        help='token ids per sequence: 1 is a decode step, larger values model prefill')
+    args = parser.parse_args()
+
+    print(f"{'batch':>6} {'tokens/seq':>10} {'mp.Queue p50 us':>16} {'shm p50 us':>11} {'speedup':>8}")
+    for prompt_len in args.prompt_lens:
+        for batch_size in BATCH_SIZES:
+            queue_us = statistics.median(bench_queue(batch_size, prompt_len, args.iterations)) * 1e6
+            shm_us = statistics.median(bench_shm(batch_size, prompt_len, args.iterations)) * 1e6
+            print(f"{batch_size:>6} {prompt_len:>10} {queue_us:>16.1f} {shm_us:>11.1f} {queue_us / shm_us:>7.1f}x")
+
+if __name__ == '__main__':
+    main()
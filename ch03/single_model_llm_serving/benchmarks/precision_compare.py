@@ -0,0 +1,118 @@
+"""Accuracy, decode throughput and memory of a model loaded in fp32, bf16 and int8.
+
+Accuracy is a spot check against fp32 on ch09/sharegpt_samples.json
+prompts: each precision scores fp32's greedy continuation, and the report
+gives how often its top token agrees with fp32's, the mean KL divergence
+from fp32's next-token distribution, and how many greedy continuations
+come out identical. Throughput runs batched greedy decode steps through
+ModelWorker's paged KV cache, as the engine does.
+
+    python benchmarks/precision_compare.py
+    python benchmarks/precision_compare.py --precisions fp32 int8 --batch-size 16
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import sys
+import time
+from typing import Dict, List
+
+import torch
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from llm.config import CacheConfig, EngineConfig, PrecisionConfig
+from llm.model_worker import ModelWorker
+from llm.sampling_params import SamplingParams
+
+DATASET = os.path.join(ROOT, '..', '..', 'ch09', 'sharegpt_samples.json')
+
+def weight_bytes(model: torch.nn.Module) -> int:
+    # Serialized size counts packed int8 weights, which parameters() does not list
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+def greedy_continuations(worker: ModelWorker, prompts: List[List[int]], num_tokens: int) -> List[List[int]]:
+    """Greedy tokens after each prompt, decoded a step at a time through the paged KV cache."""
+    continuations = []
+    for handle, token_ids in enumerate(prompts):
+        worker.add_sequences([(handle, SamplingParams(temperature=0), token_ids, len(token_ids))])
+        # One prompt at a time, so each reuses the first blocks of the pool
+        p = {'request_id': handle, 'context_len': 0, 'token_ids': token_ids,
+             'block_table': list(range((len(token_ids) + num_tokens) // worker.block_size + 1))}
+        continuation = []
+        for _ in range(num_tokens):
+            continuation += worker.generate_forward_batch([p])[0]['token_ids']
+            p['context_len'] += len(p['token_ids'])
+            p['token_ids'] = continuation[-1:]
+        continuations.append(continuation)
+    return continuations
+
+def next_token_logprobs(worker: ModelWorker, prompt: List[int], continuation: List[int]) -> torch.Tensor:
+    """Log-probabilities the model gives each position of continuation, fed the reference tokens."""
+    input_ids = torch.tensor([prompt + continuation])
+    with torch.no_grad():
+        logits = worker.model(input_ids).logits[0, len(prompt) - 1:-1].float()
+    return logits.log_softmax(dim=-1)
+
+def decode_throughput(worker: ModelWorker, prompts: List[List[int]], num_steps: int) -> float:
+    """Tokens per second of batched greedy decode steps after one prefill."""
+    blocks_per_sequence = (max(map(len, prompts)) + num_steps) // worker.block_size + 1
+    batch = []
+    for handle, token_ids in enumerate(prompts):
+        worker.add_sequences([(handle, SamplingParams(temperature=0), token_ids, len(token_ids))])
+        batch.append({'request_id': handle, 'context_len': 0, 'token_ids': token_ids,
+                      'block_table': list(range(handle * blocks_per_sequence, (handle + 1) * blocks_per_sequence))})
+    results = worker.generate_forward_batch(batch)
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        for p, result in zip(batch, results):
+            p['context_len'] += len(p['token_ids'])
+            p['token_ids'] = result['token_ids']
+        results = worker.generate_forward_batch(batch)
+    return len(prompts) * num_steps / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', default=os.path.join(ROOT, 'config', 'engine.json'))
+    parser.add_argument('--dataset', default=DATASET)
+    parser.add_argument('--precisions', nargs='+', default=['fp32', 'bf16', 'int8'], choices=['fp32', 'bf16', 'int8'])
+    parser.add_argument('--num-prompts', type=int, default=16, help='prompts in the accuracy spot check')
+    parser.add_argument('--new-tokens', type=int, default=32, help='greedy tokens compared per prompt')
+    parser.add_argument('--batch-size', type=int, default=8, help='sequences per decode step')
+    parser.add_argument('--decode-steps', type=int, default=64)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    config = EngineConfig.load(args.config)
+    with open(args.dataset) as f:
+        texts = [sample['prompt'] for sample in json.load(f)]
+    # The KV cache only has to hold the throughput batch
+    cache_config = CacheConfig(memory_bytes=256 * 2**20, block_size=config.cache.block_size)
+
+    workers: Dict[str, ModelWorker] = {}
+    for precision in ['fp32'] + [p for p in args.precisions if p != 'fp32']:
+        workers[precision] = ModelWorker(config.model, cache_config, precision_config=PrecisionConfig(default=precision))
+    tokenizer = workers['fp32'].tokenizer
+    prompts = [tokenizer(text, truncation=True, max_length=256).input_ids for text in texts[:args.num_prompts]]
+    reference = greedy_continuations(workers['fp32'], prompts, args.new_tokens)
+    reference_logprobs = [next_token_logprobs(workers['fp32'], p, c) for p, c in zip(prompts, reference) if c]
+
+    print(f"{'precision':>9} {'weights MB':>10} {'KV B/token':>10} {'top-1 agree':>11} {'mean KL':>9} "
+          f"{'same greedy':>11} {'decode tok/s':>12}")
+    for precision in args.precisions:
+        worker = workers[precision]
+        logprobs = [next_token_logprobs(worker, p, c) for p, c in zip(prompts, reference) if c]
+        agree = torch.cat([(a.argmax(-1) == b.argmax(-1)).float() for a, b in zip(reference_logprobs, logprobs)])
+        kl = torch.cat([(a.exp() * (a - b)).sum(-1) for a, b in zip(reference_logprobs, logprobs)])
+        same = sum(a == b for a, b in zip(reference, greedy_continuations(worker, prompts, args.new_tokens)))
+        kv_bytes = worker.kv_cache[:, :, 0].numel() * worker.kv_cache.element_size()
+        throughput = decode_throughput(worker, prompts[:args.batch_size], args.decode_steps)
+        print(f"{precision:>9} {weight_bytes(worker.model) / 2**20:>10.1f} {kv_bytes:>10} {agree.mean().item():>11.1%} "
+              f"{kl.mean().item():>9.4f} {same:>5}/{len(prompts):<5} {throughput:>12.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""Decode throughput and step-latency spread as replicas are added, pinned or not.
+
+For 1..N worker replicas, fills every replica with the same decode batch
+and times engine steps through ModelExecutor, the way the engine drives
+them. Reports aggregate tokens per second, its speedup over one replica,
+and the median and p99 step latency with their coefficient of variation.
+Oversubscribed cores show up as a p99 and spread that grow with the
+replica count; pinned replicas should scale close to linearly until
+they run out of physical cores.
+
+    python benchmarks/replica_scaling.py --max-workers 4
+    python benchmarks/replica_scaling.py --max-workers 4 --modes pinned
+"""
+import argparse
+import logging
+import os
+import statistics
+import sys
+import time
+from typing import Dict
+
+import torch
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from llm.config import EngineConfig
+from llm.model_executor import ModelExecutor
+from llm.model_manager import ModelManager
+from llm.sampling_params import SamplingParams
+
+def decode_steps(config: EngineConfig, num_workers: int, pinned: bool, batch_size: int, prompt_length: int,
+                 num_steps: int) -> Dict[str, float]:
+    executor_config = config.executor.model_copy(update={
+        'num_workers': num_workers, 'pin_cpus': pinned,
+        # Unpinned replicas keep torch's default of one thread per core each
+        'threads_per_worker': None if pinned else os.cpu_count(),
+    })
+    blocks_per_sequence = (prompt_length + num_steps) // config.cache.block_size + 1
+    vocab_size = ModelManager(config.model_cache.path).load_config(config.model).vocab_size
+    executor = ModelExecutor(executor_config, config.scheduler, config.cache, precision_config=config.precision,
+                             model_cache_config=config.model_cache)
+    try:
+        executor.setup_workers(config.model)
+        batch = [
+            {'request_id': f"{replica.index}-{i}", 'replica': replica.index, 'context_len': 0,
+             'token_ids': torch.randint(4, vocab_size, (prompt_length,)).tolist(),
+             'block_table': list(range(i * blocks_per_sequence, (i + 1) * blocks_per_sequence)),
+             'sampling_params': SamplingParams(temperature=0, ignore_eos=True)}
+            for replica in executor.replicas for i in range(batch_size)
+        ]
+        results = executor.execute_forward_batch(batch)
+        latencies = []
+        for _ in range(num_steps):
+            for p, result in zip(batch, results):
+                p['context_len'] += len(p['token_ids'])
+                p['token_ids'] = result['token_ids']
+            start = time.perf_counter()
+            results = executor.execute_forward_batch(batch)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        executor.shutdown()
+    latencies.sort()
+    return {
+        'tokens_per_s': len(batch) * num_steps / sum(latencies),
+        'p50_ms': 1000 * latencies[len(latencies) // 2],
+        'p99_ms': 1000 * latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))],
+        'cv': statistics.pstdev(latencies) / statistics.mean(latencies),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', default=os.path.join(ROOT, 'config', 'engine.json'))
+    parser.add_argument('--max-workers', type=int, default=2)
+    parser.add_argument('--modes', nargs='+', default=['unpinned', 'pinned'], choices=['unpinned', 'pinned'])
+    parser.add_argument('--batch-size', type=int, default=8, help='decoding sequences per replica')
+    parser.add_argument('--prompt-length', type=int, default=64)
+    parser.add_argument('--decode-steps', type=int, default=64)
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    config = EngineConfig.load(args.config)
+    print(f"{'mode':>9} {'workers':>7} {'tok/s':>8} {'speedup':>7} {'p50 ms':>8} {'p99 ms':>8} {'CV':>6}")
+    for mode in args.modes:
+        baseline = None
+        for num_workers in range(1, args.max_workers + 1):
+            result = decode_steps(config, num_workers, mode == 'pinned', args.batch_size, args.prompt_length,
+                                  args.decode_steps)
+            baseline = baseline or result['tokens_per_s']
+            print(f"{mode:>9} {num_workers:>7} {result['tokens_per_s']:>8.1f} {result['tokens_per_s'] / baseline:>6.2f}x "
+                  f"{result['p50_ms']:>8.1f} {result['p99_ms']:>8.1f} {result['cv']:>6.2f}")
+
+if __name__ == '__main__':
+    main()
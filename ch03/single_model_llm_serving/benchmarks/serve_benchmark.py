@@ -0,0 +1,271 @@
+"""Replay a ch09 dataset against the running API server and report serving latencies.
+
+Sends the dataset's prompts, each asking for its `expected_output_len`
+tokens, to `/generate_stream` or `/generate` of main.py. Arrivals follow
+a Poisson process at --request-rate, or a burstier gamma process with
+--burstiness below 1, and at most --max-concurrency requests are in
+flight over one pooled HTTP client. Reports TTFT, time per output token
+after the first (TPOT), inter-token latency (ITL) between streamed
+chunks and throughput the way `vllm bench serve` does. Output tokens
+are counted by tokenizing the returned text. With --result-file it
+appends one JSON line in the schema of ch09/test_serve_results.txt, so
+runs of this engine sit next to the vLLM ones recorded there.
+
+/generate returns each text whole, so its TTFT is the request's latency
+and it has no TPOT or ITL.
+
+    python main.py &
+    python benchmarks/serve_benchmark.py --dataset sharegpt --request-rate 2 --max-concurrency 8
+    python benchmarks/serve_benchmark.py --dataset prefix_repetition --goodput ttft:2000 tpot:200 \\
+        --result-file ../../ch09/test_serve_results.txt
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, NamedTuple, Optional, Tuple
+
+import httpx
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from llm.config import EngineConfig
+from llm.model_manager import ModelManager
+
+DATASETS = {
+    name: os.path.join(ROOT, '..', '..', 'ch09', f'{name}_samples.json') for name in ('sharegpt', 'prefix_repetition')
+}
+
+class RequestResult(NamedTuple):
+    success: bool
+    start: float
+    ttft: float
+    latency: float
+    # perf_counter() of every streamed chunk; one at the end for /generate
+    chunk_times: List[float]
+    # The streamed text, or the whole text /generate returned, prompt included
+    text: str
+    error: str = ""
+
+async def arrivals(samples: List[Dict[str, Any]], request_rate: float, burstiness: float,
+                   rng: random.Random) -> AsyncIterator[Dict[str, Any]]:
+    """Yield samples at gamma-distributed intervals with mean 1 / request_rate; shape 1 is a Poisson process."""
+    for sample in samples:
+        yield sample
+        if request_rate != float('inf'):
+            await asyncio.sleep(rng.gammavariate(burstiness, 1 / (request_rate * burstiness)))
+
+async def send_stream(client: httpx.AsyncClient, base_url: str, prompt: str,
+                      sampling_params: Dict[str, Any]) -> RequestResult:
+    start = time.perf_counter()
+    chunk_times, chunks = [], []
+    try:
+        async with client.stream('POST', f"{base_url}/generate_stream",
+                                 json={'prompt': prompt, 'sampling_params': sampling_params}) as response:
+            if response.status_code != 200:
+                await response.aread()
+                return RequestResult(False, start, 0.0, 0.0, [], "", f"HTTP {response.status_code}: {response.text}")
+            async for line in response.aiter_lines():
+                if line.startswith('data: '):
+                    chunk_times.append(time.perf_counter())
+                    chunks.append(json.loads(line[len('data: '):])['token'])
+    except httpx.HTTPError as e:
+        return RequestResult(False, start, 0.0, 0.0, [], "", repr(e))
+    end = time.perf_counter()
+    # A request that stops at once, on EOS, streams nothing
+    ttft = chunk_times[0] - start if chunk_times else end - start
+    return RequestResult(True, start, ttft, end - start, chunk_times or [end], "".join(chunks))
+
+async def send_generate(client: httpx.AsyncClient, base_url: str, prompt: str,
+                        sampling_params: Dict[str, Any]) -> RequestResult:
+    start = time.perf_counter()
+    try:
+        response = await client.post(f"{base_url}/generate",
+                                     json={'prompts': [prompt], 'sampling_params': sampling_params})
+    except httpx.HTTPError as e:
+        return RequestResult(False, start, 0.0, 0.0, [], "", repr(e))
+    end = time.perf_counter()
+    if response.status_code != 200:
+        return RequestResult(False, start, 0.0, 0.0, [], "", f"HTTP {response.status_code}: {response.text}")
+    return RequestResult(True, start, end - start, end - start, [end], response.json()['generated_texts'][0])
+
+async def run_benchmark(args, samples: List[Dict[str, Any]]) -> Tuple[float, List[RequestResult]]:
+    """Seconds from the first arrival until the last request finished, and each sample's result."""
+    send = send_stream if args.endpoint == 'generate_stream' else send_generate
+    # Connections are reused across requests, as many as may be in flight
+    limits = httpx.Limits(max_connections=args.max_concurrency, max_keepalive_connections=args.max_concurrency)
+    semaphore = asyncio.Semaphore(args.max_concurrency) if args.max_concurrency else None
+
+    def sampling_params(sample: Dict[str, Any]) -> Dict[str, Any]:
+        return {'max_tokens': args.output_len or sample['expected_output_len'], 'ignore_eos': args.ignore_eos,
+                'temperature': args.temperature}
+
+    async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(None)) as client:
+        async def limited(sample: Dict[str, Any]) -> RequestResult:
+            if semaphore is None:
+                return await send(client, args.base_url, sample['prompt'], sampling_params(sample))
+            async with semaphore:
+                return await send(client, args.base_url, sample['prompt'], sampling_params(sample))
+
+        # One request first, so a server that is down or still loading fails fast
+        warmup = await send(client, args.base_url, samples[0]['prompt'], {**sampling_params(samples[0]), 'max_tokens': 4})
+        if not warmup.success:
+            raise SystemExit(f"Warm-up request failed: {warmup.error}")
+        rng = random.Random(args.seed)
+        tasks = []
+        start = time.perf_counter()
+        async for sample in arrivals(samples, args.request_rate, args.burstiness, rng):
+            tasks.append(asyncio.create_task(limited(sample)))
+        results = await asyncio.gather(*tasks)
+        return time.perf_counter() - start, list(results)
+
+def summarize(args, samples: List[Dict[str, Any]], results: List[RequestResult], duration: float,
+              tokenizer, max_prompt_tokens: int) -> Tuple[Dict[str, Any], Dict[str, float]]:
+    """Totals, throughput and latency stats in milliseconds keyed as in ch09/test_serve_results.txt,
+    and the end-to-end latency stats, which that schema leaves out."""
+    input_lens, output_lens, ttfts, tpots, itls, e2els, good = [], [], [], [], [], [], 0
+    # Output tokens and requests in flight per second of the run
+    start = min(result.start for result in results)
+    num_seconds = int(max((result.start + result.latency for result in results), default=start) - start) + 1
+    tokens_per_second = np.zeros(num_seconds)
+    requests_per_second = np.zeros(num_seconds, dtype=int)
+    for sample, result in zip(samples, results):
+        if not result.success:
+            continue
+        # The server truncates prompts the same way
+        prompt_ids = tokenizer(sample['prompt'], truncation=True, max_length=max_prompt_tokens).input_ids
+        input_lens.append(len(prompt_ids))
+        output_text = result.text
+        if args.endpoint == 'generate':
+            # Its text is the prompt's tokens decoded together with the output's
+            output_text = output_text[len(tokenizer.decode(prompt_ids, skip_special_tokens=True)):]
+        num_output_tokens = len(tokenizer(output_text, add_special_tokens=False).input_ids)
+        output_lens.append(num_output_tokens)
+        ttfts.append(result.ttft)
+        e2els.append(result.latency)
+        tpot = None
+        if args.endpoint == 'generate_stream' and num_output_tokens > 1:
+            tpot = (result.latency - result.ttft) / (num_output_tokens - 1)
+            tpots.append(tpot)
+            itls.extend(np.diff(result.chunk_times))
+        # Streamed chunks may hold several tokens; spread them evenly
+        for chunk_time in result.chunk_times:
+            tokens_per_second[int(chunk_time - start)] += num_output_tokens / len(result.chunk_times)
+        requests_per_second[int(result.start - start):int(result.start + result.latency - start) + 1] += 1
+        if args.goodput and all(
+            value is not None and value * 1000 <= args.goodput[name]
+            for name, value in (('ttft', result.ttft), ('tpot', tpot), ('e2el', result.latency))
+            if name in args.goodput
+        ):
+            good += 1
+
+    def ms(values: List[float]) -> Dict[str, float]:
+        values = np.array(values or [0.0]) * 1000
+        return {'mean': float(np.mean(values)), 'median': float(np.median(values)),
+                'std': float(np.std(values)), 'p99': float(np.percentile(values, 99))}
+
+    summary = {
+        'date': datetime.now().strftime("%Y%m%d-%H%M%S"),
+        'setup': args.setup,
+        'endpoint_type': args.endpoint,
+        'backend': 'single_model_llm_serving',
+        'label': args.label,
+        'model_id': args.model,
+        'tokenizer_id': args.model,
+        'num_prompts': len(samples),
+        'request_rate': args.request_rate if args.request_rate != float('inf') else "inf",
+        'burstiness': args.burstiness,
+        'max_concurrency': args.max_concurrency,
+        'duration': duration,
+        'completed': len(ttfts),
+        'total_input_tokens': sum(input_lens),
+        'total_output_tokens': sum(output_lens),
+        'request_throughput': len(ttfts) / duration,
+        'request_goodput': good / duration if args.goodput else None,
+        'output_throughput': sum(output_lens) / duration,
+        'total_token_throughput': (sum(input_lens) + sum(output_lens)) / duration,
+        'max_output_tokens_per_s': float(np.ceil(tokens_per_second.max())),
+        'max_concurrent_requests': int(requests_per_second.max()),
+    }
+    if summary['setup'] is None:
+        # Older lines of the results file have no setup either
+        del summary['setup']
+    for name, values in (('ttft', ttfts), ('tpot', tpots), ('itl', itls)):
+        for stat, value in ms(values).items():
+            summary[f"{stat}_{name}_ms"] = value
+    return summary, ms(e2els)
+
+def parse_goodput(items: Optional[List[str]]) -> Dict[str, float]:
+    """SLOs in milliseconds such as ["ttft:500", "tpot:50"]; a request is good when it meets all of them."""
+    goodput = {}
+    for item in items or []:
+        name, _, value = item.partition(':')
+        if name not in ('ttft', 'tpot', 'e2el') or not value:
+            raise argparse.ArgumentTypeError(f"goodput takes ttft:, tpot: or e2el: milliseconds, not {item!r}")
+        goodput[name] = float(value)
+    return goodput
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', default=os.path.join(ROOT, 'config', 'engine.json'),
+                        help='engine config of the server, for its model and tokenizer')
+    parser.add_argument('--base-url', default='http://localhost:8000')
+    parser.add_argument('--endpoint', default='generate_stream', choices=['generate_stream', 'generate'])
+    parser.add_argument('--dataset', default='sharegpt',
+                        help=f"one of {sorted(DATASETS)} or the path of a JSON list of samples like theirs")
+    parser.add_argument('--num-prompts', type=int, default=None, help='cycles through the dataset; all of it by default')
+    parser.add_argument('--output-len', type=int, default=None, help="tokens per request instead of the sample's")
+    parser.add_argument('--ignore-eos', action='store_true', help='generate exactly the requested output tokens')
+    parser.add_argument('--temperature', type=float, default=0.0)
+    parser.add_argument('--request-rate', type=float, default=float('inf'), help='requests per second; inf sends all at once')
+    parser.add_argument('--burstiness', type=float, default=1.0, help='gamma shape of arrivals; 1 is Poisson, below 1 burstier')
+    parser.add_argument('--max-concurrency', type=int, default=None)
+    parser.add_argument('--goodput', nargs='+', default=None, metavar='METRIC:MS',
+                        help='SLOs a request must meet to count towards request_goodput, e.g. ttft:500 tpot:100')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--setup', default=None, help='free-form name of the setup, kept in the result line')
+    parser.add_argument('--label', default=None)
+    parser.add_argument('--result-file', default=None, help='append the result as a JSON line to this file')
+    args = parser.parse_args()
+    args.goodput = parse_goodput(args.goodput)
+
+    config = EngineConfig.load(args.config)
+    args.model = config.model
+    model_manager = ModelManager(config.model_cache.path)
+    tokenizer = model_manager.load_tokenizer(config.model)
+    max_prompt_tokens = getattr(model_manager.load_config(config.model), 'max_position_embeddings',
+                                tokenizer.model_max_length) - 1
+    with open(DATASETS.get(args.dataset, args.dataset)) as f:
+        dataset = json.load(f)
+    num_prompts = args.num_prompts or len(dataset)
+    samples = [dataset[i % len(dataset)] for i in range(num_prompts)]
+
+    duration, results = asyncio.run(run_benchmark(args, samples))
+    summary, e2el = summarize(args, samples, results, duration, tokenizer, max_prompt_tokens)
+
+    failed = [result.error for result in results if not result.success]
+    print(f"{args.endpoint} x {num_prompts} at {args.request_rate} req/s, burstiness {args.burstiness}, "
+          f"max concurrency {args.max_concurrency}")
+    print(f"completed {summary['completed']}, failed {len(failed)} in {duration:.1f}s"
+          + (f" (first error: {failed[0]})" if failed else ""))
+    print(f"tokens in/out: {summary['total_input_tokens']}/{summary['total_output_tokens']}, "
+          f"{summary['request_throughput']:.2f} req/s, {summary['output_throughput']:.1f} output tok/s, "
+          f"{summary['total_token_throughput']:.1f} total tok/s"
+          + (f", goodput {summary['request_goodput']:.2f} req/s" if args.goodput else ""))
+    print(f"peak {summary['max_output_tokens_per_s']:.0f} output tok/s, {summary['max_concurrent_requests']} concurrent requests")
+    print(f"{'ms':>5} {'mean':>9} {'median':>9} {'std':>9} {'p99':>9}")
+    for name in ('ttft', 'tpot', 'itl'):
+        print(f"{name.upper():>5} " + " ".join(f"{summary[f'{stat}_{name}_ms']:>9.1f}"
+                                             for stat in ('mean', 'median', 'std', 'p99')))
+    print(f"{'E2EL':>5} " + " ".join(f"{e2el[stat]:>9.1f}" for stat in ('mean', 'median', 'std', 'p99')))
+    if args.result_file:
+        with open(args.result_file, 'a') as f:
+            f.write(json.dumps(summary) + "\n")
+
+if __name__ == '__main__':
+    main()
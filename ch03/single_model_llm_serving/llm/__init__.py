@@ -1,3 +1,7 @@
 from .llm import LLMEngine
+from .admission import QueueFullError
+from .config import AdmissionConfig, AdmissionLimits, CacheConfig, EngineConfig, ExecutorConfig, SchedulerConfig
+from .sampling_params import SamplingParams
+from .scheduling_params import SchedulingParams
 
-__all__ = ['LLMEngine'] 
\ No newline at end of file
+__all__ = ['LLMEngine', 'AdmissionConfig', 'AdmissionLimits', 'CacheConfig', 'EngineConfig', 'ExecutorConfig', 'QueueFullError', 'SamplingParams', 'SchedulerConfig', 'SchedulingParams']
\ No newline at end of file
@@ -0,0 +1,92 @@
+import math
+import time
+from collections import deque
+from typing import Deque, Optional, Tuple
+from .config import AdmissionConfig, AdmissionLimits
+
+class QueueFullError(Exception):
+    """A request was turned away because the engine is overloaded; retry after `retry_after` seconds."""
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+class AdmissionController:
+    """Turns requests away instead of letting queues, and latency, grow without bound.
+
+    The scheduler keeps count of the prompt tokens still waiting for
+    prefill and of the output tokens it has promised (the rest of every
+    unfinished request's `max_tokens`). Throughput is the tokens scheduled
+    per second over the last `throughput_window_s`; the work queued ahead of
+    a new request divided by it estimates the request's wait. A request
+    that would push any count past its endpoint's limits is rejected with
+    the time the excess takes to drain. A request alone over a limit is
+    still admitted into an empty engine, or it could never run.
+    """
+    def __init__(self, config: Optional[AdmissionConfig] = None):
+        self.config = config or AdmissionConfig()
+        # (time, tokens) of recent engine steps
+        self.steps: Deque[Tuple[float, int]] = deque()
+        self.num_window_tokens = 0
+        self.num_rejected = 0
+
+    def record_step(self, num_tokens: int, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        self.steps.append((now, num_tokens))
+        self.num_window_tokens += num_tokens
+        self._expire(now)
+
+    def _expire(self, now: float):
+        while self.steps and self.steps[0][0] < now - self.config.throughput_window_s:
+            self.num_window_tokens -= self.steps.popleft()[1]
+
+    def throughput(self, now: Optional[float] = None) -> Optional[float]:
+        """Tokens per second over the window; None before the engine has run long enough to tell."""
+        now = time.monotonic() if now is None else now
+        self._expire(now)
+        if len(self.steps) < 2:
+            return None
+        # The oldest step only marks where the window starts
+        return (self.num_window_tokens - self.steps[0][1]) / max(now - self.steps[0][0], 1e-3)
+
+    def estimate_wait(self, num_queued_tokens: int, now: Optional[float] = None) -> Optional[float]:
+        """Seconds until num_queued_tokens more tokens are processed at the recent rate."""
+        throughput = self.throughput(now)
+        if not throughput:
+            return None
+        return num_queued_tokens / throughput
+
+    def check(self, limits: Optional[AdmissionLimits], num_queued_prompt_tokens: int, num_pending_decode_tokens: int,
+              num_prompt_tokens: int, num_decode_tokens: int, now: Optional[float] = None):
+        """Raise QueueFullError if a request with the given tokens does not fit next to the queued work."""
+        limits = limits or self.config.default
+        if not num_queued_prompt_tokens and not num_pending_decode_tokens:
+            return
+        now = time.monotonic() if now is None else now
+        excess, reason = 0.0, None
+        if limits.max_queued_prompt_tokens is not None:
+            over = num_queued_prompt_tokens + num_prompt_tokens - limits.max_queued_prompt_tokens
+            if over > 0:
+                excess, reason = over, f"{num_queued_prompt_tokens} prompt tokens already queued"
+        if reason is None and limits.max_pending_decode_tokens is not None:
+            over = num_pending_decode_tokens + num_decode_tokens - limits.max_pending_decode_tokens
+            if over > 0:
+                excess, reason = over, f"{num_pending_decode_tokens} output tokens already pending"
+        if reason is None and limits.max_queue_time_s is not None:
+            wait = self.estimate_wait(num_queued_prompt_tokens + num_pending_decode_tokens, now)
+            if wait is not None and wait > limits.max_queue_time_s:
+                # Tokens that have to drain first for the wait to fit
+                excess = num_queued_prompt_tokens + num_pending_decode_tokens - \
+                    limits.max_queue_time_s * self.throughput(now)
+                reason = f"estimated queue time {wait:.1f}s over {limits.max_queue_time_s}s"
+        if reason is None:
+            return
+        self.num_rejected += 1
+        drain_time = self.estimate_wait(int(math.ceil(excess)), now)
+        raise QueueFullError(
+            f"Engine overloaded: {reason}",
+            self.config.retry_after_s if drain_time is None else drain_time
+        )
@@ -0,0 +1,186 @@
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Sequence, Tuple
+
+class BlockManager:
+    """Allocates fixed-size KV-cache blocks of one worker replica to sequences.
+
+    The worker preallocates `num_blocks` blocks of `block_size` token slots
+    and reports the count at startup; this class only does the bookkeeping.
+    Each sequence owns a block table, the list of blocks that hold its
+    tokens in order. Blocks of preempted sequences can be swapped out to
+    `num_swap_blocks` host blocks and back in later.
+
+    With prefix caching, every full block is keyed by a hash of its tokens
+    and of the blocks before it, so sequences with a common prefix share
+    the blocks that hold it. Blocks are reference counted; a cached block
+    nobody uses stays valid in an LRU list and is only evicted when a fresh
+    block is needed, so the cache never grows past the pool.
+    """
+    def __init__(self, num_blocks: int, block_size: int, num_swap_blocks: int = 0, enable_prefix_caching: bool = True):
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.num_swap_blocks = num_swap_blocks
+        self.enable_prefix_caching = enable_prefix_caching
+        self.free_blocks: Deque[int] = deque(range(num_blocks))
+        self.free_swap_blocks: Deque[int] = deque(range(num_swap_blocks))
+        self.block_tables: Dict[str, List[int]] = {}
+        self.swapped_tables: Dict[str, List[int]] = {}
+        # Tokens stored per sequence, to report internal fragmentation
+        self.num_tokens: Dict[str, int] = {}
+        self.ref_counts = [0] * num_blocks
+        # prefix hash -> block and back, for full blocks whose KV is written
+        self.cached_blocks: Dict[int, int] = {}
+        self.block_hashes: Dict[int, int] = {}
+        # Unused cached blocks, least recently used first
+        self.evictable: "OrderedDict[int, None]" = OrderedDict()
+        # Hashes of the leading full blocks of each sequence
+        self.sequence_hashes: Dict[str, List[int]] = {}
+
+    @property
+    def num_free_blocks(self) -> int:
+        return len(self.free_blocks) + len(self.evictable)
+
+    def num_required_blocks(self, seq_id: str, num_tokens: int) -> int:
+        """Blocks the sequence's table has to grow by to hold num_tokens tokens."""
+        num_needed = -(-num_tokens // self.block_size)
+        return max(0, num_needed - len(self.block_tables.get(seq_id, ())))
+
+    def can_allocate(self, seq_id: str, num_tokens: int, cached_blocks: Sequence[int] = (), num_reserved: int = 0) -> bool:
+        """Whether the sequence's table can grow to hold num_tokens tokens, starting from cached_blocks,
+        and leave num_reserved blocks free."""
+        num_required = self.num_required_blocks(seq_id, num_tokens) - len(cached_blocks)
+        # Reusing an unused cached block takes it off the LRU list too
+        num_revived = sum(1 for block in cached_blocks if self.ref_counts[block] == 0)
+        return num_required + num_revived + num_reserved <= self.num_free_blocks
+
+    def allocate(self, seq_id: str, num_tokens: int, cached_blocks: Sequence[int] = ()) -> List[int]:
+        """Grow the sequence's block table to hold num_tokens tokens.
+
+        `cached_blocks` comes from `lookup()` for a sequence without a table
+        yet and becomes the start of it.
+        """
+        if not self.can_allocate(seq_id, num_tokens, cached_blocks):
+            raise MemoryError(f"Not enough free KV blocks for {num_tokens} tokens of {seq_id}")
+        table = self.block_tables.setdefault(seq_id, [])
+        if cached_blocks:
+            for block in cached_blocks:
+                self._acquire(block)
+                table.append(block)
+            self.sequence_hashes[seq_id] = [self.block_hashes[block] for block in cached_blocks]
+        for _ in range(self.num_required_blocks(seq_id, num_tokens)):
+            block = self._pop_free_block()
+            self.ref_counts[block] = 1
+            table.append(block)
+        self.num_tokens[seq_id] = num_tokens
+        return table
+
+    def _acquire(self, block: int):
+        if self.ref_counts[block] == 0:
+            del self.evictable[block]
+        self.ref_counts[block] += 1
+
+    def _release(self, block: int):
+        self.ref_counts[block] -= 1
+        if self.ref_counts[block] == 0:
+            if block in self.block_hashes:
+                self.evictable[block] = None
+            else:
+                self.free_blocks.append(block)
+
+    def _pop_free_block(self) -> int:
+        if self.free_blocks:
+            return self.free_blocks.popleft()
+        # Evict the least recently used cached block
+        block, _ = self.evictable.popitem(last=False)
+        del self.cached_blocks[self.block_hashes.pop(block)]
+        return block
+
+    def lookup(self, token_ids: Sequence[int]) -> List[int]:
+        """Blocks holding the longest cached run of full blocks at the start of token_ids."""
+        blocks: List[int] = []
+        if not self.enable_prefix_caching:
+            return blocks
+        prefix_hash = None
+        for start in range(0, len(token_ids) - self.block_size + 1, self.block_size):
+            prefix_hash = hash((prefix_hash, tuple(token_ids[start:start + self.block_size])))
+            block = self.cached_blocks.get(prefix_hash)
+            if block is None:
+                break
+            blocks.append(block)
+        return blocks
+
+    def has_uncached_full_blocks(self, seq_id: str, num_computed_tokens: int) -> bool:
+        """Cheap check before `cache_full_blocks`, which needs all token ids of the sequence."""
+        if not self.enable_prefix_caching or seq_id not in self.block_tables:
+            return False
+        num_full_blocks = min(num_computed_tokens // self.block_size, len(self.block_tables[seq_id]))
+        return num_full_blocks > len(self.sequence_hashes.get(seq_id, ()))
+
+    def cache_full_blocks(self, seq_id: str, token_ids: Sequence[int], num_computed_tokens: int):
+        """Make the sequence's full blocks whose KV is already written reusable by others."""
+        if not self.enable_prefix_caching or seq_id not in self.block_tables:
+            return
+        table = self.block_tables[seq_id]
+        hashes = self.sequence_hashes.setdefault(seq_id, [])
+        for index in range(len(hashes), min(num_computed_tokens // self.block_size, len(table))):
+            start = index * self.block_size
+            prefix_hash = hash((hashes[-1] if hashes else None, tuple(token_ids[start:start + self.block_size])))
+            hashes.append(prefix_hash)
+            block = table[index]
+            # Another sequence may have cached the same tokens first
+            if prefix_hash not in self.cached_blocks and block not in self.block_hashes:
+                self.cached_blocks[prefix_hash] = block
+                self.block_hashes[block] = prefix_hash
+
+    def free(self, seq_id: str):
+        for block in self.block_tables.pop(seq_id, ()):
+            self._release(block)
+        self.free_swap_blocks.extend(self.swapped_tables.pop(seq_id, ()))
+        self.num_tokens.pop(seq_id, None)
+        self.sequence_hashes.pop(seq_id, None)
+
+    def can_swap_out(self, seq_id: str) -> bool:
+        return len(self.block_tables.get(seq_id, ())) <= len(self.free_swap_blocks)
+
+    def swap_out(self, seq_id: str) -> List[Tuple[int, int]]:
+        """Move a sequence's blocks to swap space; returns (device block, swap block) pairs."""
+        table = self.block_tables.pop(seq_id)
+        swapped = [self.free_swap_blocks.popleft() for _ in table]
+        for block in table:
+            self._release(block)
+        self.swapped_tables[seq_id] = swapped
+        # Its blocks come back at new places, unknown to the hash index
+        self.sequence_hashes.pop(seq_id, None)
+        return list(zip(table, swapped))
+
+    def can_swap_in(self, seq_id: str, num_tokens: int) -> bool:
+        """Whether the swapped blocks fit back, grown to hold num_tokens tokens."""
+        num_needed = max(len(self.swapped_tables[seq_id]), -(-num_tokens // self.block_size))
+        return num_needed <= self.num_free_blocks
+
+    def swap_in(self, seq_id: str) -> List[Tuple[int, int]]:
+        """Bring a swapped sequence back; returns (swap block, device block) pairs."""
+        swapped = self.swapped_tables.pop(seq_id)
+        table = []
+        for _ in swapped:
+            block = self._pop_free_block()
+            self.ref_counts[block] = 1
+            table.append(block)
+        self.free_swap_blocks.extend(swapped)
+        self.block_tables[seq_id] = table
+        return list(zip(swapped, table))
+
+    def get_stats(self) -> Dict[str, float]:
+        used_blocks = self.num_blocks - self.num_free_blocks
+        used_slots = sum(len(self.block_tables[seq_id]) for seq_id in self.block_tables) * self.block_size
+        stored_tokens = sum(self.num_tokens.get(seq_id, 0) for seq_id in self.block_tables)
+        return {
+            'num_blocks': self.num_blocks,
+            'used_blocks': used_blocks,
+            'utilization': used_blocks / self.num_blocks if self.num_blocks else 0.0,
+            # Share of allocated slots that hold no token (partly filled last blocks)
+            'fragmentation': 1 - stored_tokens / used_slots if used_slots else 0.0,
+            'cached_blocks': len(self.cached_blocks),
+            'num_swap_blocks': self.num_swap_blocks,
+            'used_swap_blocks': self.num_swap_blocks - len(self.free_swap_blocks),
+        }
@@ -0,0 +1,130 @@
+import time
+import warnings
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+import torch
+from transformers import DynamicCache
+from .config import CompileConfig
+
+class ForwardStep(torch.nn.Module):
+    """One forward of a model over new tokens and their gathered cached context.
+
+    It takes and returns tensors only, so it can be traced or compiled:
+    `context_kv` is `[layer, key/value, row, position, head, head_dim]`,
+    and the keys and values of the new tokens come back in the same layout
+    next to the logits.
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, position_ids: torch.Tensor,
+                context_kv: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        max_context = context_kv.shape[3]
+        past_key_values = None
+        if max_context:
+            past_key_values = DynamicCache.from_legacy_cache(tuple(
+                (context_kv[layer, 0].transpose(1, 2), context_kv[layer, 1].transpose(1, 2))
+                for layer in range(context_kv.shape[0])
+            ))
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+            use_cache=True
+        )
+        new_kv = torch.stack([
+            torch.stack((key[:, :, max_context:], value[:, :, max_context:])).transpose(2, 3)
+            for key, value in _to_legacy_cache(outputs.past_key_values)
+        ])
+        return outputs.logits, new_kv
+
+class CompiledSteps:
+    """A model's ForwardStep, compiled once per padded shape bucket.
+
+    A bucket is a number of rows, of new tokens per row and of cached
+    context positions, each from a short list, so a few graphs cover every
+    decode forward after padding. Shapes past the largest bucket, and
+    every forward when compilation is off, run the eager step. All buckets
+    are compiled by warmup(), before the worker takes its first step, and
+    the latency of every forward is recorded under its bucket.
+    """
+    def __init__(self, model, config: CompileConfig, new_token_counts: Sequence[int]):
+        self.step = ForwardStep(model)
+        self.mode = config.mode
+        self.batch_sizes = sorted(config.batch_sizes)
+        self.context_lengths = sorted(config.context_lengths)
+        self.new_token_counts = sorted(set(new_token_counts))
+        self.compiled: Dict[Tuple[int, int, int], Callable] = {}
+        self.compile_s = 0.0
+        # Forwards and their total seconds, per bucket label
+        self.latency: Dict[str, List[float]] = {}
+
+    def bucket(self, num_rows: int, num_new_tokens: int, max_context: int) -> Optional[Tuple[int, int, int]]:
+        """The smallest bucket a forward of this shape fits, None past the largest ones."""
+        if not max_context:
+            # First prefill chunks are long and compute-bound
+            return None
+        shape = tuple(
+            next((size for size in sizes if size >= n), None) for n, sizes in
+            ((num_rows, self.batch_sizes), (num_new_tokens, self.new_token_counts), (max_context, self.context_lengths))
+        )
+        return None if None in shape else shape
+
+    def warmup(self, num_layers: int, num_kv_heads: int, head_dim: int, dtype: torch.dtype, device: str):
+        """Compile every bucket and run each a few times, so no request pays for it."""
+        if self.mode is None:
+            return
+        if self.mode == "inductor":
+            # Each bucket is a graph of its own for the same code
+            num_buckets = len(self.batch_sizes) * len(self.new_token_counts) * len(self.context_lengths)
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, num_buckets)
+        start = time.perf_counter()
+        for num_rows in self.batch_sizes:
+            for num_new_tokens in self.new_token_counts:
+                for max_context in self.context_lengths:
+                    inputs = (
+                        torch.zeros((num_rows, num_new_tokens), dtype=torch.long, device=device),
+                        torch.ones((num_rows, max_context + num_new_tokens), dtype=torch.long, device=device),
+                        max_context + torch.arange(num_new_tokens, device=device).expand(num_rows, -1),
+                        torch.zeros((num_layers, 2, num_rows, max_context, num_kv_heads, head_dim),
+                                    dtype=dtype, device=device),
+                    )
+                    with torch.no_grad(), warnings.catch_warnings():
+                        if self.mode == "torchscript":
+                            # Shape checks in the model's code are fixed for the bucket by design
+                            warnings.simplefilter("ignore", torch.jit.TracerWarning)
+                            compiled = torch.jit.trace(self.step, inputs, check_trace=False)
+                        else:
+                            compiled = torch.compile(self.step, dynamic=False)
+                        # TorchScript optimizes its graph over the first runs
+                        for _ in range(3):
+                            compiled(*inputs)
+                    self.compiled[(num_rows, num_new_tokens, max_context)] = compiled
+        self.compile_s = time.perf_counter() - start
+
+    def __call__(self, bucket: Optional[Tuple[int, int, int]], *inputs: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Run the compiled step of a bucket the inputs are padded to, or the eager one."""
+        step = self.compiled.get(bucket, self.step)
+        start = time.perf_counter()
+        outputs = step(*inputs)
+        if outputs[0].is_cuda:
+            torch.cuda.synchronize()
+        label = 'x'.join(map(str, bucket)) if bucket else 'other'
+        entry = self.latency.setdefault(label, [0, 0.0])
+        entry[0] += 1
+        entry[1] += time.perf_counter() - start
+        return outputs
+
+    def get_stats(self) -> Dict[str, object]:
+        return {
+            'mode': self.mode or 'eager',
+            'compile_s': self.compile_s,
+            'step_latency_ms': {label: 1000 * total / count for label, (count, total) in self.latency.items()},
+        }
+
+
+def _to_legacy_cache(past_key_values) -> Tuple[Tuple[torch.Tensor, torch.Tensor], ...]:
+    if hasattr(past_key_values, 'to_legacy_cache'):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
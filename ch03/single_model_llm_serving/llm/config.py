@@ -0,0 +1,139 @@
+import json
+import os
+from typing import Dict, List, Literal, Optional
+from pydantic import BaseModel, Field, model_validator
+
+class SchedulerConfig(BaseModel):
+    # Order of admission and preemption: arrival, priority then deadline, or earliest deadline
+    policy: Literal["fcfs", "priority", "edf"] = "fcfs"
+    # Upper bound of sequences that run together in one engine step
+    max_num_seqs: int = Field(default=64, gt=0)
+    # Upper bound of prefill + decode tokens fed to the model in one engine step
+    max_num_batched_tokens: int = Field(default=2048, gt=0)
+    # Upper bound of prompt tokens prefilled in one engine step; longer
+    # prompts are fed in chunks over several steps, next to the decoding
+    # sequences. None prefills every prompt whole.
+    prefill_chunk_size: Optional[int] = Field(default=512, gt=0)
+
+class ExecutorConfig(BaseModel):
+    # Number of ModelWorker processes, each with its own copy of the model
+    num_workers: int = Field(default=1, gt=0)
+    # torch intra-op threads per worker; None splits the host's cores evenly,
+    # or gives a pinned worker one per physical core it has
+    threads_per_worker: Optional[int] = Field(default=None, gt=0)
+    # torch inter-op threads per worker
+    interop_threads_per_worker: int = Field(default=1, gt=0)
+    # Pin each worker to whole physical cores of its own, NUMA node by node,
+    # and the engine and API threads to the cores left over (Linux only)
+    pin_cpus: bool = False
+    # Physical cores kept for the engine loop and API server when pinning
+    reserved_cores: int = Field(default=1, ge=0)
+    # Share of a prefill forward's positions left padding may fill before
+    # the batch is split into length buckets; 1 never splits
+    max_padding_fraction: float = Field(default=0.25, ge=0, le=1)
+
+class CompileConfig(BaseModel):
+    # Decode forwards traced with TorchScript or compiled with torch.compile,
+    # one graph per shape bucket; None runs every forward eagerly
+    mode: Optional[Literal["torchscript", "inductor"]] = None
+    # Decode forwards are padded up to the next batch size and cached context
+    # length listed; larger ones run eagerly. Every combination is compiled
+    # at startup
+    batch_sizes: List[int] = [1, 2, 4, 8, 16, 32, 64]
+    context_lengths: List[int] = [128, 256, 512, 1024, 2048]
+
+class CacheConfig(BaseModel):
+    # Tokens per KV-cache block
+    block_size: int = Field(default=16, gt=0)
+    # Share of free device memory (host RAM on CPU) the worker pool reserves for KV blocks
+    memory_fraction: float = Field(default=0.3, gt=0, le=1)
+    # Fixed KV-cache size per worker in bytes; overrides memory_fraction
+    memory_bytes: Optional[int] = Field(default=None, gt=0)
+    # Host memory per worker for blocks of swapped-out sequences
+    swap_space_bytes: int = Field(default=0, ge=0)
+    # What happens to a sequence preempted when blocks run out; swap falls
+    # back to recompute when the swap space is full
+    preemption_mode: Literal["recompute", "swap"] = "recompute"
+    # Share the KV blocks of token prefixes that earlier sequences computed
+    enable_prefix_caching: bool = True
+
+class AdmissionLimits(BaseModel):
+    # Prompt tokens waiting for prefill, this request's included; None is unlimited
+    max_queued_prompt_tokens: Optional[int] = Field(default=None, gt=0)
+    # Output tokens still to generate for every unfinished request, by their max_tokens
+    max_pending_decode_tokens: Optional[int] = Field(default=None, gt=0)
+    # Longest estimated wait for the work queued ahead of a new request
+    max_queue_time_s: Optional[float] = Field(default=None, gt=0)
+
+class AdmissionConfig(BaseModel):
+    # Limits for endpoints without their own entry
+    default: AdmissionLimits = AdmissionLimits()
+    # Per-endpoint limits keyed by path, e.g. "/generate_stream"
+    endpoints: Dict[str, AdmissionLimits] = {}
+    # Seconds of recent engine steps the throughput estimate covers
+    throughput_window_s: float = Field(default=10.0, gt=0)
+    # Retry-After for rejections before there is a throughput estimate
+    retry_after_s: float = Field(default=1.0, gt=0)
+
+    def limits_for(self, endpoint: Optional[str]) -> AdmissionLimits:
+        return self.endpoints.get(endpoint, self.default) if endpoint else self.default
+
+class PrecisionConfig(BaseModel):
+    # Weights of models without their own entry: full fp32, bf16, or int8
+    # dynamic quantization of the linear layers (CPU only)
+    default: Literal["fp32", "bf16", "int8"] = "fp32"
+    # Per-model precision keyed by model name, e.g. for the draft model
+    models: Dict[str, Literal["fp32", "bf16", "int8"]] = {}
+
+    def precision_for(self, model_name: str) -> str:
+        return self.models.get(model_name, self.default)
+
+class ModelCacheConfig(BaseModel):
+    # Local snapshots of model weights as safetensors, memory-mapped at load
+    # so the workers on a host share their pages; None loads from the hub
+    path: Optional[str] = "model_cache"
+
+class SpeculativeConfig(BaseModel):
+    # Who proposes tokens for the model to verify: an n-gram lookup in the
+    # sequence's own tokens, or a small draft model; None turns it off
+    method: Optional[Literal["ngram", "draft"]] = None
+    # Tokens proposed per sequence and step
+    num_speculative_tokens: int = Field(default=4, gt=0)
+    # Draft model for the "draft" method; it has to share the model's tokenizer
+    draft_model: Optional[str] = None
+    # Longest and shortest n-gram at the end of a sequence looked up earlier in it
+    prompt_lookup_max: int = Field(default=3, gt=0)
+    prompt_lookup_min: int = Field(default=1, gt=0)
+
+    @model_validator(mode="after")
+    def _check_draft_model(self) -> "SpeculativeConfig":
+        if self.method == "draft" and not self.draft_model:
+            raise ValueError("speculative method 'draft' needs a draft_model")
+        return self
+
+class ProfilerConfig(BaseModel):
+    # Record engine step stages and request lifecycles from startup; the
+    # admin endpoint switches it at runtime either way
+    enabled: bool = False
+    # Events kept per process; older ones are dropped
+    max_events: int = Field(default=200_000, gt=0)
+
+class EngineConfig(BaseModel):
+    model: str = "facebook/opt-125m"
+    precision: PrecisionConfig = PrecisionConfig()
+    model_cache: ModelCacheConfig = ModelCacheConfig()
+    scheduler: SchedulerConfig = SchedulerConfig()
+    executor: ExecutorConfig = ExecutorConfig()
+    compile: CompileConfig = CompileConfig()
+    cache: CacheConfig = CacheConfig()
+    admission: AdmissionConfig = AdmissionConfig()
+    speculative: SpeculativeConfig = SpeculativeConfig()
+    profiler: ProfilerConfig = ProfilerConfig()
+
+    @classmethod
+    def load(cls, config_path: str) -> "EngineConfig":
+        """Load the engine config from a JSON file, falling back to defaults if it is missing."""
+        if not os.path.exists(config_path):
+            return cls()
+        with open(config_path, 'r') as f:
+            return cls(**json.load(f))
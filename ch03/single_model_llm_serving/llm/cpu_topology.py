@@ -0,0 +1,102 @@
+import glob
+import os
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+class Core(NamedTuple):
+    """A physical core: its NUMA node and its logical CPUs (hyperthreads)."""
+    node: int
+    cpus: Tuple[int, ...]
+
+class Placement(NamedTuple):
+    # Logical CPUs each worker is pinned to, and its intra-op threads: one per physical core
+    worker_cpus: List[List[int]]
+    worker_threads: List[int]
+    # CPUs left to the engine loop and the API server
+    api_cpus: List[int]
+
+def parse_cpu_list(text: str) -> List[int]:
+    """CPUs of a sysfs list such as "0-3,8-11"."""
+    cpus = []
+    for part in text.strip().split(','):
+        if part:
+            first, _, last = part.partition('-')
+            cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+def discover_cores(sysfs: str = "/sys/devices/system") -> List[Core]:
+    """Physical cores this process may run on, in NUMA node order.
+
+    Only CPUs in the process's affinity mask count, so a container's cpuset
+    is respected. Without sysfs every CPU is a core of node 0.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        allowed = sorted(os.sched_getaffinity(0))
+    else:
+        allowed = list(range(os.cpu_count() or 1))
+    node_of = {}
+    for node_dir in glob.glob(os.path.join(sysfs, "node", "node[0-9]*")):
+        with open(os.path.join(node_dir, "cpulist")) as f:
+            for cpu in parse_cpu_list(f.read()):
+                node_of[cpu] = int(os.path.basename(node_dir)[4:])
+    cores: Dict[Tuple[int, int, int], List[int]] = {}
+    for cpu in allowed:
+        topology = os.path.join(sysfs, "cpu", f"cpu{cpu}", "topology")
+        try:
+            with open(os.path.join(topology, "physical_package_id")) as f:
+                package = int(f.read())
+            with open(os.path.join(topology, "core_id")) as f:
+                core_id = int(f.read())
+        except (OSError, ValueError):
+            package, core_id = 0, cpu
+        cores.setdefault((node_of.get(cpu, 0), package, core_id), []).append(cpu)
+    return [Core(node, tuple(cpus)) for (node, _, _), cpus in sorted(cores.items())]
+
+def plan_placement(cores: Sequence[Core], num_workers: int, reserved_cores: int) -> Optional[Placement]:
+    """Give every worker the same number of whole physical cores, disjoint and NUMA-local where they fit.
+
+    The first reserved_cores cores go to the engine and API threads. Each
+    NUMA node is cut into per-worker chunks before any worker gets cores of
+    two nodes. Workers run each step in lock step, so the slowest sets the
+    pace: cores beyond an equal share go to the API side instead of making
+    one worker faster. Returns None when there are fewer cores than workers;
+    with too few for the reservation as well, the API shares the workers'.
+    """
+    if len(cores) < num_workers:
+        return None
+    if len(cores) < num_workers + reserved_cores:
+        reserved_cores = 0
+    api_cores = list(cores[:reserved_cores])
+    per_worker = (len(cores) - reserved_cores) // num_workers
+    by_node: Dict[int, List[Core]] = {}
+    for core in cores[reserved_cores:]:
+        by_node.setdefault(core.node, []).append(core)
+    chunks, fragments = [], []
+    for node_cores in by_node.values():
+        while len(node_cores) >= per_worker and len(chunks) < num_workers:
+            chunks.append(node_cores[:per_worker])
+            node_cores = node_cores[per_worker:]
+        fragments.extend(node_cores)
+    while len(chunks) < num_workers:
+        chunks.append(fragments[:per_worker])
+        fragments = fragments[per_worker:]
+    api_cores.extend(fragments)
+    # With nothing reserved the API threads are not pinned at all
+    api_cpus = sorted(cpu for core in api_cores for cpu in core.cpus) if reserved_cores else []
+    return Placement(
+        worker_cpus=[sorted(cpu for core in chunk for cpu in core.cpus) for chunk in chunks],
+        worker_threads=[len(chunk) for chunk in chunks],
+        api_cpus=api_cpus
+    )
+
+def pin_process(cpus: Sequence[int]):
+    """Move every thread of this process onto cpus; threads started later inherit it."""
+    try:
+        tids = [int(tid) for tid in os.listdir("/proc/self/task")]
+    except OSError:
+        tids = [0]
+    for tid in tids:
+        try:
+            os.sched_setaffinity(tid, cpus)
+        except ProcessLookupError:
+            # The thread exited meanwhile
+            pass
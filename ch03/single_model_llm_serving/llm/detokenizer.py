@@ -0,0 +1,40 @@
+from typing import List
+from .workload_manager import Sequence
+
+class IncrementalDetokenizer:
+    """Turns the tokens streaming sequences sampled into stable text deltas.
+
+    Decoding one token id at a time splits multi-byte UTF-8 characters
+    that byte-level BPE spreads over several tokens, and drops the leading
+    spaces some tokenizers only render in context. Instead every sequence
+    keeps two offsets into its token ids: text is decoded from
+    `prefix_offset`, a few tokens of context, and what lies past
+    `read_offset` is emitted once it no longer ends in a replacement
+    character, and appended to the sequence's `output_text`. One
+    `batch_decode` call covers all sequences of a step.
+    """
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+
+    def step(self, sequences: List[Sequence]) -> List[str]:
+        """The new text of each sequence; empty while its last character is incomplete."""
+        if not sequences:
+            return []
+        token_id_lists = []
+        for sequence in sequences:
+            token_ids = sequence.get_token_ids_from(sequence.prefix_offset)
+            token_id_lists.append(token_ids[:sequence.read_offset - sequence.prefix_offset])
+            token_id_lists.append(token_ids)
+        texts = self.tokenizer.batch_decode(token_id_lists, skip_special_tokens=True)
+
+        deltas = []
+        for sequence, prefix_text, new_text in zip(sequences, texts[::2], texts[1::2]):
+            if len(new_text) > len(prefix_text) and not new_text.endswith("�"):
+                delta = new_text[len(prefix_text):]
+                sequence.output_text += delta
+                deltas.append(delta)
+                sequence.prefix_offset = sequence.read_offset
+                sequence.read_offset = len(sequence.prompt_token_ids) + len(sequence.output_token_ids)
+            else:
+                deltas.append("")
+        return deltas
@@ -1,136 +1,367 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, AsyncIterator, Optional, Tuple
+from .block_manager import BlockManager
+from .config import AdmissionLimits, EngineConfig
+from .detokenizer import IncrementalDetokenizer
 from .workload_manager import WorkloadManager, Sequence
 from .model_executor import ModelExecutor
+from .metrics import EngineMetrics
+from .model_manager import ModelManager
+from .profiler import profiler
+from .sampling_params import SamplingParams
+from .scheduling_params import SchedulingParams
+from .stop_checker import get_matcher
 import asyncio
 import json
+from concurrent.futures import Future
 import atexit
 import threading
 import time
-import uuid
 from vllm import LLM as VLLM
-from vllm import SamplingParams
+from vllm import SamplingParams as VLLMSamplingParams
 
 class LLMEngine:
-    def __init__(self):
-        self.model_executor = ModelExecutor()
-        self.workload_manager = WorkloadManager()
-        self.max_tokens = 20
+    def __init__(self, config: Optional[EngineConfig] = None):
+        self.config = config or EngineConfig()
+        self.model_executor = ModelExecutor(self.config.executor, self.config.scheduler, self.config.cache,
+                                            self.config.speculative, self.config.precision, self.config.model_cache,
+                                            self.config.compile)
+        
+        # The engine keeps a tokenizer so text only exists at the API edges
+        # and everything behind it moves token ids.
+        model_manager = ModelManager(self.config.model_cache.path)
+        self.tokenizer = model_manager.load_tokenizer(self.config.model)
+        self.detokenizer = IncrementalDetokenizer(self.tokenizer)
+        # Positions the model has embeddings for; long prompts are prefilled
+        # in chunks, so only the model limits their length
+        self.max_model_len = getattr(
+            model_manager.load_config(self.config.model), 'max_position_embeddings', self.tokenizer.model_max_length
+        )
+        self.max_prompt_tokens = self.max_model_len - 1
         
         # Initialize the model
-        self.model_executor.setup_worker("facebook/opt-125m")
+        self.model_executor.setup_workers(self.config.model, self.max_model_len)
+        
+        # The scheduler accounts for the KV blocks each worker allocated
+        self.workload_manager = WorkloadManager(self.config.scheduler, self.config.cache, [
+            BlockManager(replica.num_blocks, self.config.cache.block_size, replica.num_swap_blocks,
+                         self.config.cache.enable_prefix_caching)
+            for replica in self.model_executor.replicas
+        ], self.config.admission, self.config.speculative, self.max_model_len)
+        self.metrics = EngineMetrics(self.config.scheduler.max_num_seqs, self.config.scheduler.max_num_batched_tokens)
+        if self.config.profiler.enabled:
+            self.set_profiling(True)
         
         # Initialize vLLM model
-        self.vllm_model = VLLM(model="facebook/opt-125m")
+        self.vllm_model = VLLM(model=self.config.model)
         
         # Start processing loop in a separate thread
-        self.thread = threading.Thread(target=self.requests_processing_loop, daemon=True)
+        self.thread = threading.Thread(target=self.requests_processing_loop, name="engine-loop", daemon=True)
         self.thread.start()
         
         # Register cleanup
         atexit.register(self._cleanup)
     
     def requests_processing_loop(self):
-        """Process requests in a loop."""
+        """Run one engine step per iteration over streaming and batch requests alike."""
         while True:
+            scheduler_output = None
             try:
-                active_sequences = self.workload_manager.get_next_batch(is_streaming=True)
-                if not active_sequences:
-                    time.sleep(0.1)
+                with profiler.span('schedule'):
+                    scheduler_output = self.workload_manager.schedule()
+                for seq in scheduler_output.aborted:
+                    self._abort_sequence(seq)
+                for seq in scheduler_output.finished:
+                    # Out of KV cache; ends as if it reached max_tokens
+                    self._finish_sequence(seq)
+                if not scheduler_output.sequences:
+                    # Sleep until an add_*_request call signals new work
+                    self.workload_manager.wait_for_work()
                     continue
                     
+                # Move blocks of preempted and resumed sequences first
+                if scheduler_output.blocks_to_swap_out or scheduler_output.blocks_to_swap_in:
+                    with profiler.span('swap'):
+                        self.model_executor.swap_blocks(scheduler_output.blocks_to_swap_out,
+                                                        scheduler_output.blocks_to_swap_in)
+                
+                self.metrics.record_step(scheduler_output.sequences, scheduler_output.num_prefill_tokens,
+                                         scheduler_output.num_decode_tokens, time.monotonic())
+                
                 # Process batch through model, forward pass.
-                prompts = [{'prompt': seq.prompt, 'request_id': seq.id} for seq in active_sequences]
-                prompts_results = self.model_executor.execute_forward_batch(prompts)
+                with profiler.span('forward', sequences=len(scheduler_output.sequences),
+                                   prefill_tokens=scheduler_output.num_prefill_tokens,
+                                   decode_tokens=scheduler_output.num_decode_tokens):
+                    prompts_results = self.model_executor.execute_forward_batch(scheduler_output.prompts)
+                now = time.monotonic()
                 
-                # Stream tokens back to respective clients
-                for result in prompts_results:
-                    seq = self.workload_manager.get_sequence(result['request_id'])
-                    if result['is_finished'] or seq.token_count > self.max_tokens:
-                        # Use run_coroutine_threadsafe to safely put None in the main loop's queue
-                        asyncio.run_coroutine_threadsafe(
-                            seq.client_stream.put(None),
-                            seq.loop
-                        )
-                        seq.finished = True
-                        self.workload_manager.remove_finished_sequence(result['request_id'])
-                    else:
-                        # Use run_coroutine_threadsafe to safely put data in the main loop's queue
-                        asyncio.run_coroutine_threadsafe(
-                            seq.client_stream.put(
-                                json.dumps({"token": result['token'], "sequence_id": result['request_id']})
-                            ),
-                            seq.loop
+                finished: Dict[str, Sequence] = {}
+                detokenize = []
+                with profiler.span('outputs', sequences=len(prompts_results)):
+                    for result in prompts_results:
+                        seq = self.workload_manager.get_sequence(result['request_id'])
+                        if seq is None or seq.finished:
+                            continue
+                        params = seq.sampling_params
+                        token_ids = result['token_ids']
+                        if not token_ids:
+                            # Fed a prefill chunk, the prompt goes on next step
+                            continue
+                        # Speculating sequences get their accepted proposals and one more token
+                        accepted = []
+                        for token_id in token_ids:
+                            if token_id in params.stop_token_ids or (token_id == self.tokenizer.eos_token_id and not params.ignore_eos):
+                                # Stop tokens are not part of the output
+                                finished[seq.id] = seq
+                                break
+                            accepted.append(token_id)
+                            if seq.token_count + len(accepted) >= params.max_tokens or \
+                                    len(seq.prompt_token_ids) + seq.token_count + len(accepted) >= self.max_model_len:
+                                finished[seq.id] = seq
+                                break
+                        if not accepted:
+                            continue
+                        self.metrics.record_tokens(seq, len(accepted), now)
+                        # Only the proposals kept count as accepted: a stop can cut the
+                        # output short of the last ones the worker verified
+                        self.workload_manager.update_sequence_output(
+                            seq.id, accepted, num_accepted=min(len(token_ids) - 1, len(accepted))
                         )
-                        self.workload_manager.update_sequence_output(result['request_id'], result['token'])
+                        if seq.client_stream is not None or params.stop:
+                            detokenize.append(seq)
+                
+                # Decode the new text of all of them at once, then stream what
+                # no stop string can claim any more back to the clients
+                if detokenize:
+                    with profiler.span('detokenize', sequences=len(detokenize)):
+                        deltas = self.detokenizer.step(detokenize)
+                    with profiler.span('stream', sequences=len(detokenize)):
+                        for seq, delta in zip(detokenize, deltas):
+                            text, stopped = self._check_stop_strings(seq, len(delta))
+                            if text and seq.client_stream is not None:
+                                self._stream(seq, text)
+                            if stopped:
+                                finished[seq.id] = seq
+                
+                if finished:
+                    with profiler.span('finish', sequences=len(finished)):
+                        for seq in finished.values():
+                            # Evict right away so the slot and KV blocks are reused on the next step
+                            self.workload_manager.finish_sequence(seq.id)
+                            self._finish_sequence(seq)
                 
             except Exception as e:
                 print(f"Error in processing loop: {e}")
+                if scheduler_output is not None:
+                    # The step's tokens are lost; its sequences end with the error
+                    # instead of waiting for tokens that never come
+                    for seq in self.workload_manager.fail_sequences([seq.id for seq in scheduler_output.sequences]):
+                        self._fail_sequence(seq, e)
                 time.sleep(0.1)
     
+    def _check_stop_strings(self, seq: Sequence, num_new_chars: int) -> Tuple[str, bool]:
+        """Text of seq to stream after its last num_new_chars were detokenized, and whether a stop string ended it.
+
+        Text that may be the start of a stop string is held back until the
+        next characters decide it; on a match the output ends where the stop
+        string begins.
+        """
+        text = seq.output_text
+        start = len(text) - num_new_chars
+        if not seq.sampling_params.stop:
+            return text[start:], False
+        matcher = get_matcher(tuple(seq.sampling_params.stop))
+        sent = start - matcher.held_back(seq.stop_state)
+        seq.stop_state, match = matcher.feed(seq.stop_state, text, start)
+        if match >= 0:
+            seq.output_text = text[:match]
+            seq.stop_state = 0
+            return seq.output_text[sent:], True
+        return text[sent:len(text) - matcher.held_back(seq.stop_state)], False
+    
+    def _stream(self, seq: Sequence, text: str):
+        # Use run_coroutine_threadsafe to safely put data in the main loop's queue
+        asyncio.run_coroutine_threadsafe(
+            seq.client_stream.put(
+                json.dumps({"token": text, "sequence_id": seq.id})
+            ),
+            seq.loop
+        )
+    
+    def _finish_sequence(self, seq: Sequence):
+        """Hand a sequence the scheduler already finished back to its caller."""
+        self.model_executor.release_sequences([seq.id])
+        self.metrics.record_finished(seq, time.monotonic())
+        profiler.request(seq, 'finished')
+        if seq.client_stream is not None and seq.stop_state:
+            # Text held back for a stop string that never came
+            held_back = get_matcher(tuple(seq.sampling_params.stop)).held_back(seq.stop_state)
+            self._stream(seq, seq.output_text[len(seq.output_text) - held_back:])
+        # The caller owns the sequence from here on
+        self.workload_manager.remove_finished_sequence(seq.id)
+        # A caller that went away may have cancelled the future already
+        if seq.future is not None and not seq.future.done():
+            seq.future.set_result(seq)
+        if seq.client_stream is not None:
+            # Use run_coroutine_threadsafe to safely put None in the main loop's queue
+            asyncio.run_coroutine_threadsafe(
+                seq.client_stream.put(None),
+                seq.loop
+            )
+    
+    def _abort_sequence(self, seq: Sequence):
+        """Release a sequence the scheduler dropped after its caller went away."""
+        self.model_executor.release_sequences([seq.id])
+        profiler.request(seq, 'aborted')
+        if seq.future is not None:
+            seq.future.cancel()
+        if seq.client_stream is not None:
+            asyncio.run_coroutine_threadsafe(seq.client_stream.put(None), seq.loop)
+    
+    def _fail_sequence(self, seq: Sequence, error: Exception):
+        """Hand a sequence dropped after a failed step back to its caller with the error."""
+        self.model_executor.release_sequences([seq.id])
+        profiler.request(seq, 'failed')
+        if seq.future is not None and not seq.future.done():
+            seq.future.set_exception(error)
+        if seq.client_stream is not None:
+            asyncio.run_coroutine_threadsafe(seq.client_stream.put(None), seq.loop)
+    
+    def abort(self, seq_id: str):
+        """Stop generating for a sequence whose client disconnected; safe from any thread."""
+        self.workload_manager.abort_sequence(seq_id)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Scheduler queues, preemptions, aborts, speculative acceptance, prefix cache hits,
+        KV-cache utilization and fragmentation, and per-worker padding efficiency."""
+        return {**self.workload_manager.get_stats(), 'batching': self.model_executor.get_stats()}
+    
+    def render_metrics(self) -> str:
+        """Latency histograms, token counters and load gauges in the Prometheus text format."""
+        return self.metrics.render(self.workload_manager.get_stats())
+    
+    def set_profiling(self, enabled: bool):
+        """Start or stop recording step stages and request lifecycles, here and in every worker."""
+        max_events = self.config.profiler.max_events
+        self.model_executor.set_profiling(enabled, max_events)
+        if enabled:
+            profiler.start(max_events)
+        else:
+            profiler.stop()
+    
+    def get_trace(self) -> Dict[str, Any]:
+        """What the profilers recorded as a Chrome trace, for chrome://tracing or ui.perfetto.dev."""
+        return {
+            'traceEvents': profiler.trace_events("engine") + self.model_executor.trace_events(),
+            'displayTimeUnit': 'ms',
+        }
+    
     def _cleanup(self):
         """Cleanup function to be called when the program exits."""
-        # The thread will be automatically terminated since it's a daemon thread
-        pass
+        # The thread will be automatically terminated since it's a daemon thread;
+        # the workers are not, and would keep the interpreter from exiting
+        self.model_executor.shutdown()
 
-    # process 1 request with only one prompt at a time.
-    def basic_generate(self, prompt: str) -> str:
-
-        sequence = Sequence(str(uuid.uuid4()), prompt, None, None)
-        
-        # Execute the batch
-        results = self.model_executor.execute_batch([sequence])
-        
-        return results[1][0]['generated_text']
+    # process 1 request with only one prompt at a time; it joins the
+    # continuous batch like any other, so it never stalls running sequences
+    def basic_generate(self, prompt: str, sampling_params: Optional[SamplingParams] = None,
+                       limits: Optional[AdmissionLimits] = None,
+                       scheduling_params: Optional[SchedulingParams] = None) -> str:
+        return self.generate([prompt], sampling_params, limits, scheduling_params)[0]
     
-    def _is_batch_finished(self, request_ids: List[str]) -> bool:
-        for id in request_ids:
-            if not self.workload_manager.is_sequence_finished(id):
-                return False
-        return True
+    async def basic_generate_async(self, prompt: str, sampling_params: Optional[SamplingParams] = None,
+                                   limits: Optional[AdmissionLimits] = None,
+                                   scheduling_params: Optional[SchedulingParams] = None) -> str:
+        """Like basic_generate, but awaits the engine thread instead of blocking the event loop.
 
+        Cancelling the awaiting task aborts the request.
+        """
+        return (await self.generate_async([prompt], sampling_params, limits, scheduling_params))[0]
+    
+    def _encode(self, prompt: str) -> List[int]:
+        with profiler.span('tokenize', chars=len(prompt)):
+            return self.tokenizer(prompt, truncation=True, max_length=self.max_prompt_tokens).input_ids
+    
+    def _decode(self, sequence: Sequence) -> str:
+        if sequence.sampling_params.stop:
+            # The output text is cut at the stop string, maybe inside a token
+            return self.tokenizer.decode(sequence.prompt_token_ids, skip_special_tokens=True) + sequence.output_text
+        return self.tokenizer.decode(sequence.get_token_ids(), skip_special_tokens=True)
+    
+    def _submit(self, prompts: List[str], sampling_params: Optional[SamplingParams] = None,
+                limits: Optional[AdmissionLimits] = None,
+                scheduling_params: Optional[SchedulingParams] = None) -> Dict[str, Future]:
+        # Add all requests to workload manager, all or none; the processing loop
+        # batches them with every other running sequence and completes the futures.
+        futures = [Future() for _ in prompts]
+        seq_ids = self.workload_manager.add_requests(
+            [self._encode(prompt) for prompt in prompts], futures, sampling_params, limits, scheduling_params
+        )
+        return dict(zip(seq_ids, futures))
+    
     # process multiple prompts in a request
-    def generate(self, prompts: List[str]) -> List[str]:
-        # Add all requests to workload manager
-        request_ids = []
-        for prompt in prompts:
-            request_id = self.workload_manager.add_request(prompt)
-            request_ids.append(request_id)
-        
-        # Process requests in batches (from LoadManager) until all prompts of the request are finished
-        while not self._is_batch_finished(request_ids):
-            # Get next batch of requests
-            sequences = self.workload_manager.get_next_batch()
-            if not sequences:
-                time.sleep(0.1)
-                continue
-                
-            # Execute the next batch in one go, it may not be the same prompts as the prompts in the request.
-            results = self.model_executor.execute_batch(sequences)
-        
-            # Update results in workload manager
-            for result in results[1]:
-                self.workload_manager.remove_active_sequence(result['request_id'])
-                self.workload_manager.update_sequence_output(result['request_id'], result['generated_text'], is_finished=True)
-
-        # Remove finished sequences from workload manager
-        generated_texts = []
-        for request_id in request_ids:
-            generated_texts.append(self.workload_manager.get_sequence(request_id).output[0])
-            self.workload_manager.remove_finished_sequence(request_id)
+    def generate(self, prompts: List[str], sampling_params: Optional[SamplingParams] = None,
+                 limits: Optional[AdmissionLimits] = None,
+                 scheduling_params: Optional[SchedulingParams] = None) -> List[str]:
+        futures = self._submit(prompts, sampling_params, limits, scheduling_params)
+        return [self._decode(future.result()) for future in futures.values()]
+    
+    async def generate_async(self, prompts: List[str], sampling_params: Optional[SamplingParams] = None,
+                             limits: Optional[AdmissionLimits] = None,
+                             scheduling_params: Optional[SchedulingParams] = None) -> List[str]:
+        """Like generate, but awaits the engine thread instead of blocking the event loop.
 
-        return generated_texts 
+        Cancelling the awaiting task aborts every prompt of the request.
+        """
+        sequences = await self._generate_sequences_async(prompts, sampling_params, limits, scheduling_params)
+        return [self._decode(sequence) for sequence in sequences]
     
-    async def event_generator(self, loop, prompt: str):
-        
+    async def generate_outputs_async(self, prompts: List[str], sampling_params: Optional[SamplingParams] = None,
+                                     limits: Optional[AdmissionLimits] = None,
+                                     scheduling_params: Optional[SchedulingParams] = None) -> List[Dict[str, Any]]:
+        """Like generate_async, but each prompt's `text` comes with its `speculative` decoding stats,
+        None if nothing was proposed for it."""
+        sequences = await self._generate_sequences_async(prompts, sampling_params, limits, scheduling_params)
+        return [{'text': self._decode(sequence), 'speculative': sequence.speculative_stats()} for sequence in sequences]
+    
+    async def _generate_sequences_async(self, prompts: List[str], sampling_params: Optional[SamplingParams] = None,
+                                        limits: Optional[AdmissionLimits] = None,
+                                        scheduling_params: Optional[SchedulingParams] = None) -> List[Sequence]:
+        futures = self._submit(prompts, sampling_params, limits, scheduling_params)
+        try:
+            return await asyncio.gather(*(asyncio.wrap_future(future) for future in futures.values()))
+        except asyncio.CancelledError:
+            for seq_id in futures:
+                self.abort(seq_id)
+            raise
+    
+    async def event_generator(self, loop, prompt: str, sampling_params: Optional[SamplingParams] = None,
+                              limits: Optional[AdmissionLimits] = None,
+                              scheduling_params: Optional[SchedulingParams] = None):
+        events = self.open_stream(loop, prompt, sampling_params, limits, scheduling_params)
+        try:
+            async for event in events:
+                yield event
+        finally:
+            await events.aclose()
+    
+    def open_stream(self, loop, prompt: str, sampling_params: Optional[SamplingParams] = None,
+                    limits: Optional[AdmissionLimits] = None,
+                    scheduling_params: Optional[SchedulingParams] = None) -> AsyncIterator[str]:
+        """Queue a streaming request now, so admission errors come before any response, and return its events."""
         asyncio.set_event_loop(loop)
         # Create a queue for this client's stream
         queue = asyncio.Queue()
         
         # Add streaming request to workload manager with the queue
-        seq_id = self.workload_manager.add_streaming_request(prompt, queue, loop)
+        seq_id = self.workload_manager.add_streaming_request(
+            self._encode(prompt), queue, loop, sampling_params, limits, scheduling_params
+        )
         
         print(f"Created queue for sequence {seq_id} in loop {id(loop)} and queue {id(queue._get_loop())}")  # Debug print
-        
+        return self._stream_events(seq_id, queue)
+    
+    async def _stream_events(self, seq_id: str, queue: asyncio.Queue):
+        finished = False
         try:
             while True:
                 print(f"Waiting for data in queue for sequence {seq_id}")  # Debug print
@@ -139,14 +370,16 @@ class LLMEngine:
                 print(f"Received data in queue for sequence {seq_id}: {data}")  # Debug print
                 if data is None:  # End of stream
                     print(f"End of stream for sequence {seq_id}")  # Debug print
+                    finished = True
                     break
                 yield f"data: {data}\n\n"
         except Exception as e:
             print(f"Error in stream for sequence {seq_id}: {e}")
         finally:
-            # Clean up
-            self.workload_manager.remove_finished_sequence(seq_id)
-            print(f"Cleaned up sequence {seq_id}")  # Debug print
+            # The engine cleans up finished sequences; one whose client went
+            # away mid-stream is aborted so its slot and KV blocks free up
+            if not finished:
+                self.abort(seq_id)
 
     def generate_vllm(self, prompts: List[str]) -> List[str]:
         """
@@ -159,10 +392,10 @@ class LLMEngine:
             List of generated texts
         """
         # Configure sampling parameters
-        sampling_params = SamplingParams(
+        sampling_params = VLLMSamplingParams(
             temperature=0.7,
             top_p=0.95,
-            max_tokens=self.max_tokens
+            max_tokens=SamplingParams().max_tokens
         )
         
         # Generate text for all prompts
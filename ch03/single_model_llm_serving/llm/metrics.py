@@ -0,0 +1,204 @@
+import bisect
+import os
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from .workload_manager import Sequence
+
+# Seconds; TTFT and end-to-end buckets reach the tens of seconds a CPU
+# replica under overload takes, TPOT and ITL ones the seconds per step
+TTFT_BUCKETS = (0.005, 0.01, 0.02, 0.04, 0.06, 0.08, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0, 20.0, 40.0, 80.0)
+TOKEN_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.4, 0.5, 0.75, 1.0, 2.5, 5.0, 10.0)
+REQUEST_LATENCY_BUCKETS = (0.1, 0.3, 0.5, 0.8, 1.0, 1.5, 2.0, 2.5, 5.0, 10.0, 15.0, 20.0, 30.0, 60.0, 120.0, 240.0, 480.0)
+# Output tokens per step that gave a speculating request tokens, from 1
+# with every proposal rejected to 1 + num_speculative_tokens
+TOKENS_PER_STEP_BUCKETS = (1.0, 1.25, 1.5, 1.75, 2.0, 2.5, 3.0, 3.5, 4.0, 5.0, 6.0, 8.0)
+
+class Counter:
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter",
+                f"{self.name} {_format(self.value)}"]
+
+class Gauge:
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge",
+                f"{self.name} {_format(self.value)}"]
+
+class Histogram:
+    """Observations counted into fixed buckets, without any lock.
+
+    Only the engine thread observes; a scrape from another thread may see
+    a step half recorded, which the next scrape makes up for. Counts are
+    kept per bucket and made cumulative when rendered, so `_count` always
+    equals the `+Inf` bucket.
+    """
+    def __init__(self, name: str, documentation: str, buckets: Iterable[float]):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        # One more count for observations past the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{_format(bound)}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {_format(total)}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+class EngineMetrics:
+    """Request latencies and engine load in the Prometheus text format.
+
+    The engine loop records each step with a few additions and one bucket
+    search per sequence that produced tokens: TTFT, inter-token latency,
+    and when a request finishes its end-to-end latency, time per output
+    token after the first, the time it waited before its first step and,
+    if it speculated, its output tokens per step. Queue lengths, KV-cache usage, preemptions and aborts are not recorded
+    at all; `render` reads them from the scheduler's stats when scraped.
+    """
+    def __init__(self, max_num_seqs: int, max_num_batched_tokens: int):
+        self.max_num_seqs = max_num_seqs
+        self.max_num_batched_tokens = max_num_batched_tokens
+        self.ttft = Histogram("llm_time_to_first_token_seconds",
+                              "Seconds from arrival to the first output token.", TTFT_BUCKETS)
+        self.inter_token_latency = Histogram("llm_inter_token_latency_seconds",
+                                             "Seconds between consecutive engine steps that gave a sequence tokens.",
+                                             TOKEN_LATENCY_BUCKETS)
+        self.tpot = Histogram("llm_time_per_output_token_seconds",
+                              "Mean seconds per output token after the first, per finished request.",
+                              TOKEN_LATENCY_BUCKETS)
+        self.e2e_latency = Histogram("llm_e2e_request_latency_seconds",
+                                     "Seconds from arrival to the last output token, per finished request.",
+                                     REQUEST_LATENCY_BUCKETS)
+        self.queue_time = Histogram("llm_request_queue_time_seconds",
+                                    "Seconds from arrival to the request's first engine step.",
+                                    REQUEST_LATENCY_BUCKETS)
+        self.tokens_per_step = Histogram("llm_request_tokens_per_step",
+                                         "Mean output tokens per step, per finished request that speculated.",
+                                         TOKENS_PER_STEP_BUCKETS)
+        self.prompt_tokens = Counter("llm_prompt_tokens_total",
+                                     "Prompt tokens prefilled, recomputed ones after preemption included.")
+        self.generation_tokens = Counter("llm_generation_tokens_total", "Output tokens generated.")
+        self.finished_requests = Counter("llm_request_success_total", "Requests that finished generating.")
+        self.num_steps = Counter("llm_engine_steps_total", "Engine steps that ran a forward.")
+        self.batch_size = Gauge("llm_num_batched_sequences", "Sequences in the last engine step.")
+        self.batch_occupancy = Gauge("llm_batch_occupancy_ratio",
+                                     "Sequences in the last engine step over max_num_seqs.")
+        self.batched_tokens = Gauge("llm_num_batched_tokens", "Prefill and decode tokens in the last engine step.")
+        self.token_budget_usage = Gauge("llm_batch_token_budget_usage_ratio",
+                                        "Tokens in the last engine step over max_num_batched_tokens.")
+
+    def record_step(self, sequences: List[Sequence], num_prefill_tokens: int, num_decode_tokens: int, now: float):
+        """Count a scheduled step; its sequences' first step ends their queue time."""
+        self.num_steps.inc()
+        self.prompt_tokens.inc(num_prefill_tokens)
+        self.batch_size.set(len(sequences))
+        self.batch_occupancy.set(len(sequences) / self.max_num_seqs)
+        self.batched_tokens.set(num_prefill_tokens + num_decode_tokens)
+        self.token_budget_usage.set((num_prefill_tokens + num_decode_tokens) / self.max_num_batched_tokens)
+        for sequence in sequences:
+            if sequence.first_scheduled_time is None:
+                self.record_scheduled(sequence, now)
+
+    def record_scheduled(self, sequence: Sequence, now: float):
+        sequence.first_scheduled_time = now
+        self.queue_time.observe(now - sequence.arrival_time)
+
+    def record_tokens(self, sequence: Sequence, num_tokens: int, now: float):
+        """Time the tokens a step gave sequence, before they are appended to its output."""
+        self.generation_tokens.inc(num_tokens)
+        if sequence.first_token_time is None:
+            sequence.first_token_time = now
+            self.ttft.observe(now - sequence.arrival_time)
+        else:
+            self.inter_token_latency.observe(now - sequence.last_token_time)
+        sequence.last_token_time = now
+
+    def record_finished(self, sequence: Sequence, now: float):
+        self.finished_requests.inc()
+        self.e2e_latency.observe(now - sequence.arrival_time)
+        # Not for outputs that came in a single step
+        if sequence.first_token_time is not None and sequence.last_token_time > sequence.first_token_time:
+            self.tpot.observe((sequence.last_token_time - sequence.first_token_time) / (sequence.token_count - 1))
+        speculative_stats = sequence.speculative_stats()
+        if speculative_stats is not None:
+            self.tokens_per_step.observe(speculative_stats['tokens_per_step'])
+
+    def render(self, stats: Dict[str, Any]) -> str:
+        """All metrics in the text exposition format, with `stats` from WorkloadManager.get_stats()."""
+        lines = []
+        for metric in (self.ttft, self.inter_token_latency, self.tpot, self.e2e_latency, self.queue_time,
+                       self.tokens_per_step, self.prompt_tokens, self.generation_tokens, self.finished_requests, self.num_steps,
+                       self.batch_size, self.batch_occupancy, self.batched_tokens, self.token_budget_usage):
+            lines.extend(metric.render())
+        for name, key, documentation in (
+            ("llm_num_requests_running", 'num_running', "Sequences holding KV cache between steps."),
+            ("llm_num_requests_waiting", 'num_waiting', "Sequences waiting for their first step or preempted by recompute."),
+            ("llm_num_requests_swapped", 'num_swapped', "Sequences preempted with their KV blocks swapped out."),
+            ("llm_queued_prompt_tokens", 'queued_prompt_tokens', "Prompt tokens of waiting sequences."),
+            ("llm_pending_decode_tokens", 'pending_decode_tokens', "Output tokens unfinished sequences may still generate."),
+        ):
+            lines.extend(_sample(name, "gauge", documentation, [((), stats[key])]))
+        for name, key, documentation in (
+            ("llm_num_preemptions_total", 'num_preemptions', "Sequences preempted for lack of KV blocks."),
+            ("llm_num_aborted_requests_total", 'num_aborted', "Requests whose client went away before they finished."),
+            ("llm_num_rejected_requests_total", 'num_rejected', "Requests turned away by admission control."),
+            ("llm_spec_decode_proposed_tokens_total", 'spec_proposed_tokens', "Speculative tokens proposed for verification."),
+            ("llm_spec_decode_accepted_tokens_total", 'spec_accepted_tokens',
+             "Speculative tokens verified, accepted and kept in the output."),
+        ):
+            lines.extend(_sample(name, "counter", documentation, [((), stats[key])]))
+        kv_cache = [(('replica', str(replica)), kv) for replica, kv in enumerate(stats['kv_cache'])]
+        lines.extend(_sample("llm_kv_cache_usage_ratio", "gauge", "Share of a worker's KV-cache blocks in use.",
+                             [(label, kv['utilization']) for label, kv in kv_cache]))
+        lines.extend(_sample("llm_kv_cache_swap_usage_ratio", "gauge", "Share of a worker's swap blocks in use.",
+                             [(label, kv['used_swap_blocks'] / kv['num_swap_blocks'] if kv['num_swap_blocks'] else 0.0)
+                              for label, kv in kv_cache]))
+        resident_bytes = _resident_memory_bytes()
+        if resident_bytes is not None:
+            lines.extend(_sample("process_resident_memory_bytes", "gauge",
+                                 "Resident memory of the engine process, workers not included.", [((), resident_bytes)]))
+        return "\n".join(lines) + "\n"
+
+
+def _sample(name: str, kind: str, documentation: str, values: List[Tuple[Tuple[str, ...], float]]) -> List[str]:
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}"]
+    for label, value in values:
+        labels = f'{{{label[0]}="{label[1]}"}}' if label else ""
+        lines.append(f"{name}{labels} {_format(value)}")
+    return lines
+
+def _format(value: float) -> str:
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _resident_memory_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
@@ -1,8 +1,16 @@
 import multiprocessing as mp
-from typing import List, Dict, Any
+from multiprocessing.connection import wait
+from typing import List, Dict, Any, Optional, Tuple
+from .cpu_topology import discover_cores, pin_process, plan_placement
+from .config import CacheConfig, CompileConfig, ExecutorConfig, ModelCacheConfig, PrecisionConfig, SchedulerConfig, SpeculativeConfig
 from .model_worker import ModelWorker
+from .profiler import profiler
+from .shm_transport import ShmChannel
 import logging
+import os
 import sys
+import threading
+import time
 
 # Set up logging with stream handler
 logger = logging.getLogger(__name__)
@@ -13,60 +21,272 @@ formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(messag
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
+class WorkerReplica:
+    """One ModelWorker process and the shared-memory channel that feeds it."""
+    def __init__(self, index: int, channel: ShmChannel):
+        self.index = index
+        self.channel = channel
+        self.process = None
+        # Sequences whose KV cache lives on this replica
+        self.num_sequences = 0
+        # KV-cache blocks the worker allocated, reported once it is ready
+        self.num_blocks = 0
+        self.num_swap_blocks = 0
+        # Sequence handles, recycled so the worker's per-handle sampling state stays small
+        self.free_handles: List[int] = []
+        self.next_handle = 0
+        # What the worker last reported with a step, or when it became ready
+        self.stats: Dict[str, Any] = {}
+    
+    def acquire_handle(self) -> int:
+        if self.free_handles:
+            return self.free_handles.pop()
+        self.next_handle += 1
+        return self.next_handle - 1
+
 class ModelExecutor:
-    def __init__(self):
-        self.task_queue = mp.Queue()
-        self.result_queue = mp.Queue()
-        self.worker_process = None
-        logger.debug("ModelExecutor initialized with queues")
+    """Data-parallel pool of ModelWorker replicas.
+
+    A sequence is pinned to the replica that holds its KV blocks: the one
+    the scheduler placed it on, or the least-loaded replica when the prompt
+    does not name one. Each step splits the batch by replica, sends every
+    sub-batch before waiting on any, and gathers the sampled tokens by
+    request id in whatever order the replicas finish.
+    """
+    def __init__(self, config: Optional[ExecutorConfig] = None, scheduler_config: Optional[SchedulerConfig] = None,
+                 cache_config: Optional[CacheConfig] = None, speculative_config: Optional[SpeculativeConfig] = None,
+                 precision_config: Optional[PrecisionConfig] = None, model_cache_config: Optional[ModelCacheConfig] = None,
+                 compile_config: Optional[CompileConfig] = None):
+        self.config = config or ExecutorConfig()
+        self.scheduler_config = scheduler_config or SchedulerConfig()
+        self.speculative_config = speculative_config or SpeculativeConfig()
+        self.precision_config = precision_config or PrecisionConfig()
+        self.model_cache_config = model_cache_config or ModelCacheConfig()
+        self.compile_config = compile_config or CompileConfig()
+        cache_config = cache_config or CacheConfig()
+        # memory_fraction is a budget for the whole pool
+        self.cache_config = cache_config.model_copy(update={
+            'memory_fraction': cache_config.memory_fraction / self.config.num_workers
+        })
+        # Sized for [n, handles, context_lens, lengths, num_blocks, tokens]
+        # until the workers report their block counts. A step returns at most
+        # one token per sequence plus one per speculative token it verified.
+        self.replicas = [
+            WorkerReplica(index, ShmChannel(
+                request_capacity=self._request_capacity(0),
+                response_capacity=2 * (2 * self.scheduler_config.max_num_seqs + self.scheduler_config.max_num_batched_tokens)
+            ))
+            for index in range(self.config.num_workers)
+        ]
+        # Sequences are named by small integer handles, unique per replica,
+        # on the shared-memory path
+        self.handles: Dict[str, int] = {}
+        self.assignments: Dict[str, WorkerReplica] = {}
+        # The engine loop and API handlers share the replica channels
+        self.lock = threading.Lock()
+        logger.debug(f"ModelExecutor initialized with {len(self.replicas)} shared-memory channels")
     
-    def setup_worker(self, model_name: str):
-        logger.debug(f"Setting up worker with model: {model_name}")
-        self.worker_process = mp.Process(
-            target=ModelWorker.run,
-            args=(model_name, self.task_queue, self.result_queue)
-        )
-        logger.debug("Starting worker process")
-        self.worker_process.start()
-        logger.debug("Worker process started")
+    def _request_capacity(self, num_blocks: int, max_model_len: Optional[int] = None) -> int:
+        # Sequences sharing a prefix name the same blocks, so a step's block
+        # tables may name many more blocks than the replica has; each table
+        # still holds at most the blocks of max_model_len tokens, or all of
+        # the replica's. Twice the largest step leaves room to wrap around
+        # the ring without splitting a step.
+        max_num_seqs = self.scheduler_config.max_num_seqs
+        max_table_len = num_blocks
+        if max_model_len is not None:
+            max_table_len = min(num_blocks, -(-max_model_len // self.cache_config.block_size))
+        return 2 * (1 + 6 * max_num_seqs + self.scheduler_config.max_num_batched_tokens + max_num_seqs * max_table_len)
     
-    def execute_batch(self, prompts: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        if not prompts:
-            logger.debug("Empty batch received")
-            return []
-        
-        logger.debug(f"Sending batch to worker: {prompts}")
-        # Send batch to worker
-        self.task_queue.put((prompts, False))
+    def setup_workers(self, model_name: str, max_model_len: Optional[int] = None):
+        """Start the workers and wait until each has allocated its KV cache and compiled its forwards.
+
+        `max_model_len` bounds the block table of a sequence, and so the
+        request rings; without it they are sized for tables of the whole pool.
+        """
+        placement = None
+        if self.config.pin_cpus and not hasattr(os, 'sched_setaffinity'):
+            logger.warning("CPU pinning needs sched_setaffinity, which this platform lacks")
+        elif self.config.pin_cpus:
+            placement = plan_placement(discover_cores(), len(self.replicas), self.config.reserved_cores)
+            if placement is None:
+                logger.warning(f"Fewer physical cores than {len(self.replicas)} workers; not pinning them")
+        start = time.perf_counter()
+        for replica in self.replicas:
+            cpus = placement.worker_cpus[replica.index] if placement else None
+            num_threads = self.config.threads_per_worker or (
+                placement.worker_threads[replica.index] if placement
+                else max(1, (os.cpu_count() or 1) // len(self.replicas))
+            )
+            logger.debug(f"Starting worker {replica.index} with model: {model_name}, {num_threads} threads"
+                         + (f" on CPUs {cpus}" if cpus else ""))
+            replica.process = mp.Process(
+                target=ModelWorker.run,
+                args=(model_name, replica.channel, num_threads, self.cache_config, self.config.max_padding_fraction,
+                      self.speculative_config, self.precision_config, self.model_cache_config,
+                      self.compile_config, cpus, self.config.interop_threads_per_worker)
+            )
+            replica.process.start()
+        if placement and placement.api_cpus:
+            # Workers pinned themselves; threads this process starts later,
+            # the engine loop and the API server's, inherit the rest
+            pin_process(placement.api_cpus)
+            logger.debug(f"Engine and API threads on CPUs {placement.api_cpus}")
         
-        # Get results
-        logger.debug("Waiting for results from worker")
-        results = self.result_queue.get()
-        logger.debug(f"Received results from worker: {results}")
-        return results
+        for replica in self.replicas:
+            while not replica.channel.executor_conn.poll(1.0):
+                if not replica.process.is_alive():
+                    raise RuntimeError(f"Worker {replica.index} exited during startup")
+            _, replica.num_blocks, replica.num_swap_blocks, replica.stats = replica.channel.recv()
+            replica.channel.resize_requests(self._request_capacity(replica.num_blocks, max_model_len))
+            logger.debug(f"Worker {replica.index} ready with {replica.num_blocks} KV blocks, {replica.num_swap_blocks} swap blocks")
+        # Process start and imports included; the workers' stats break down the rest
+        logger.debug(f"Worker processes started in {time.perf_counter() - start:.2f}s")
+    
+    def _least_loaded(self) -> WorkerReplica:
+        return min(self.replicas, key=lambda replica: replica.num_sequences)
+    
+    def _assign(self, request_id: str, index: Optional[int] = None) -> Tuple[WorkerReplica, bool]:
+        """The replica of a sequence and whether the sequence is new to it."""
+        replica = self.assignments.get(request_id)
+        if replica is not None and (index is None or replica.index == index):
+            return replica, False
+        if replica is not None:
+            # A sequence preempted by recompute may be placed elsewhere
+            replica.num_sequences -= 1
+            replica.free_handles.append(self.handles[request_id])
+        replica = self.replicas[index] if index is not None else self._least_loaded()
+        self.assignments[request_id] = replica
+        self.handles[request_id] = replica.acquire_handle()
+        replica.num_sequences += 1
+        return replica, True
     
     def execute_forward_batch(self, prompts: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         if not prompts:
             logger.debug("Empty batch received")
             return []
         
-        logger.debug(f"Sending streaming batch to worker: {prompts}")
-        # Send batch to worker with streaming flag
-        self.task_queue.put((prompts, True))
-        
-        # Get streaming results
-        logger.debug("Waiting for streaming results from worker")
-        result_type, results = self.result_queue.get()
-        logger.debug(f"Received streaming results from worker: {results}")
+        with self.lock:
+            with profiler.span('send', rows=len(prompts)):
+                sub_batches: Dict[WorkerReplica, List[Dict[str, Any]]] = {}
+                added: Dict[WorkerReplica, List[Tuple[int, Any, List[int], int]]] = {}
+                for p in prompts:
+                    replica, is_new = self._assign(p['request_id'], p.get('replica'))
+                    sub_batches.setdefault(replica, []).append(p)
+                    # Admissions carry the whole sequence so penalties see its history,
+                    # also when it comes back after a preemption
+                    if is_new or 'all_token_ids' in p:
+                        token_ids = p.get('all_token_ids', p['token_ids'])
+                        added.setdefault(replica, []).append((
+                            self.handles[p['request_id']],
+                            p.get('sampling_params'),
+                            token_ids,
+                            p.get('num_prompt_tokens', len(token_ids))
+                        ))
+                
+                # Sampling settings go ahead of the step on the same pipe
+                for replica, sequences in added.items():
+                    replica.channel.send(('add', sequences))
+                
+                # Token ids go through shared memory, only (offset, length) through the pipe
+                pending = {}
+                error = None
+                for replica, sub_batch in sub_batches.items():
+                    try:
+                        replica.channel.send_batch(
+                            [self.handles[p['request_id']] for p in sub_batch],
+                            [p.get('context_len', 0) for p in sub_batch],
+                            # n-gram proposals follow the new tokens, the draft model makes its own
+                            [p['token_ids'] + p.get('proposal_token_ids', []) for p in sub_batch],
+                            [p.get('block_table', ()) for p in sub_batch],
+                            [p.get('do_sample', True) for p in sub_batch],
+                            [p.get('num_speculative_tokens', 0) for p in sub_batch]
+                        )
+                    except ValueError as e:
+                        # Larger than the ring; replicas sent to already still answer
+                        error = e
+                        break
+                    pending[replica.channel.executor_conn] = (replica, sub_batch)
+            
+            with profiler.span('wait', replicas=len(pending)):
+                # Gather in completion order; tokens are correlated by request id.
+                # A prefill chunk short of the prompt's end samples nothing, a
+                # speculating sequence its accepted proposals and one more token.
+                # Every reply is read even after a failure, so none is left over
+                # for the next step to take as its own.
+                tokens = {}
+                while pending:
+                    for conn in wait(list(pending)):
+                        replica, sub_batch = pending.pop(conn)
+                        try:
+                            token_id_lists, replica.stats = replica.channel.recv_tokens(len(sub_batch))
+                        except RuntimeError as e:
+                            error = e
+                            continue
+                        for p, token_ids in zip(sub_batch, token_id_lists):
+                            tokens[p['request_id']] = token_ids
+            if error is not None:
+                raise error
+        logger.debug(f"Received {len(tokens)} streaming results from {len(sub_batches)} workers")
         
-        if result_type == 'stream':
-            return results
-        else:
-            raise Exception("Unexpected result type from worker")
+        return [{'request_id': p['request_id'], 'token_ids': tokens[p['request_id']]} for p in prompts]
+    
+    def swap_blocks(self, blocks_to_swap_out: Dict[int, List[Tuple[int, int]]],
+                    blocks_to_swap_in: Dict[int, List[Tuple[int, int]]]):
+        """Ask workers to move KV blocks of preempted or resumed sequences before the next step."""
+        with self.lock:
+            for index, mapping in blocks_to_swap_out.items():
+                self.replicas[index].channel.send(('swap_out', mapping))
+            for index, mapping in blocks_to_swap_in.items():
+                self.replicas[index].channel.send(('swap_in', mapping))
+    
+    def get_stats(self) -> List[Dict[str, Any]]:
+        """Forwards run, padding efficiency, startup phases and step latencies of each replica.
+
+        Workers send them with every step, so this never waits on one.
+        """
+        return [replica.stats for replica in self.replicas]
+    
+    def set_profiling(self, enabled: bool, max_events: Optional[int] = None):
+        """Start or stop the step profiler of every worker; starting drops what it recorded before."""
+        with self.lock:
+            for replica in self.replicas:
+                replica.channel.send(('profile', enabled, max_events))
+    
+    def trace_events(self) -> List[Dict[str, Any]]:
+        """The events every worker's profiler recorded, in the Chrome trace event format."""
+        with self.lock:
+            events = []
+            for replica in self.replicas:
+                replica.channel.send(('trace', f"worker {replica.index}"))
+                events.extend(replica.channel.recv()[1])
+            return events
+    
+    def release_sequences(self, request_ids: List[str]):
+        """Forget finished sequences; the scheduler already returned their KV blocks."""
+        with self.lock:
+            for request_id in request_ids:
+                replica = self.assignments.pop(request_id, None)
+                if replica is None:
+                    continue
+                replica.num_sequences -= 1
+                replica.free_handles.append(self.handles.pop(request_id))
+    
+    def shutdown(self):
+        """Ask every worker to exit and release the shared memory."""
+        for replica in self.replicas:
+            if replica.process is None:
+                continue
+            if replica.process.is_alive():
+                logger.debug(f"Stopping worker process {replica.index}")
+                replica.channel.send(None)
+                replica.process.join(timeout=5)
+            if replica.process.is_alive():
+                replica.process.terminate()
+                replica.process.join()
+            replica.process = None
+            replica.channel.close(unlink=True)
+        logger.debug("Worker processes terminated")
     
     def __del__(self):
-        if self.worker_process:
-            logger.debug("Terminating worker process")
-            self.worker_process.terminate()
-            self.worker_process.join()
-            logger.debug("Worker process terminated") 
\ No newline at end of file
+        self.shutdown()
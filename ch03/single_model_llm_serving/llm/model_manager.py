@@ -1,16 +1,184 @@
+import fcntl
+import glob
+import json
+import mmap
 import os
-from transformers import AutoTokenizer, AutoModelForCausalLM
+import shutil
+import struct
+import tempfile
+import time
+from typing import Dict, Optional
+import torch
+from transformers import AutoConfig, AutoTokenizer, AutoModelForCausalLM, GenerationConfig
 
 class ModelManager:
-    def __init__(self):
-        self.model_dir = "model_cache"
+    """Loads models, from a local snapshot of their weights when it has one.
+
+    The first load of a model saves its config, tokenizer and weights as
+    safetensors under the cache directory; later loads memory-map the
+    weights in place instead of reading them into process memory, so the
+    worker processes on one host share the same page-cache pages and start
+    without going through from_pretrained. A cache directory of None always
+    loads from the hub. timings holds the seconds each phase of the last
+    load took.
+    """
+    def __init__(self, cache_dir: Optional[str] = "model_cache"):
+        self.model_dir = cache_dir
+        self.timings: Dict[str, float] = {}
     
-    def load_model(self, model_name: str = "facebook/opt-125m") -> tuple[AutoModelForCausalLM, AutoTokenizer]:
-        # Create model directory if it doesn't exist
-        os.makedirs(self.model_dir, exist_ok=True)
+    def load_model(self, model_name: str = "facebook/opt-125m",
+                   precision: str = "fp32") -> tuple[AutoModelForCausalLM, AutoTokenizer]:
+        """Load a model in fp32, bf16 or with int8 linear layers, and its tokenizer.
+
+        int8 quantizes the weights of the linear layers and, at run time,
+        their inputs, dynamically per batch; it runs on CPU only. The output
+        projection stays in full precision: it usually shares its weights
+        with the embeddings, and the logits are what sampling sees.
+        """
+        if precision not in ("fp32", "bf16", "int8"):
+            raise ValueError(f"Unknown precision {precision!r}")
+        self.timings = {}
+        torch_dtype = torch.bfloat16 if precision == "bf16" else torch.float32
+        
+        # int8 is quantized from the fp32 snapshot at every load
+        source = model_name if self.model_dir is None else self._snapshot(model_name, torch_dtype)
+        # Importing the model's code in a fresh process can take longer than
+        # its weights; building it without storage costs next to nothing else
+        start = time.perf_counter()
+        with torch.device("meta"):
+            AutoModelForCausalLM.from_config(AutoConfig.from_pretrained(source))
+        self.timings['import'] = time.perf_counter() - start
         
         # Load model and tokenizer
-        model = AutoModelForCausalLM.from_pretrained(model_name)
-        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        start = time.perf_counter()
+        if self.model_dir is None:
+            model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch_dtype)
+            self.timings['from_pretrained'] = time.perf_counter() - start
+        else:
+            model = load_snapshot(source, torch_dtype)
+            self.timings['map_weights'] = time.perf_counter() - start
+        if precision == "int8":
+            start = time.perf_counter()
+            model = quantize_int8(model)
+            self.timings['quantize'] = time.perf_counter() - start
+        start = time.perf_counter()
+        tokenizer = AutoTokenizer.from_pretrained(source)
+        self.timings['tokenizer'] = time.perf_counter() - start
+        
+        return model, tokenizer
+    
+    def load_tokenizer(self, model_name: str = "facebook/opt-125m") -> AutoTokenizer:
+        # The engine process only needs the tokenizer to turn text into ids and back
+        return AutoTokenizer.from_pretrained(self._local_source(model_name))
+    
+    def load_config(self, model_name: str = "facebook/opt-125m") -> AutoConfig:
+        # Model limits such as the context length, without loading weights
+        return AutoConfig.from_pretrained(self._local_source(model_name))
+    
+    def snapshot_dir(self, model_name: str, torch_dtype: torch.dtype = torch.float32) -> str:
+        dtype_name = str(torch_dtype).removeprefix("torch.")
+        return os.path.join(self.model_dir, f"{model_name.replace('/', '--')}--{dtype_name}")
+    
+    def _local_source(self, model_name: str) -> str:
+        """A snapshot of the model for its config and tokenizer, the hub name when it has none."""
+        if self.model_dir is not None:
+            for torch_dtype in (torch.float32, torch.bfloat16):
+                if os.path.isdir(self.snapshot_dir(model_name, torch_dtype)):
+                    return self.snapshot_dir(model_name, torch_dtype)
+        return model_name
+    
+    def _snapshot(self, model_name: str, torch_dtype: torch.dtype) -> str:
+        """Directory of the model's snapshot in torch_dtype, saved on first use.
+
+        The first snapshot in another dtype is converted from the fp32 one
+        when that is on disk, and only downloaded from the hub otherwise.
+        """
+        path = self.snapshot_dir(model_name, torch_dtype)
+        if os.path.isdir(path):
+            return path
         
-        return model, tokenizer
\ No newline at end of file
+        # Replicas starting together take turns: the first saves the
+        # snapshot, the others wait for it instead of downloading too
+        os.makedirs(self.model_dir, exist_ok=True)
+        start = time.perf_counter()
+        with open(path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.isdir(path):
+                source = self.snapshot_dir(model_name)
+                if not os.path.isdir(source):
+                    source = model_name
+                model = AutoModelForCausalLM.from_pretrained(source, torch_dtype=torch_dtype)
+                tokenizer = AutoTokenizer.from_pretrained(source)
+                # Readers only ever see a complete snapshot
+                staging = tempfile.mkdtemp(dir=self.model_dir)
+                try:
+                    model.save_pretrained(staging, safe_serialization=True)
+                    tokenizer.save_pretrained(staging)
+                    os.rename(staging, path)
+                except BaseException:
+                    shutil.rmtree(staging, ignore_errors=True)
+                    raise
+                del model
+        self.timings['snapshot'] = time.perf_counter() - start
+        return path
+
+
+_SAFETENSORS_DTYPES = {
+    'F64': torch.float64, 'F32': torch.float32, 'F16': torch.float16, 'BF16': torch.bfloat16,
+    'I64': torch.int64, 'I32': torch.int32, 'I16': torch.int16, 'I8': torch.int8,
+    'U8': torch.uint8, 'BOOL': torch.bool,
+}
+
+def map_safetensors(path: str) -> Dict[str, torch.Tensor]:
+    """Tensors of a safetensors file as views of a private memory map of it.
+
+    Nothing is read until a tensor is touched, and pages stay shared with
+    every other process mapping the file as long as nobody writes to them.
+    safetensors' own loader copies each tensor out of its map.
+    """
+    with open(path, 'rb') as f:
+        header_len, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_len))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    tensors = {}
+    for name, entry in header.items():
+        if name == '__metadata__':
+            continue
+        dtype = _SAFETENSORS_DTYPES[entry['dtype']]
+        begin, end = entry['data_offsets']
+        if begin == end:
+            tensors[name] = torch.empty(entry['shape'], dtype=dtype)
+            continue
+        tensors[name] = torch.frombuffer(
+            buffer, dtype=dtype, count=(end - begin) // dtype.itemsize, offset=8 + header_len + begin
+        ).view(entry['shape'])
+    return tensors
+
+def load_snapshot(path: str, torch_dtype: torch.dtype = torch.float32) -> AutoModelForCausalLM:
+    """Build a model from a snapshot directory around its memory-mapped weights."""
+    config = AutoConfig.from_pretrained(path)
+    # Parameters start out without storage and take the mapped tensors as they are
+    with torch.device("meta"):
+        model = AutoModelForCausalLM.from_config(config, torch_dtype=torch_dtype)
+    state_dict = {}
+    for file in sorted(glob.glob(os.path.join(path, "*.safetensors"))):
+        state_dict.update(map_safetensors(file))
+    model.load_state_dict(state_dict, strict=False, assign=True)
+    # Tied output embeddings are saved once, under the input embeddings
+    model.tie_weights()
+    if any(t.is_meta for t in [*model.parameters(), *model.buffers()]):
+        # Weights missing from the snapshot or buffers computed at construction
+        return AutoModelForCausalLM.from_pretrained(path, torch_dtype=torch_dtype)
+    if os.path.exists(os.path.join(path, "generation_config.json")):
+        model.generation_config = GenerationConfig.from_pretrained(path)
+    return model.eval()
+
+def quantize_int8(model: AutoModelForCausalLM) -> AutoModelForCausalLM:
+    """Dynamic int8 quantization of every linear layer but the output projection."""
+    output_embeddings = model.get_output_embeddings()
+    linear_layers = {
+        name for name, module in model.named_modules()
+        if isinstance(module, torch.nn.Linear) and module is not output_embeddings
+    }
+    # In place, so the layers it leaves alone keep their memory-mapped weights
+    return torch.ao.quantization.quantize_dynamic(model, linear_layers, dtype=torch.qint8, inplace=True)
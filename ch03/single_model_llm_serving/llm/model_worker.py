@@ -1,7 +1,16 @@
-import multiprocessing as mp
-from typing import List, Dict, Any, Generator
+from typing import List, Dict, Any, Optional, Sequence, Tuple
+from .compiled_forward import CompiledSteps
+from .config import CacheConfig, CompileConfig, ModelCacheConfig, PrecisionConfig, SpeculativeConfig
 from .model_manager import ModelManager
+from .profiler import profiler
+from .sampler import Sampler, sample
+from .sampling_params import SamplingParams
+from .shm_transport import ShmChannel
+from .spec_decode import rejection_sample
+import os
+import time
 import torch
+import torch.nn.functional as F
 import logging
 import sys
 
@@ -15,126 +24,522 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 
 class ModelWorker:
-    def __init__(self, model_name: str):
+    def __init__(self, model_name: str, cache_config: Optional[CacheConfig] = None, max_padding_fraction: float = 0.25,
+                 speculative_config: Optional[SpeculativeConfig] = None, precision_config: Optional[PrecisionConfig] = None,
+                 model_cache_config: Optional[ModelCacheConfig] = None, compile_config: Optional[CompileConfig] = None):
+        # Seconds each startup phase took, reported with the stats
+        self.startup_timings: Dict[str, float] = {}
+        start = time.perf_counter()
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        logger.debug(f"Loading model {model_name} on device {self.device}")
-        self.model, self.tokenizer = ModelManager().load_model(model_name)
-        # Initialize state for streaming
-        self.stream_states = {}  # request_id -> (input_ids, attention_mask, past_key_values)
-    
-    def generate(self, prompts: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        logger.debug(f"Received prompts: {prompts}")
-        
-        # Extract prompts and request IDs
-        prompt_texts = [p.prompt for p in prompts]
-        request_ids = [p.id for p in prompts]
+        precision_config = precision_config or PrecisionConfig()
+        model_manager = ModelManager((model_cache_config or ModelCacheConfig()).path)
+        logger.debug(f"Loading model {model_name} in {precision_config.precision_for(model_name)} on device {self.device}")
+        self.model, self.tokenizer = model_manager.load_model(model_name, precision_config.precision_for(model_name))
+        self.startup_timings.update(model_manager.timings)
+        self.pad_token_id = self.tokenizer.pad_token_id
+        if self.pad_token_id is None:
+            self.pad_token_id = self.tokenizer.eos_token_id
         
-        # Tokenize all prompts in batch
-        inputs = self.tokenizer(
-            prompt_texts,
-            return_tensors="pt",
-            padding=True,
-            truncation=True,
-            max_length=512
-        ).to(self.device)
+        # A draft model proposes tokens for speculative decoding; n-gram
+        # proposals come from the scheduler instead
+        self.speculative_config = speculative_config or SpeculativeConfig()
+        self.draft_model = None
+        if self.speculative_config.method == "draft":
+            logger.debug(f"Loading draft model {self.speculative_config.draft_model}")
+            draft_model = self.speculative_config.draft_model
+            self.draft_model, _ = model_manager.load_model(draft_model, precision_config.precision_for(draft_model))
+            self.startup_timings.update({f'draft_{phase}': seconds for phase, seconds in model_manager.timings.items()})
         
-        logger.debug(f"Batch input shape: {inputs.input_ids.shape}")
+        # Paged KV cache: one preallocated pool of fixed-size blocks sized
+        # from the memory budget; the scheduler owns the block tables. The
+        # draft model has a pool of its own under the same block tables. KV
+        # is kept in each model's activation dtype, fp32 for int8 weights.
+        self.cache_config = cache_config or CacheConfig()
+        self.block_size = self.cache_config.block_size
+        model_config = self.model.config
+        self.num_layers, self.num_kv_heads, self.head_dim = _kv_dims(self.model)
+        self.dtype = _kv_dtype(self.model)
+        self.num_blocks, self.num_swap_blocks = self._profile_num_blocks()
+        kv_start = time.perf_counter()
+        self.kv_cache = self._allocate_kv_cache(self.num_blocks, self.device)
+        self.swap_cache = self._allocate_kv_cache(self.num_swap_blocks, "cpu")
+        if self.draft_model is not None:
+            self.draft_kv_cache = self._allocate_kv_cache(self.num_blocks, self.device, self.draft_model)
+            self.draft_swap_cache = self._allocate_kv_cache(self.num_swap_blocks, "cpu", self.draft_model)
+        self.startup_timings['kv_cache'] = time.perf_counter() - kv_start
+        logger.debug(f"KV cache: {self.num_blocks} blocks of {self.block_size} tokens, {self.num_swap_blocks} swap blocks")
         
-        # Generate text for all prompts in one batch
-        with torch.no_grad():
-            outputs = self.model.generate(
-                inputs.input_ids,
-                attention_mask=inputs.attention_mask,
-                max_new_tokens=50,  # Generate up to 50 new tokens
-                num_return_sequences=1,
-                pad_token_id=self.tokenizer.eos_token_id
-            )
+        # Decode forwards run through graphs compiled per padded shape, all of
+        # them compiled before the worker reports ready. Verifying forwards
+        # carry the proposals after the new token.
+        compile_config = compile_config or CompileConfig()
+        num_new_tokens = [1]
+        if self.speculative_config.method is not None:
+            num_new_tokens.append(1 + self.speculative_config.num_speculative_tokens)
+        self.steps = CompiledSteps(self.model, compile_config, num_new_tokens)
+        self.steps.warmup(self.num_layers, self.num_kv_heads, self.head_dim, self.dtype, self.device)
+        self.draft_steps = None
+        if self.draft_model is not None:
+            self.draft_steps = CompiledSteps(self.draft_model, compile_config, [1])
+            self.draft_steps.warmup(*_kv_dims(self.draft_model), _kv_dtype(self.draft_model), self.device)
+        if compile_config.mode is not None:
+            self.startup_timings['compile'] = self.steps.compile_s + (self.draft_steps.compile_s if self.draft_steps else 0)
         
-        # Decode all outputs
-        generated_texts = self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
-        logger.debug(f"Generated texts: {generated_texts}")
+        # Sampling settings per sequence handle, registered by the executor
+        self.sampler = Sampler(model_config.vocab_size, self.device)
         
-        # Map results back to request IDs
-        results = [
-            {
-                'request_id': request_id,
-                'generated_text': generated_text
+        # Prefill batches are split into length buckets so left padding wastes
+        # at most this share of their positions; real and padded positions
+        # computed so far, per kind of forward
+        self.max_padding_fraction = max_padding_fraction
+        self.num_forwards = 0
+        self.num_draft_forwards = 0
+        self.padding = {'prefill': [0, 0], 'decode': [0, 0]}
+        # run() pinned the worker before it was created
+        self.cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else None
+        self.startup_timings['total'] = time.perf_counter() - start
+        logger.debug("Startup phases: " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in self.startup_timings.items()))
+    
+    def _buckets(self, prompts: List[Dict[str, Any]], lengths: List[int]) -> List[List[Dict[str, Any]]]:
+        return [[prompts[i] for i in bucket] for bucket in bucket_by_length(lengths, self.max_padding_fraction)]
+    
+    def _record_padding(self, kind: str, num_tokens: int, num_positions: int) -> float:
+        """Count a forward's real and padded positions; returns its padding efficiency."""
+        self.num_forwards += 1
+        self.padding[kind][0] += num_tokens
+        self.padding[kind][1] += num_positions
+        return num_tokens / num_positions
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Share of computed positions that held real tokens, for prefill and decode forwards, startup phases
+        and the CPUs and threads the worker runs on. Cheap enough to send with every step."""
+        return {
+            'startup_s': self.startup_timings,
+            'cpus': self.cpus,
+            'num_threads': torch.get_num_threads(),
+            'compile': self.steps.get_stats(),
+            'num_forwards': self.num_forwards,
+            'num_draft_forwards': self.num_draft_forwards,
+            **{
+                f'{kind}_padding_efficiency': num_tokens / num_positions if num_positions else 1.0
+                for kind, (num_tokens, num_positions) in self.padding.items()
             }
-            for request_id, generated_text in zip(request_ids, generated_texts)
+        }
+    
+    def _profile_num_blocks(self) -> Tuple[int, int]:
+        """Turn the configured memory budget into device and swap block counts."""
+        models = [self.model] if self.draft_model is None else [self.model, self.draft_model]
+        block_bytes = 0
+        for model in models:
+            num_layers, num_kv_heads, head_dim = _kv_dims(model)
+            block_bytes += num_layers * 2 * self.block_size * num_kv_heads * head_dim * _kv_dtype(model).itemsize
+        budget = self.cache_config.memory_bytes or _available_memory(self.device) * self.cache_config.memory_fraction
+        num_blocks = int(budget // block_bytes)
+        if num_blocks == 0:
+            raise ValueError(f"KV cache budget of {int(budget)} bytes is less than one block of {block_bytes} bytes")
+        return num_blocks, self.cache_config.swap_space_bytes // block_bytes
+    
+    def _allocate_kv_cache(self, num_blocks: int, device: str, model=None) -> torch.Tensor:
+        # [layer, key/value, slot, head, head_dim]; block b owns slots
+        # b * block_size to (b + 1) * block_size - 1. Left uninitialized:
+        # forwards only gather slots of positions already written, masked
+        # padding included, which reads each row's first cached position;
+        # padded rows of compiled shapes read whatever block 0 holds, but
+        # their outputs are dropped.
+        model = model or self.model
+        num_layers, num_kv_heads, head_dim = _kv_dims(model)
+        return torch.empty(
+            (num_layers, 2, num_blocks * self.block_size, num_kv_heads, head_dim),
+            dtype=_kv_dtype(model), device=device
+        )
+    
+    def generate_forward_batch(self, prompts: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Generate the next tokens for each prompt in the batch.
+
+        Each entry carries the `token_ids` the worker has not computed yet,
+        the number of tokens of the sequence already in the KV cache
+        (`context_len`) and its `block_table`. Cached keys and values are
+        gathered from the block pool and the new ones are written back to the
+        slots of their positions, so the worker keeps no per-sequence KV
+        state. Fresh prompts, later prefill chunks and decoding sequences run
+        as separate forwards to keep padding low, prefills further split into
+        length buckets; their logits are sampled together. Decoding rows
+        stay in one forward whatever their context lengths: a forward more
+        reads all weights again, which costs more than the padded context. Entries with `do_sample` false are prefill chunks short of
+        the prompt's end: their KV is stored but no token is sampled, and
+        their `token_ids` are empty.
+
+        Decoding entries with `num_speculative_tokens` check that many
+        proposed tokens, the scheduler's `proposal_token_ids` or the draft
+        model's, in the same forward and return the accepted ones followed
+        by one more token; everyone else gets one token.
+        """
+        logger.debug(f"Received streaming batch of {len(prompts)} sequences")
+        
+        prefill = [p for p in prompts if p['context_len'] == 0]
+        # Later prefill chunks would pad every decode row to their length
+        chunks = [p for p in prompts if p['context_len'] > 0 and len(p['token_ids']) > 1]
+        decode = [p for p in prompts if p['context_len'] > 0 and len(p['token_ids']) <= 1]
+        groups = [
+            bucket for group in (prefill, chunks) if group
+            for bucket in self._buckets(group, [p['context_len'] + len(p['token_ids']) for p in group])
+        ]
+        if decode:
+            groups.append(decode)
+        ordered = [p for group in groups for p in group]
+        speculating = [p for p in decode if p.get('do_sample', True) and p.get('num_speculative_tokens')]
+        
+        with torch.no_grad():
+            draft_probs = None
+            if self.draft_model is not None:
+                with profiler.span('propose', rows=len(speculating)):
+                    draft_probs = self._propose(groups, speculating)
+            verify = {}
+            if speculating:
+                # Proposals are verified in the decode forward, after the new token
+                verify = {id(p): {**p, 'token_ids': p['token_ids'] + p['proposal_token_ids']} for p in speculating}
+                groups[-1] = [verify.get(id(p), p) for p in decode]
+            
+            # The decode forward also scores every proposal
+            logits = [
+                self._forward(group, num_logits=1 + max(len(p['proposal_token_ids']) for p in speculating)
+                              if verify and group is groups[-1] else 1)
+                for group in groups
+            ]
+            last_logits = torch.cat([group_logits[:, -1] for group_logits in logits])
+            next_tokens = {}
+            sampled = [i for i, p in enumerate(ordered) if p.get('do_sample', True) and id(p) not in verify]
+            if sampled:
+                with profiler.span('sample', rows=len(sampled)):
+                    slots = torch.tensor([ordered[i]['request_id'] for i in sampled], device=self.device)
+                    next_token = self.sampler(last_logits[sampled], slots).tolist()
+                next_tokens = {ordered[i]['request_id']: [token] for i, token in zip(sampled, next_token)}
+            if speculating:
+                with profiler.span('verify', rows=len(speculating)):
+                    next_tokens.update(self._verify(speculating, decode, logits[-1], draft_probs))
+        
+        return [
+            {'request_id': p['request_id'], 'token_ids': next_tokens.get(p['request_id'], [])}
+            for p in prompts
         ]
+
+    def _propose(self, groups: List[List[Dict[str, Any]]], speculating: List[Dict[str, Any]]) -> Optional[torch.Tensor]:
+        """Sample `num_speculative_tokens` proposals per speculating row from the draft model.
+
+        The draft first computes every row's new tokens, also in steps where
+        nobody speculates, so its cache stays in step with the model's; then
+        it runs one forward per proposal. Sets each row's
+        `proposal_token_ids` and returns the draft's distributions
+        `[rows, k, vocab]` they were drawn from.
+        """
+        rows = {id(p): i for i, p in enumerate(speculating)}
+        last_logits = [None] * len(speculating)
+        for group in groups:
+            group_logits = self._forward(group, draft=True)[:, -1]
+            for p, row_logits in zip(group, group_logits):
+                if id(p) in rows:
+                    last_logits[rows[id(p)]] = row_logits
+        if not speculating:
+            return None
         
-        return results
+        num_speculative = [p['num_speculative_tokens'] for p in speculating]
+        max_speculative = max(num_speculative)
+        slots = torch.tensor([p['request_id'] for p in speculating], device=self.device)
+        draft_probs = torch.zeros((len(speculating), max_speculative, self.sampler.vocab_size), device=self.device)
+        proposals = torch.zeros((len(speculating), max_speculative), dtype=torch.long, device=self.device)
+        active = list(range(len(speculating)))
+        logits = self._vocab_logits(torch.stack(last_logits))
+        for j in range(max_speculative):
+            probs = self.sampler.probs(logits, slots[active])
+            draft_probs[active, j] = probs
+            proposals[active, j] = sample(probs)
+            # Feed each proposal back unless it is the row's last one
+            active = [i for i in active if num_speculative[i] > j + 1]
+            if not active:
+                break
+            logits = self._vocab_logits(self._forward([
+                {**speculating[i], 'context_len': speculating[i]['context_len'] + len(speculating[i]['token_ids']) + j,
+                 'token_ids': [int(proposals[i, j])]}
+                for i in active
+            ], draft=True)[:, -1])
+        for p, row in zip(speculating, proposals.tolist()):
+            p['proposal_token_ids'] = row[:p['num_speculative_tokens']]
+        return draft_probs
 
-    def generate_forward_batch(self, prompts: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        """Generate one token for each prompt in the batch."""
-        logger.debug(f"Received streaming prompts: {prompts}")
+    def _vocab_logits(self, logits: torch.Tensor) -> torch.Tensor:
+        # A draft sharing the tokenizer may still pad its vocabulary differently
+        vocab_size = self.sampler.vocab_size
+        if logits.shape[-1] < vocab_size:
+            return F.pad(logits, (0, vocab_size - logits.shape[-1]), value=float('-inf'))
+        return logits
+
+    def _verify(self, speculating: List[Dict[str, Any]], decode: List[Dict[str, Any]], logits: torch.Tensor,
+                draft_probs: Optional[torch.Tensor]) -> Dict[int, List[int]]:
+        """Rejection-sample each speculating row's proposals against the decode forward's logits."""
+        rows = {id(p): i for i, p in enumerate(decode)}
+        num_proposed = [len(p['proposal_token_ids']) for p in speculating]
+        max_proposed = max(num_proposed)
+        # The last 1 + k logits of a row score its proposals and the token after them
+        target_logits = torch.stack([
+            F.pad(logits[rows[id(p)], logits.shape[1] - 1 - k:], (0, 0, 0, max_proposed - k))
+            for p, k in zip(speculating, num_proposed)
+        ])
+        slots = torch.tensor([p['request_id'] for p in speculating], device=self.device)
+        target_probs = self.sampler.probs(
+            target_logits.flatten(0, 1), slots.repeat_interleave(max_proposed + 1)
+        ).view(len(speculating), max_proposed + 1, -1)
+        proposals = torch.tensor(
+            [p['proposal_token_ids'] + [0] * (max_proposed - k) for p, k in zip(speculating, num_proposed)],
+            dtype=torch.long, device=self.device
+        )
+        if draft_probs is not None:
+            draft_probs = draft_probs[:, :max_proposed]
+        num_accepted, next_token = rejection_sample(
+            target_probs, proposals, torch.tensor(num_proposed, device=self.device), draft_probs
+        )
         
-        # Add padding token to the tokenizer if not present
-        if self.tokenizer.pad_token is None:
-            self.tokenizer.pad_token = self.tokenizer.eos_token
+        next_tokens = {}
+        fully_accepted = []
+        for p, k, accepted, token in zip(speculating, num_proposed, num_accepted.tolist(), next_token.tolist()):
+            next_tokens[p['request_id']] = p['proposal_token_ids'][:accepted] + [token]
+            if accepted == k:
+                fully_accepted.append(p)
+        for handle, token_ids in next_tokens.items():
+            self.sampler.record(torch.full((len(token_ids),), handle, device=self.device),
+                                torch.tensor(token_ids, device=self.device))
+        if self.draft_model is not None and fully_accepted:
+            # The draft never computed its own last proposal, which the next step builds on
+            self._forward([
+                {**p, 'context_len': p['context_len'] + len(p['token_ids']) + len(p['proposal_token_ids']) - 1,
+                 'token_ids': p['proposal_token_ids'][-1:]}
+                for p in fully_accepted
+            ], draft=True)
+        return next_tokens
+
+    def add_sequences(self, sequences: List[Tuple[int, Optional[SamplingParams], List[int], int]]):
+        """Register (handle, sampling params, token ids, prompt length) of sequences new to this worker."""
+        for handle, params, token_ids, num_prompt_tokens in sequences:
+            self.sampler.add(handle, params, token_ids, num_prompt_tokens)
+
+    def swap_out(self, mapping: List[Tuple[int, int]]):
+        """Copy blocks of preempted sequences from the device pool to swap space."""
+        self._copy_blocks(self.kv_cache, self.swap_cache, mapping)
+        if self.draft_model is not None:
+            self._copy_blocks(self.draft_kv_cache, self.draft_swap_cache, mapping)
+
+    def swap_in(self, mapping: List[Tuple[int, int]]):
+        """Copy blocks of resumed sequences from swap space back to the device pool."""
+        self._copy_blocks(self.swap_cache, self.kv_cache, mapping)
+        if self.draft_model is not None:
+            self._copy_blocks(self.draft_swap_cache, self.draft_kv_cache, mapping)
+
+    def _copy_blocks(self, source: torch.Tensor, destination: torch.Tensor, mapping: List[Tuple[int, int]]):
+        offsets = torch.arange(self.block_size)
+        source_slots = (torch.tensor([src for src, _ in mapping])[:, None] * self.block_size + offsets).flatten()
+        destination_slots = (torch.tensor([dst for _, dst in mapping])[:, None] * self.block_size + offsets).flatten()
+        destination[:, :, destination_slots.to(destination.device)] = \
+            source[:, :, source_slots.to(source.device)].to(destination.device)
+        logger.debug(f"Copied {len(mapping)} KV blocks")
+
+    def _pad(self, token_id_lists: List[List[int]]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Left-pad token id lists so the last real token sits at position -1 of every row."""
+        max_length = max(len(token_ids) for token_ids in token_id_lists)
+        input_ids = torch.full((len(token_id_lists), max_length), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(token_id_lists), max_length), dtype=torch.long)
+        for i, token_ids in enumerate(token_id_lists):
+            if len(token_ids):
+                input_ids[i, -len(token_ids):] = torch.as_tensor(token_ids, dtype=torch.long)
+                attention_mask[i, -len(token_ids):] = 1
+        return input_ids.to(self.device), attention_mask.to(self.device)
+
+    def _slots(self, block_tables: torch.Tensor, positions: torch.Tensor) -> torch.Tensor:
+        """Map token positions of each row to slots of the KV pool through its block table."""
+        return block_tables.gather(1, positions // self.block_size) * self.block_size + positions % self.block_size
+
+    def _forward(self, prompts: List[Dict[str, Any]], num_logits: int = 1, draft: bool = False) -> torch.Tensor:
+        """Run the new tokens of each sequence against its cached context, store their KV
+        and return the logits of the last num_logits positions of each row, `[rows, num_logits, vocab]`.
+
+        With `draft` the draft model runs against its own pool.
+        """
+        steps, kv_cache = (self.draft_steps, self.draft_kv_cache) if draft else (self.steps, self.kv_cache)
+        num_rows = len(prompts)
+        input_ids, new_mask = self._pad([p['token_ids'] for p in prompts])
+        context_lens = torch.tensor([p['context_len'] for p in prompts], device=self.device)
+        max_context = int(context_lens.max())
+        bucket = steps.bucket(num_rows, input_ids.shape[1], max_context)
+        if bucket in steps.compiled:
+            # Pad up to the compiled shape: extra rows have no context and a
+            # single new token whose keys and values are not stored
+            padded_rows, num_new_tokens, max_context = bucket
+            padding = (num_new_tokens - input_ids.shape[1], 0, 0, padded_rows - num_rows)
+            input_ids = F.pad(input_ids, padding, value=self.pad_token_id)
+            new_mask = F.pad(new_mask, padding)
+            new_mask[num_rows:, -1] = 1
+            context_lens = F.pad(context_lens, (0, padded_rows - num_rows))
+        max_blocks = max(len(p['block_table']) for p in prompts)
+        block_tables = torch.zeros((input_ids.shape[0], max_blocks), dtype=torch.long)
+        for i, p in enumerate(prompts):
+            block_tables[i, :len(p['block_table'])] = torch.as_tensor(p['block_table'], dtype=torch.long)
+        block_tables = block_tables.to(self.device)
+        if draft:
+            self.num_draft_forwards += 1
+        else:
+            # Every row attends over max_context cached and as many new positions as the longest
+            efficiency = self._record_padding(
+                'decode' if all(p['context_len'] and len(p['token_ids']) <= 1 + p.get('num_speculative_tokens', 0)
+                                for p in prompts) else 'prefill',
+                int(context_lens.sum()) + int(new_mask[:num_rows].sum()),
+                input_ids.shape[0] * (max_context + input_ids.shape[1])
+            )
+            logger.debug(f"Forward input shape: {tuple(input_ids.shape)}, max cached length: {max_context}, "
+                         f"padding efficiency {efficiency:.0%}")
         
-        # Tokenize all prompts in batch
-        encoded = self.tokenizer(
-            [p['prompt'] for p in prompts],
-            return_tensors="pt",
-            padding=True,
-            truncation=True,
-            max_length=512
-        ).to(self.device)
+        # New tokens continue after the cached context
+        position_ids = (new_mask.cumsum(-1) - 1).clamp(min=0) + context_lens[:, None]
+        attention_mask = new_mask
+        # [layer, key/value, row, position, head, head_dim]
+        context_kv = kv_cache.new_empty((kv_cache.shape[0], 2, input_ids.shape[0], 0, *kv_cache.shape[3:]))
+        if max_context:
+            # Cached tokens are gathered left-padded to max_context like the
+            # new ones; the attention mask hides the padding in both parts.
+            context_positions = torch.arange(max_context, device=self.device) - (max_context - context_lens[:, None])
+            context_slots = self._slots(block_tables, context_positions.clamp(min=0))
+            attention_mask = torch.cat([(context_positions >= 0).long(), new_mask], dim=-1)
+            context_kv = kv_cache[:, :, context_slots]
         
-        logger.debug(f"Batch input shape: {encoded.input_ids.shape}")
+        with profiler.span('draft_forward' if draft else 'forward', rows=num_rows, new_tokens=input_ids.shape[1],
+                           context=max_context, compiled=bucket in steps.compiled):
+            logits, new_kv = steps(bucket, input_ids, attention_mask, position_ids, context_kv)
+        # Write the keys and values of the new tokens into their slots
+        with profiler.span('write_kv'):
+            rows, columns = new_mask[:num_rows].nonzero(as_tuple=True)
+            kv_cache[:, :, self._slots(block_tables, position_ids)[rows, columns]] = new_kv[:, :, rows, columns]
         
-        # Generate next token
-        with torch.no_grad():
-            outputs = self.model(
-                input_ids=encoded.input_ids,
-                attention_mask=encoded.attention_mask,
-                use_cache=False
-            )
-            
-            # Get next token logits and sample
-            next_token_logits = outputs.logits[:, -1, :]
-            next_token = torch.multinomial(
-                torch.softmax(next_token_logits / 0.7, dim=-1),
-                num_samples=1
-            ).squeeze(-1)
-            
-            # Prepare results
-            results = []
-            for i, prompt_data in enumerate(prompts):
-                token = self.tokenizer.decode(next_token[i].unsqueeze(0), skip_special_tokens=True)
-                logger.debug(f"Generated token for prompt '{prompt_data['prompt']}': '{token}'")
-                results.append({
-                    'request_id': prompt_data['request_id'],
-                    'token': token,
-                    'is_finished': token == self.tokenizer.eos_token
-                })
-            
-            return results
+        return logits[:num_rows, -num_logits:, :]
 
     @staticmethod
-    def run(model_name: str, task_queue: mp.Queue, result_queue: mp.Queue):
+    def run(model_name: str, channel: ShmChannel, num_threads: Optional[int] = None,
+            cache_config: Optional[CacheConfig] = None, max_padding_fraction: float = 0.25,
+            speculative_config: Optional[SpeculativeConfig] = None, precision_config: Optional[PrecisionConfig] = None,
+            model_cache_config: Optional[ModelCacheConfig] = None, compile_config: Optional[CompileConfig] = None,
+            cpus: Optional[List[int]] = None, num_interop_threads: Optional[int] = None):
         # Enable remote debugging
         logger.debug("Waiting for debugger to attach...")
         logger.debug("Debugger attached!")
         
-        worker = ModelWorker(model_name)
+        # Replicas share the host, so each one keeps to its own cores and
+        # thread budget. Pinned before loading, so the memory it touches
+        # first is allocated on its NUMA node.
+        if cpus:
+            os.sched_setaffinity(0, cpus)
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        if num_interop_threads:
+            try:
+                torch.set_num_interop_threads(num_interop_threads)
+            except RuntimeError:
+                # Too late once the pool inherited from the parent has started
+                logger.debug("Keeping the default inter-op threads")
+        
+        worker = ModelWorker(model_name, cache_config, max_padding_fraction, speculative_config, precision_config,
+                             model_cache_config, compile_config)
         logger.debug("Worker initialized")
+        # The scheduler sizes its block manager from these counts
+        channel.reply(('ready', worker.num_blocks, worker.num_swap_blocks, worker.get_stats()))
         
         while True:
-            logger.debug("Waiting for batch from queue...")
-            batch_data = task_queue.get()
-            logger.debug(f"Received batch: {batch_data}")
+            task = channel.recv_task()
             
-            if batch_data is None:  # Shutdown signal
+            if task is None:  # Shutdown signal
                 logger.debug("Received shutdown signal")
                 break
             
-            batch, is_streaming = batch_data
-            
-            if is_streaming:
-                # Handle streaming generation
-                result_queue.put(('stream', worker.generate_forward_batch(batch)))
-            else:
-                # Handle regular generation
-                result_queue.put(('complete', worker.generate(batch)))
\ No newline at end of file
+            task_type = task[0]
+            try:
+                if task_type == 'forward':
+                    # Handle streaming generation; token ids are read in place from shared memory
+                    with profiler.span('read_batch'):
+                        handles, context_lens, token_id_lists, block_tables, do_sample, num_speculative = \
+                            channel.read_batch(task[1], task[2])
+                    prompts = [
+                        {'request_id': handle, 'context_len': context_len, 'token_ids': token_ids,
+                         'block_table': block_table, 'do_sample': sample, 'num_speculative_tokens': k}
+                        for handle, context_len, token_ids, block_table, sample, k
+                        in zip(handles, context_lens, token_id_lists, block_tables, do_sample, num_speculative)
+                    ]
+                    if worker.draft_model is None:
+                        # n-gram proposals arrive after the new tokens
+                        for p in prompts:
+                            if p['num_speculative_tokens']:
+                                k = p['num_speculative_tokens']
+                                p['token_ids'], p['proposal_token_ids'] = p['token_ids'][:-k], p['token_ids'][-k:]
+                    with profiler.span('step', rows=len(prompts)):
+                        results = worker.generate_forward_batch(prompts)
+                    with profiler.span('send_tokens'):
+                        channel.send_tokens([result['token_ids'] for result in results], worker.get_stats())
+                elif task_type == 'add':
+                    worker.add_sequences(task[1])
+                elif task_type == 'swap_out':
+                    worker.swap_out(task[1])
+                elif task_type == 'swap_in':
+                    worker.swap_in(task[1])
+                elif task_type == 'attach':
+                    # The executor resized the request ring
+                    channel.attach_requests(task[1])
+                elif task_type == 'profile':
+                    if task[1]:
+                        profiler.start(task[2])
+                    else:
+                        profiler.stop()
+                elif task_type == 'trace':
+                    channel.reply(('trace', profiler.trace_events(task[1])))
+            except Exception as e:
+                logger.exception(f"Failed to run {task_type} task")
+                # Adds, swaps and attaches are one-way, nobody waits for an answer
+                if task_type in ('forward', 'trace'):
+                    channel.reply(('error', repr(e)))
+
+
+def bucket_by_length(lengths: Sequence[int], max_padding_fraction: float) -> List[List[int]]:
+    """Group row indices, shortest first, into buckets whose padding to
+    their longest row is at most max_padding_fraction of the positions."""
+    buckets: List[List[int]] = []
+    num_tokens = 0
+    for index in sorted(range(len(lengths)), key=lengths.__getitem__):
+        length = lengths[index]
+        num_positions = (len(buckets[-1]) + 1) * length if buckets else 0
+        if not buckets or num_positions - num_tokens - length > max_padding_fraction * num_positions:
+            buckets.append([])
+            num_tokens = 0
+        buckets[-1].append(index)
+        num_tokens += length
+    return buckets
+
+
+def _kv_dims(model) -> Tuple[int, int, int]:
+    """Layers, KV heads and head size of a model's KV cache."""
+    config = model.config
+    num_kv_heads = getattr(config, 'num_key_value_heads', None) or config.num_attention_heads
+    head_dim = getattr(config, 'head_dim', None) or config.hidden_size // config.num_attention_heads
+    return config.num_hidden_layers, num_kv_heads, head_dim
+
+
+def _kv_dtype(model) -> torch.dtype:
+    # Quantized linear layers keep their weights packed, outside parameters();
+    # the embeddings still tell the activation dtype
+    return model.get_input_embeddings().weight.dtype
+
+
+def _available_memory(device: str) -> int:
+    """Free bytes on the device, or available host RAM when running on CPU."""
+    if device == "cuda":
+        return torch.cuda.mem_get_info()[0]
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
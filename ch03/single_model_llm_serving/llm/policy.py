@@ -0,0 +1,68 @@
+import math
+from typing import TYPE_CHECKING, Any, Iterable, List, Tuple
+
+if TYPE_CHECKING:
+    from .workload_manager import Sequence
+
+class Policy:
+    """Order in which the scheduler serves sequences; smaller keys go first.
+
+    `WorkloadManager` sorts its running, swapped and waiting sequences by
+    `key` every step: running ones decode in that order and the last one on
+    a replica is the preemption victim, waiting ones are admitted in it.
+    `preempts(a, b)` says whether waiting sequence `a` may take the blocks
+    of running sequence `b` when there is no room for it.
+    """
+    # Whether the order can differ from the queues' own, so sorting is needed
+    reorders = True
+
+    def key(self, sequence: "Sequence") -> Tuple[Any, ...]:
+        raise NotImplementedError
+
+    def sort(self, sequences: Iterable["Sequence"]) -> List["Sequence"]:
+        return sorted(sequences, key=self.key)
+
+    def preempts(self, sequence: "Sequence", running: "Sequence") -> bool:
+        return False
+
+class FCFSPolicy(Policy):
+    """Arrival order; the queues already keep it, so nothing is sorted or preempted."""
+    reorders = False
+
+    def key(self, sequence: "Sequence") -> Tuple[Any, ...]:
+        return (sequence.arrival_time,)
+
+class PriorityPolicy(Policy):
+    """Lowest priority value first, then least slack, then arrival order.
+
+    All sequences are compared at the same moment, so the least slack is
+    the nearest deadline. A waiting sequence preempts running ones of a
+    higher priority value, never its own class, so equals do not thrash.
+    """
+    def key(self, sequence: "Sequence") -> Tuple[Any, ...]:
+        return (sequence.priority, _deadline(sequence), sequence.arrival_time)
+
+    def preempts(self, sequence: "Sequence", running: "Sequence") -> bool:
+        return sequence.priority < running.priority
+
+class EDFPolicy(Policy):
+    """Earliest deadline first regardless of priority; sequences without a deadline go last, in arrival order."""
+    def key(self, sequence: "Sequence") -> Tuple[Any, ...]:
+        return (_deadline(sequence), sequence.arrival_time)
+
+def _deadline(sequence: "Sequence") -> float:
+    """The first token's deadline until it is out, then the whole request's."""
+    if sequence.ttft_deadline is not None and not sequence.output_token_ids:
+        if sequence.deadline is not None:
+            return min(sequence.ttft_deadline, sequence.deadline)
+        return sequence.ttft_deadline
+    return sequence.deadline if sequence.deadline is not None else math.inf
+
+_POLICIES = {
+    "fcfs": FCFSPolicy,
+    "priority": PriorityPolicy,
+    "edf": EDFPolicy,
+}
+
+def get_policy(name: str) -> Policy:
+    return _POLICIES[name]()
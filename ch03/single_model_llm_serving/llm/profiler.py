@@ -0,0 +1,118 @@
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+class _Span:
+    __slots__ = ('events', 'name', 'args', 'start')
+
+    def __init__(self, events: Deque[Tuple], name: str, args: Dict[str, Any]):
+        self.events = events
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.monotonic()
+        self.events.append(('X', self.name, threading.get_native_id(), self.start, end - self.start, self.args))
+        return False
+
+class _NoSpan:
+    """What span() returns while profiling is off: entering and leaving it costs two calls."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NO_SPAN = _NoSpan()
+
+class StepProfiler:
+    """Timestamps of the stages of every engine step and of every request, for chrome://tracing or Perfetto.
+
+    Each process has one, `profiler`: the engine thread and API handlers
+    record into the engine's, every worker into its own. Stages are
+    `with profiler.span(name, **args)` blocks; off, a span is a shared
+    object with no state. On, it appends one tuple to a ring of the last
+    `max_events` events, which is safe from any thread, and events become
+    Chrome trace JSON only when exported. A request's queue wait, prefill
+    and decode are recorded once, when it ends, from the times its
+    Sequence already keeps. All times are `time.monotonic()`, one clock
+    for every process on the host, so worker spans line up with the
+    engine's.
+    """
+    def __init__(self, max_events: int = 200_000):
+        self.enabled = False
+        self.events: Deque[Tuple] = deque(maxlen=max_events)
+
+    def start(self, max_events: Optional[int] = None):
+        """Drop earlier events and record from now on."""
+        self.events = deque(maxlen=max_events or self.events.maxlen)
+        self.enabled = True
+
+    def stop(self):
+        """Stop recording; the events so far can still be exported."""
+        self.enabled = False
+
+    def span(self, name: str, **args):
+        if not self.enabled:
+            return _NO_SPAN
+        return _Span(self.events, name, args)
+
+    def request(self, sequence, outcome: str):
+        """Record the life of a request that finished or was aborted."""
+        if not self.enabled:
+            return
+        self.events.append(('request', sequence.id, sequence.arrival_time, sequence.first_scheduled_time,
+                            sequence.first_token_time, time.monotonic(), {
+                                'outcome': outcome,
+                                'prompt_tokens': len(sequence.prompt_token_ids),
+                                'output_tokens': sequence.token_count,
+                            }))
+
+    def trace_events(self, process_name: Optional[str] = None) -> List[Dict[str, Any]]:
+        """The recorded events in the Chrome trace event format, with names for this process and its threads."""
+        pid = os.getpid()
+        trace = []
+        if process_name:
+            trace.append({'ph': 'M', 'name': 'process_name', 'pid': pid, 'tid': 0, 'args': {'name': process_name}})
+        thread_names = {thread.native_id: thread.name for thread in threading.enumerate()}
+        threads = set()
+        for event in list(self.events):
+            if event[0] == 'X':
+                _, name, tid, start, duration, args = event
+                threads.add(tid)
+                trace.append({'ph': 'X', 'cat': 'step', 'name': name, 'pid': pid, 'tid': tid,
+                              'ts': start * 1e6, 'dur': duration * 1e6, 'args': args})
+            else:
+                _, seq_id, arrival, scheduled, first_token, end, args = event
+                trace.extend(_request_events(pid, seq_id, arrival, scheduled, first_token, end, args))
+        for tid in threads:
+            if tid in thread_names:
+                trace.append({'ph': 'M', 'name': 'thread_name', 'pid': pid, 'tid': tid,
+                              'args': {'name': thread_names[tid]}})
+        return trace
+
+# The profiler of this process
+profiler = StepProfiler()
+
+
+def _request_events(pid: int, seq_id: str, arrival: float, scheduled: Optional[float], first_token: Optional[float],
+                    end: float, args: Dict[str, Any]) -> List[Dict[str, Any]]:
+    # Async slices share the request's id, so each request gets a track of
+    # its own with its phases nested under it
+    common = {'cat': 'request', 'id': seq_id, 'pid': pid, 'tid': 0}
+    events = [{**common, 'ph': 'b', 'name': 'request', 'ts': arrival * 1e6, 'args': args}]
+    boundaries = [('queued', arrival), ('prefill', scheduled), ('decode', first_token)]
+    known = [(name, start) for name, start in boundaries if start is not None]
+    for (name, start), (_, stop) in zip(known, known[1:] + [(None, end)]):
+        events.append({**common, 'ph': 'b', 'name': name, 'ts': start * 1e6})
+        events.append({**common, 'ph': 'e', 'name': name, 'ts': stop * 1e6})
+    events.append({**common, 'ph': 'e', 'name': 'request', 'ts': end * 1e6})
+    return events
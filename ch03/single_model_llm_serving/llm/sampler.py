@@ -0,0 +1,154 @@
+from typing import List, Optional, Tuple
+import torch
+from .sampling_params import SamplingParams
+
+class Sampler:
+    """Picks the next token of every row of a batch, each with its own SamplingParams.
+
+    Parameters live in per-slot tensors indexed by the executor's sequence
+    handles, so a step gathers them with one indexing op and every stage
+    runs on the whole batch at once; a stage no row needs is skipped, which
+    keeps mixed batches as fast as uniform ones. The prompt token set and
+    output token counts behind the penalties are `[slot, vocab]` tensors,
+    only allocated once some request asks for a penalty.
+    """
+    def __init__(self, vocab_size: int, device: str, capacity: int = 64):
+        self.vocab_size = vocab_size
+        self.device = device
+        self.capacity = 0
+        self.temperature = torch.empty(0, device=device)
+        self.top_k = torch.empty(0, dtype=torch.long, device=device)
+        self.top_p = torch.empty(0, device=device)
+        self.min_p = torch.empty(0, device=device)
+        self.repetition_penalty = torch.empty(0, device=device)
+        self.presence_penalty = torch.empty(0, device=device)
+        self.frequency_penalty = torch.empty(0, device=device)
+        self.prompt_mask: Optional[torch.Tensor] = None
+        self.output_counts: Optional[torch.Tensor] = None
+        self._grow(capacity)
+
+    def _grow(self, capacity: int):
+        def grow(tensor: torch.Tensor) -> torch.Tensor:
+            grown = torch.zeros((capacity,) + tuple(tensor.shape[1:]), dtype=tensor.dtype, device=self.device)
+            grown[:len(tensor)] = tensor
+            return grown
+
+        for name in ('temperature', 'top_k', 'top_p', 'min_p', 'repetition_penalty', 'presence_penalty', 'frequency_penalty'):
+            setattr(self, name, grow(getattr(self, name)))
+        if self.output_counts is not None:
+            self.prompt_mask = grow(self.prompt_mask)
+            self.output_counts = grow(self.output_counts)
+        self.capacity = capacity
+
+    def add(self, slot: int, params: Optional[SamplingParams], token_ids: List[int], num_prompt_tokens: int):
+        """Set up a sequence's slot; token_ids are its prompt and any output it already has."""
+        params = params or SamplingParams()
+        if slot >= self.capacity:
+            self._grow(max(2 * self.capacity, slot + 1))
+        self.temperature[slot] = params.temperature
+        self.top_k[slot] = params.top_k
+        self.top_p[slot] = params.top_p
+        self.min_p[slot] = params.min_p
+        self.repetition_penalty[slot] = params.repetition_penalty
+        self.presence_penalty[slot] = params.presence_penalty
+        self.frequency_penalty[slot] = params.frequency_penalty
+        if params.has_penalties and self.output_counts is None:
+            self.prompt_mask = torch.zeros((self.capacity, self.vocab_size), dtype=torch.bool, device=self.device)
+            self.output_counts = torch.zeros((self.capacity, self.vocab_size), dtype=torch.int32, device=self.device)
+        if self.output_counts is not None:
+            token_ids = torch.as_tensor(token_ids, dtype=torch.long, device=self.device)
+            self.prompt_mask[slot] = False
+            self.prompt_mask[slot, token_ids[:num_prompt_tokens]] = True
+            self.output_counts[slot] = torch.bincount(token_ids[num_prompt_tokens:], minlength=self.vocab_size)[:self.vocab_size]
+
+    def _transform(self, logits: torch.Tensor, slots: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Apply each row's penalties, temperature and truncation; also returns which rows are greedy.
+
+        Greedy rows keep their argmax through every stage, and when all rows
+        are greedy only the penalties are applied.
+        """
+        logits = logits[:, :self.vocab_size].float()
+        if self.output_counts is not None:
+            repetition = self.repetition_penalty[slots]
+            presence = self.presence_penalty[slots]
+            frequency = self.frequency_penalty[slots]
+            if ((repetition != 1) | (presence != 0) | (frequency != 0)).any():
+                logits = apply_penalties(
+                    logits, self.prompt_mask[slots], self.output_counts[slots], repetition, presence, frequency
+                )
+
+        temperature = self.temperature[slots]
+        greedy = temperature == 0
+        if not greedy.all():
+            logits = logits / torch.where(greedy, torch.ones_like(temperature), temperature)[:, None]
+            top_k = self.top_k[slots]
+            top_p = self.top_p[slots]
+            if (top_k > 0).any() or (top_p < 1).any():
+                logits = apply_top_k_top_p(logits, top_k, top_p)
+            min_p = self.min_p[slots]
+            if (min_p > 0).any():
+                logits = apply_min_p(logits, min_p)
+        return logits, greedy
+
+    def __call__(self, logits: torch.Tensor, slots: torch.Tensor) -> torch.Tensor:
+        """Sample one token per row of logits; row i belongs to slots[i]."""
+        logits, greedy = self._transform(logits, slots)
+        greedy_tokens = logits.argmax(dim=-1)
+        if greedy.all():
+            tokens = greedy_tokens
+        else:
+            tokens = torch.where(greedy, greedy_tokens, sample(logits.softmax(dim=-1)))
+        self.record(slots, tokens)
+        return tokens
+
+    def probs(self, logits: torch.Tensor, slots: torch.Tensor) -> torch.Tensor:
+        """The distribution each row of logits samples from, one-hot for greedy rows.
+
+        Speculative decoding compares these between draft and model; unlike
+        a call, it does not count any token towards the penalties.
+        """
+        logits, greedy = self._transform(logits, slots)
+        one_hot = torch.zeros_like(logits).scatter_(-1, logits.argmax(dim=-1, keepdim=True), 1.0)
+        if greedy.all():
+            return one_hot
+        return torch.where(greedy[:, None], one_hot, logits.softmax(dim=-1))
+
+    def record(self, slots: torch.Tensor, tokens: torch.Tensor):
+        """Count tokens sampled for slots towards their frequency and presence penalties."""
+        if self.output_counts is not None:
+            self.output_counts.index_put_((slots, tokens), torch.ones_like(tokens, dtype=torch.int32), accumulate=True)
+
+
+def sample(probs: torch.Tensor) -> torch.Tensor:
+    # Racing exponential clocks samples from probs like torch.multinomial,
+    # as one elementwise op and an argmax
+    return (probs / torch.empty_like(probs).exponential_()).argmax(dim=-1)
+
+def apply_penalties(logits: torch.Tensor, prompt_mask: torch.Tensor, output_counts: torch.Tensor,
+                    repetition: torch.Tensor, presence: torch.Tensor, frequency: torch.Tensor) -> torch.Tensor:
+    generated = output_counts > 0
+    scale = torch.where(prompt_mask | generated, repetition[:, None], torch.ones_like(logits))
+    logits = torch.where(logits > 0, logits / scale, logits * scale)
+    return logits - frequency[:, None] * output_counts - presence[:, None] * generated
+
+
+def apply_top_k_top_p(logits: torch.Tensor, top_k: torch.Tensor, top_p: torch.Tensor) -> torch.Tensor:
+    """Mask everything outside each row's top-k and then its top-p nucleus, with a single sort."""
+    vocab_size = logits.shape[-1]
+    sorted_logits, sorted_index = logits.sort(dim=-1)
+    k = torch.where(top_k > 0, top_k, vocab_size).clamp(max=vocab_size)
+    kth_largest = sorted_logits.gather(-1, (vocab_size - k)[:, None])
+    sorted_logits = sorted_logits.masked_fill(sorted_logits < kth_largest, float('-inf'))
+    # Ascending order: drop the low tail whose mass stays within 1 - top_p,
+    # always keeping the most likely token
+    cumulative = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+    tail = cumulative <= 1 - top_p[:, None]
+    tail[:, -1] = False
+    sorted_logits = sorted_logits.masked_fill(tail, float('-inf'))
+    return torch.empty_like(logits).scatter_(-1, sorted_index, sorted_logits)
+
+
+def apply_min_p(logits: torch.Tensor, min_p: torch.Tensor) -> torch.Tensor:
+    probs = logits.softmax(dim=-1)
+    threshold = min_p[:, None] * probs.max(dim=-1, keepdim=True).values
+    return logits.masked_fill(probs < threshold, float('-inf'))
@@ -0,0 +1,33 @@
+from typing import List
+from pydantic import BaseModel, Field
+
+class SamplingParams(BaseModel):
+    """How one request picks its next token and when it stops; every row of a batch may differ.
+
+    Penalties follow the OpenAI / vLLM conventions: `repetition_penalty`
+    scales the logits of tokens seen in the prompt or the output,
+    `presence_penalty` and `frequency_penalty` subtract from the logits of
+    tokens already generated. A sequence stops after `max_tokens` tokens,
+    at EOS unless `ignore_eos`, at any of `stop_token_ids` or once its text
+    contains one of the `stop` strings; stop tokens and strings are left
+    out of the output.
+    """
+    # 0 is greedy decoding
+    temperature: float = Field(default=0.7, ge=0)
+    # Keep the k most likely tokens; -1 keeps all
+    top_k: int = Field(default=-1, ge=-1)
+    # Keep the smallest set of tokens whose probability adds up to top_p
+    top_p: float = Field(default=1.0, gt=0, le=1)
+    # Drop tokens less likely than min_p times the most likely one
+    min_p: float = Field(default=0.0, ge=0, le=1)
+    repetition_penalty: float = Field(default=1.0, gt=0)
+    presence_penalty: float = Field(default=0.0, ge=-2, le=2)
+    frequency_penalty: float = Field(default=0.0, ge=-2, le=2)
+    max_tokens: int = Field(default=20, gt=0)
+    stop: List[str] = []
+    stop_token_ids: List[int] = []
+    ignore_eos: bool = False
+
+    @property
+    def has_penalties(self) -> bool:
+        return self.repetition_penalty != 1.0 or self.presence_penalty != 0.0 or self.frequency_penalty != 0.0
@@ -0,0 +1,15 @@
+from typing import Optional
+from pydantic import BaseModel, Field
+
+class SchedulingParams(BaseModel):
+    """How urgent one request is to the scheduler; only non-FCFS policies look at it.
+
+    A lower `priority` runs first, as in vLLM; the priority policy lets it
+    preempt running sequences of a higher one. `ttft_slo_s` is how long,
+    from arrival, the first token may take and `deadline_s` how long the
+    whole request may take; sequences closest to their deadline go first
+    within a priority and under earliest-deadline-first.
+    """
+    priority: int = 0
+    ttft_slo_s: Optional[float] = Field(default=None, gt=0)
+    deadline_s: Optional[float] = Field(default=None, gt=0)
@@ -0,0 +1,168 @@
+import multiprocessing as mp
+from itertools import chain
+from multiprocessing import shared_memory
+from typing import Any, List, Optional, Sequence, Tuple
+import numpy as np
+
+class ShmRingBuffer:
+    """A preallocated int32 ring buffer in shared memory.
+
+    Only one process writes to a ring; it reserves a contiguous slice, fills
+    it in place and passes `(offset, length)` to the reader in a control
+    message. A reservation that does not fit before the end wraps to the
+    start, which is safe because every step is read before the next one is
+    written.
+    """
+    def __init__(self, capacity: int, name: Optional[str] = None):
+        self.capacity = capacity
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=capacity * 4)
+        self.array = np.ndarray((capacity,), dtype=np.int32, buffer=self.shm.buf)
+        self.head = 0
+
+    def reserve(self, length: int) -> Tuple[int, np.ndarray]:
+        if length > self.capacity:
+            raise ValueError(f"Message of {length} ints does not fit in a ring of {self.capacity}")
+        if self.head + length > self.capacity:
+            self.head = 0
+        offset = self.head
+        self.head += length
+        return offset, self.array[offset:offset + length]
+
+    def read(self, offset: int, length: int) -> np.ndarray:
+        return self.array[offset:offset + length]
+
+    def close(self, unlink: bool = False):
+        self.array = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+    def __getstate__(self):
+        # Other processes attach to the same segment by name
+        return {'name': self.shm.name, 'capacity': self.capacity}
+
+    def __setstate__(self, state):
+        self.__init__(state['capacity'], state['name'])
+
+class ShmChannel:
+    """Executor <-> worker transport: token ids in shared memory, control on a pipe.
+
+    A forward step writes `[n, handles[n], context_lens[n], lengths[n],
+    num_blocks[n], do_sample[n], num_speculative[n], tokens...,
+    blocks...]` into the request ring and sends `('forward', offset,
+    length)`; the worker answers with `[counts[n], tokens...]` in the
+    response ring and `('tokens', offset, length)`: one sampled token per
+    sequence, none for those fed only part of their prompt and up to
+    `num_speculative + 1` for speculating ones. The answer also carries
+    the worker's stats, so they are never asked for. Sequences
+    are named by small integer handles, so nothing on the hot path is
+    pickled except these tuples. Rare messages such as block swaps and
+    trace requests travel on the pipe as is.
+    """
+    def __init__(self, request_capacity: int, response_capacity: int):
+        self.requests = ShmRingBuffer(request_capacity)
+        self.responses = ShmRingBuffer(response_capacity)
+        self.executor_conn, self.worker_conn = mp.Pipe()
+
+    # executor side
+    def send_batch(self, handles: Sequence[int], context_lens: Sequence[int],
+                   token_id_lists: Sequence[Sequence[int]], block_tables: Sequence[Sequence[int]],
+                   do_sample: Optional[Sequence[bool]] = None, num_speculative: Optional[Sequence[int]] = None):
+        n = len(handles)
+        lengths = [len(token_ids) for token_ids in token_id_lists]
+        num_blocks = [len(block_table) for block_table in block_tables]
+        num_tokens = sum(lengths)
+        total_blocks = sum(num_blocks)
+        offset, packed = self.requests.reserve(1 + 6 * n + num_tokens + total_blocks)
+        packed[0] = n
+        packed[1:n + 1] = handles
+        packed[n + 1:2 * n + 1] = context_lens
+        packed[2 * n + 1:3 * n + 1] = lengths
+        packed[3 * n + 1:4 * n + 1] = num_blocks
+        packed[4 * n + 1:5 * n + 1] = 1 if do_sample is None else do_sample
+        packed[5 * n + 1:6 * n + 1] = 0 if num_speculative is None else num_speculative
+        # One bulk copy for all sequences instead of a slice assignment per sequence
+        start = 6 * n + 1
+        packed[start:start + num_tokens] = np.fromiter(chain.from_iterable(token_id_lists), dtype=np.int32, count=num_tokens)
+        packed[start + num_tokens:] = np.fromiter(chain.from_iterable(block_tables), dtype=np.int32, count=total_blocks)
+        self.executor_conn.send(('forward', offset, len(packed)))
+
+    def send(self, message: Any):
+        self.executor_conn.send(message)
+
+    def resize_requests(self, capacity: int):
+        """Swap in a request ring of a new size; pipe order makes the worker attach before the next step."""
+        if capacity == self.requests.capacity:
+            return
+        old = self.requests
+        self.requests = ShmRingBuffer(capacity)
+        self.executor_conn.send(('attach', self.requests))
+        old.close(unlink=True)
+
+    def recv_tokens(self, n: int) -> Tuple[List[List[int]], Any]:
+        """The tokens sampled for each of the n sequences of the last step, and the stats sent with them."""
+        message = self.executor_conn.recv()
+        if message[0] == 'error':
+            raise RuntimeError(f"Worker failed: {message[1]}")
+        _, offset, length, stats = message
+        values = self.responses.read(offset, length).tolist()
+        token_id_lists = []
+        position = n
+        for count in values[:n]:
+            token_id_lists.append(values[position:position + count])
+            position += count
+        return token_id_lists, stats
+
+    def recv(self) -> Any:
+        message = self.executor_conn.recv()
+        if message[0] == 'error':
+            raise RuntimeError(f"Worker failed: {message[1]}")
+        return message
+
+    # worker side
+    def recv_task(self) -> Any:
+        return self.worker_conn.recv()
+
+    def read_batch(self, offset: int, length: int
+                   ) -> Tuple[List[int], List[int], List[List[int]], List[List[int]], List[bool], List[int]]:
+        """Unpack a forward step into handles, cached lengths, new token ids, block tables,
+        sample flags and speculative token counts."""
+        packed = self.requests.read(offset, length)
+        n = int(packed[0])
+        handles = packed[1:n + 1].tolist()
+        context_lens = packed[n + 1:2 * n + 1].tolist()
+        lengths = packed[2 * n + 1:3 * n + 1].tolist()
+        num_blocks = packed[3 * n + 1:4 * n + 1].tolist()
+        do_sample = (packed[4 * n + 1:5 * n + 1] != 0).tolist()
+        num_speculative = packed[5 * n + 1:6 * n + 1].tolist()
+        values = packed[6 * n + 1:].tolist()
+        token_id_lists = []
+        position = 0
+        for length in lengths:
+            token_id_lists.append(values[position:position + length])
+            position += length
+        block_tables = []
+        for length in num_blocks:
+            block_tables.append(values[position:position + length])
+            position += length
+        return handles, context_lens, token_id_lists, block_tables, do_sample, num_speculative
+
+    def attach_requests(self, requests: ShmRingBuffer):
+        self.requests.close()
+        self.requests = requests
+
+    def send_tokens(self, token_id_lists: Sequence[Sequence[int]], stats: Any = None):
+        n = len(token_id_lists)
+        counts = [len(token_ids) for token_ids in token_id_lists]
+        num_tokens = sum(counts)
+        offset, packed = self.responses.reserve(n + num_tokens)
+        packed[:n] = counts
+        packed[n:] = np.fromiter(chain.from_iterable(token_id_lists), dtype=np.int32, count=num_tokens)
+        self.worker_conn.send(('tokens', offset, len(packed), stats))
+
+    def reply(self, message: Any):
+        self.worker_conn.send(message)
+
+    def close(self, unlink: bool = False):
+        self.requests.close(unlink)
+        self.responses.close(unlink)
@@ -0,0 +1,69 @@
+from typing import List, Optional, Tuple
+import numpy as np
+import torch
+from .sampler import sample
+
+class NgramProposer:
+    """Prompt lookup: guess the next tokens from an earlier occurrence of the sequence's last n-gram.
+
+    Outputs that quote, summarize or edit their prompt repeat long runs of
+    it, and this finds them without a second model. The longest n-gram
+    from `max_n` down to `min_n` that appears earlier wins, and its most
+    recent earlier occurrence supplies the tokens that followed it.
+    """
+    def __init__(self, min_n: int, max_n: int):
+        self.min_n = min_n
+        self.max_n = max_n
+
+    def propose(self, token_ids: np.ndarray, k: int) -> List[int]:
+        """Up to k tokens to follow token_ids, none if their tail never occurred before."""
+        length = len(token_ids)
+        for n in range(min(self.max_n, length - 1), self.min_n - 1, -1):
+            # Windows starting before the tail itself, compared all at once
+            windows = np.lib.stride_tricks.sliding_window_view(token_ids[:length - 1], n)
+            matches = np.flatnonzero((windows == token_ids[length - n:]).all(axis=1))
+            if len(matches):
+                start = int(matches[-1]) + n
+                return token_ids[start:start + k].tolist()
+        return []
+
+
+def rejection_sample(target_probs: torch.Tensor, draft_token_ids: torch.Tensor,
+                     num_draft_tokens: torch.Tensor, draft_probs: Optional[torch.Tensor] = None
+                     ) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Verify draft tokens so the output follows the model's own distribution exactly.
+
+    Row r proposed `draft_token_ids[r, :num_draft_tokens[r]]`; `target_probs`
+    `[rows, k + 1, vocab]` are the model's distributions at the position of
+    each proposal and one past the last. Draft token i is accepted with
+    probability min(1, p(x) / q(x)), where q is the draft's distribution, or
+    a point mass on the proposal when `draft_probs` is None, as for n-gram
+    lookup. The first rejected position draws its token from the normalized
+    residual max(p - q, 0) instead; when every proposal is accepted a bonus
+    token comes from the last distribution. Returns the accepted count of
+    each row and the token following them, so each row yields
+    `num_accepted + 1` tokens.
+    """
+    num_rows, k = draft_token_ids.shape
+    rows = torch.arange(num_rows, device=target_probs.device)
+    p = target_probs[:, :k].gather(-1, draft_token_ids[..., None]).squeeze(-1)
+    q = torch.ones_like(p) if draft_probs is None else draft_probs.gather(-1, draft_token_ids[..., None]).squeeze(-1)
+    accepted = torch.rand_like(p) * q < p
+    accepted &= torch.arange(k, device=p.device) < num_draft_tokens[:, None]
+    # Only the leading run of acceptances counts
+    num_accepted = accepted.long().cumprod(dim=-1).sum(dim=-1)
+
+    next_probs = target_probs[rows, num_accepted]
+    rejected = num_accepted < num_draft_tokens
+    position = num_accepted.clamp(max=k - 1)
+    if draft_probs is None:
+        rejected_probs = torch.zeros_like(next_probs)
+        rejected_probs[rows, draft_token_ids[rows, position]] = 1.0
+    else:
+        rejected_probs = draft_probs[rows, position]
+    residual = (next_probs - rejected_probs).clamp(min=0)
+    mass = residual.sum(dim=-1, keepdim=True)
+    # p == q leaves no residual, but then the proposal is never rejected
+    residual = torch.where(mass > 0, residual / mass.clamp(min=1e-12), next_probs)
+    next_tokens = sample(torch.where(rejected[:, None], residual, next_probs))
+    return num_accepted, next_tokens
@@ -0,0 +1,63 @@
+from functools import lru_cache
+from typing import Dict, List, Sequence, Tuple
+
+class StopStringMatcher:
+    """Aho-Corasick automaton over a request's stop strings.
+
+    Text is fed as it is detokenized; the automaton state carries over
+    between deltas, so a stop string split across tokens is found without
+    rescanning earlier text, and each character costs the same however
+    many stop strings there are. `held_back(state)` is the length of the
+    longest text suffix that may still grow into a stop string; streaming
+    keeps that much text back until it is decided.
+    """
+    def __init__(self, stop: Sequence[str]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.depth = [0]
+        # Length of the longest stop string ending at the state, 0 if none
+        self.match = [0]
+        for pattern in stop:
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.depth.append(self.depth[state] + 1)
+                    self.match.append(0)
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.match[state] = max(self.match[state], len(pattern))
+
+        # Failure links in breadth-first order, so a state's link is done before its children
+        self.fail = [0] * len(self.goto)
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, child in self.goto[state].items():
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                link = self.goto[fallback].get(char, 0)
+                self.fail[child] = link if link != child else 0
+                self.match[child] = max(self.match[child], self.match[self.fail[child]])
+                queue.append(child)
+
+    def held_back(self, state: int) -> int:
+        return self.depth[state]
+
+    def feed(self, state: int, text: str, start: int = 0) -> Tuple[int, int]:
+        """Scan text[start:] from state; returns the new state and where the
+        first stop string in text begins, or -1."""
+        goto, fail, match = self.goto, self.fail, self.match
+        for index in range(start, len(text)):
+            char = text[index]
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if match[state]:
+                return state, index + 1 - match[state]
+        return state, -1
+
+
+@lru_cache(maxsize=256)
+def get_matcher(stop: Tuple[str, ...]) -> StopStringMatcher:
+    """Requests usually share a few stop lists; build each automaton once."""
+    return StopStringMatcher([pattern for pattern in stop if pattern])
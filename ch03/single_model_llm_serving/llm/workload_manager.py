@@ -1,75 +1,682 @@
 import uuid
-from typing import List, Dict, Any, Optional
-from queue import Queue
-import asyncio
+import threading
+import time
+from array import array
+from collections import deque
+from concurrent.futures import Future
+from typing import List, Dict, Any, Deque, Iterable, Optional, Tuple
+import numpy as np
+from .admission import AdmissionController
+from .block_manager import BlockManager
+from .config import AdmissionConfig, AdmissionLimits, CacheConfig, SchedulerConfig, SpeculativeConfig
+from .policy import get_policy
+from .sampling_params import SamplingParams
+from .scheduling_params import SchedulingParams
+from .spec_decode import NgramProposer
+
+# Shared by requests that bring no SamplingParams; nothing mutates it
+_DEFAULT_SAMPLING_PARAMS = SamplingParams()
+_DEFAULT_SCHEDULING_PARAMS = SchedulingParams()
 
 class Sequence:
-    def __init__(self, seq_id: str, prompt: str, client_stream, loop):
+    """A request's token ids; text only exists at the engine's edges.
+
+    Token ids live in compact `array('i')` buffers and `__slots__` avoids a
+    per-instance `__dict__`, so thousands of queued sequences stay small.
+    Streaming sequences push tokens into `client_stream` on `loop`; the others
+    complete `future` from the engine thread when they finish.
+    `num_computed_tokens` counts the tokens whose KV is cached on worker
+    `replica`; preemption by recompute resets it, so the next step feeds the
+    prompt and the output so far again. `prefix_offset`, `read_offset` and
+    `output_text` belong to the engine's IncrementalDetokenizer. Deadlines
+    are absolute `time.monotonic()` values, None without an SLO, and so
+    are the times of its first step, first and latest output tokens the
+    engine's metrics keep, None until they happen. The
+    speculative decoding counters tell how many proposed tokens were
+    verified and accepted over how many steps that produced output.
+    """
+    __slots__ = ('id', 'prompt_token_ids', 'output_token_ids', 'finished', 'loop', 'client_stream', 'future',
+                 'num_computed_tokens', 'replica', 'sampling_params', 'prefix_offset', 'read_offset',
+                 'output_text', 'stop_state', 'priority', 'arrival_time', 'ttft_deadline', 'deadline',
+                 'first_scheduled_time', 'first_token_time', 'last_token_time',
+                 'num_proposed_tokens', 'num_accepted_tokens', 'num_output_steps')
+
+    def __init__(self, seq_id: str, prompt_token_ids: Iterable[int], client_stream, loop, future: Optional[Future] = None,
+                 sampling_params: Optional[SamplingParams] = None, scheduling_params: Optional[SchedulingParams] = None):
         self.id = seq_id
-        self.prompt = prompt
-        self.output = []
+        self.prompt_token_ids = array('i', prompt_token_ids)
+        self.output_token_ids = array('i')
         self.finished = False
         self.loop = loop
         self.client_stream = client_stream
-        self.token_count = 0
+        self.future = future
+        self.num_computed_tokens = 0
+        self.replica: Optional[int] = None
+        self.sampling_params = sampling_params or _DEFAULT_SAMPLING_PARAMS
+        # Streamed text: tokens from prefix_offset are decoded as context,
+        # those from read_offset on are not sent yet. A few prompt tokens
+        # give the first output token its leading space.
+        self.read_offset = len(self.prompt_token_ids)
+        self.prefix_offset = max(self.read_offset - 5, 0)
+        # Detokenized output and stop string matcher state, kept for
+        # streaming sequences and those with stop strings
+        self.output_text = ""
+        self.stop_state = 0
+        scheduling_params = scheduling_params or _DEFAULT_SCHEDULING_PARAMS
+        self.priority = scheduling_params.priority
+        self.arrival_time = time.monotonic()
+        self.ttft_deadline = self.deadline = None
+        if scheduling_params.ttft_slo_s is not None:
+            self.ttft_deadline = self.arrival_time + scheduling_params.ttft_slo_s
+        if scheduling_params.deadline_s is not None:
+            self.deadline = self.arrival_time + scheduling_params.deadline_s
+        self.first_scheduled_time: Optional[float] = None
+        self.first_token_time: Optional[float] = None
+        self.last_token_time: Optional[float] = None
+        self.num_proposed_tokens = 0
+        self.num_accepted_tokens = 0
+        self.num_output_steps = 0
+
+    @property
+    def token_count(self) -> int:
+        return len(self.output_token_ids)
+
+    def get_token_ids(self) -> List[int]:
+        return self.prompt_token_ids.tolist() + self.output_token_ids.tolist()
+
+    def get_token_ids_from(self, start: int) -> List[int]:
+        num_prompt_tokens = len(self.prompt_token_ids)
+        if start >= num_prompt_tokens:
+            return self.output_token_ids[start - num_prompt_tokens:].tolist()
+        return self.prompt_token_ids[start:].tolist() + self.output_token_ids.tolist()
+
+    def next_token_ids(self) -> List[int]:
+        """Token ids the worker has not computed yet: the prompt, then the last output."""
+        return self.get_token_ids_from(self.num_computed_tokens)
+
+    def speculative_stats(self) -> Optional[Dict[str, float]]:
+        """Proposed and accepted tokens and output tokens per step; None if nothing was proposed."""
+        if not self.num_proposed_tokens:
+            return None
+        return {
+            'proposed_tokens': self.num_proposed_tokens,
+            'accepted_tokens': self.num_accepted_tokens,
+            'acceptance_rate': self.num_accepted_tokens / self.num_proposed_tokens,
+            'tokens_per_step': self.token_count / max(self.num_output_steps, 1),
+        }
+
+class SchedulerOutput:
+    """The sequences to run in one engine step, their worker prompts and KV block moves."""
+    __slots__ = ('sequences', 'prompts', 'num_prefill_tokens', 'num_decode_tokens',
+                 'blocks_to_swap_out', 'blocks_to_swap_in', 'num_preempted', 'finished', 'aborted')
 
-class WorkloadManager:
     def __init__(self):
-        self.incoming_queue: Queue[Sequence] = Queue()
-        self.active_sequences: List[Sequence] = []
-        
-        self.incoming_streaming_queue: Queue[Sequence] = Queue()
-        self.active_streaming_sequences: List[Sequence] = []
-        self.batch_size = 4  # Process up to 4 sequences at a time
+        self.sequences: List[Sequence] = []
+        # One {'request_id', 'token_ids', 'context_len', 'block_table', 'replica', 'sampling_params',
+        # 'do_sample'} per sequence; admissions add 'all_token_ids' and
+        # 'num_prompt_tokens' so the worker's sampler knows the history behind penalties,
+        # speculating sequences 'num_speculative_tokens' and n-gram 'proposal_token_ids'
+        self.prompts: List[Dict[str, Any]] = []
+        self.num_prefill_tokens = 0
+        self.num_decode_tokens = 0
+        # replica index -> [(source block, destination block)]
+        self.blocks_to_swap_out: Dict[int, List[Tuple[int, int]]] = {}
+        self.blocks_to_swap_in: Dict[int, List[Tuple[int, int]]] = {}
+        self.num_preempted = 0
+        # Sequences that outgrew a whole worker's KV cache and end here
+        self.finished: List[Sequence] = []
+        # Sequences whose client went away, dropped with their KV blocks
+        self.aborted: List[Sequence] = []
+
+    @property
+    def num_batched_tokens(self) -> int:
+        return self.num_prefill_tokens + self.num_decode_tokens
+
+class WorkloadManager:
+    """Iteration-level scheduler shared by streaming and non-streaming requests.
+
+    Every engine step calls `schedule()`, which keeps running sequences
+    decoding and admits waiting ones while `max_num_seqs`,
+    `max_num_batched_tokens` and the free KV blocks allow it. Finished
+    sequences leave the running set and return their blocks as soon as the
+    engine reports them, so their slot is reused on the next step.
+
+    With `prefill_chunk_size`, a step prefills at most that many prompt
+    tokens, after every decode token: a long prompt is fed in chunks over
+    several steps instead of stalling all decoding sequences for one long
+    step, and it may be longer than `max_num_batched_tokens`. A sequence
+    whose prompt is not all fed yet stays running but gets no token.
+
+    With `block_managers`, one per worker replica, a new sequence is placed
+    on the replica that caches the longest prefix of its tokens, then the
+    one with the most free blocks; the cached part is not prefilled again. When a running sequence needs
+    a block and none is free, the most recently admitted sequence on that
+    replica is preempted: its blocks are swapped out to host memory, or
+    freed so it is recomputed from its tokens later. Swapped sequences
+    resume before new ones are admitted. Without block managers memory is
+    not accounted for.
+
+    The scheduling `policy` orders all of this. Under FCFS the queues keep
+    arrival order and "most recently admitted" decides preemption. Other
+    policies re-sort running, swapped and waiting sequences every step, so
+    the least urgent running sequence is preempted first, and may let the
+    most urgent waiting sequence preempt running ones it outranks when
+    there are no blocks or slots left for it.
+
+    Waiting is event driven: the engine loop blocks on `has_work` until a
+    request arrives.
+
+    `abort_sequence` may be called from any thread; the sequence is only
+    marked, and the next `schedule()` drops it wherever it is, so a step in
+    flight never loses a sequence under its feet.
+
+    New requests pass the `admission` controller first, against the prompt
+    tokens still queued and the output tokens promised to unfinished
+    requests; both counts are kept up to date as sequences move.
+
+    With a `speculative` method, budget and free blocks the step leaves
+    over go to decoding sequences as proposed tokens for the model to
+    verify along with their next token. Proposals never preempt anyone,
+    and sequences with penalties do not speculate, because their
+    distribution would change with every accepted token.
+    """
+    def __init__(self, config: Optional[SchedulerConfig] = None, cache_config: Optional[CacheConfig] = None,
+                 block_managers: Optional[List[BlockManager]] = None, admission_config: Optional[AdmissionConfig] = None,
+                 speculative_config: Optional[SpeculativeConfig] = None, max_model_len: Optional[int] = None):
+        self.config = config or SchedulerConfig()
+        self.cache_config = cache_config or CacheConfig()
+        self.block_managers = block_managers or []
+        self.waiting: Deque[Sequence] = deque()
+        self.running: List[Sequence] = []
+        self.swapped: Deque[Sequence] = deque()
         self.sequence_map: Dict[str, Sequence] = {}
+        self.num_preemptions = 0
+        # Prompt tokens looked up in the prefix cache and found there
+        self.num_prefix_query_tokens = 0
+        self.num_prefix_hit_tokens = 0
+        # Ids of sequences to drop on the next step, in abort order
+        self.aborted: Dict[str, None] = {}
+        self.num_aborted = 0
+        # Tokens aborted sequences would still have run through the model
+        self.num_aborted_saved_tokens = 0
+        self.admission = AdmissionController(admission_config)
+        # Tokens of waiting sequences, and output tokens unfinished
+        # sequences may still generate
+        self.num_queued_prompt_tokens = 0
+        self.num_pending_decode_tokens = 0
+        self.policy = get_policy(self.config.policy)
+        # Sequences that got their first token or finished after their deadline
+        self.num_ttft_slo_missed = 0
+        self.num_deadline_missed = 0
+        self.speculative_config = speculative_config or SpeculativeConfig()
+        self.proposer = None
+        if self.speculative_config.method == "ngram":
+            self.proposer = NgramProposer(self.speculative_config.prompt_lookup_min,
+                                          self.speculative_config.prompt_lookup_max)
+        # Proposals must not run past the positions the model has embeddings for
+        self.max_model_len = max_model_len
+        # Speculative tokens verified and accepted, and output tokens over steps that produced them
+        self.num_proposed_tokens = 0
+        self.num_accepted_tokens = 0
+        self.num_output_tokens = 0
+        self.num_output_steps = 0
+        self.lock = threading.Lock()
+        self.has_work = threading.Condition(self.lock)
+    
+    # for batch generate; the future resolves to the finished Sequence
+    def add_request(self, prompt_token_ids: List[int], future: Optional[Future] = None,
+                    sampling_params: Optional[SamplingParams] = None,
+                    limits: Optional[AdmissionLimits] = None,
+                    scheduling_params: Optional[SchedulingParams] = None) -> str:
+        return self.add_requests([prompt_token_ids], [future], sampling_params, limits, scheduling_params)[0]
     
-    # for basic generate and batch generate        
-    def add_request(self, prompt: str) -> str:
-        request_id = str(uuid.uuid4())
-        sequence = Sequence(request_id, prompt, None, None)
-        self.incoming_queue.put(sequence)
-        self.sequence_map[request_id] = sequence
-        return request_id
+    def add_requests(self, prompt_token_id_lists: List[List[int]], futures: List[Optional[Future]],
+                     sampling_params: Optional[SamplingParams] = None,
+                     limits: Optional[AdmissionLimits] = None,
+                     scheduling_params: Optional[SchedulingParams] = None) -> List[str]:
+        """Queue the prompts of one request together; all are admitted or none."""
+        return self._add_sequences([
+            Sequence(str(uuid.uuid4()), prompt_token_ids, None, None, future, sampling_params, scheduling_params)
+            for prompt_token_ids, future in zip(prompt_token_id_lists, futures)
+        ], limits)
     
     # for streaming generate
-    def add_streaming_request(self, prompt: str, client_stream, loop) -> str:
-        request_id = str(uuid.uuid4())
-        sequence = Sequence(request_id, prompt, client_stream, loop)
-        self.incoming_streaming_queue.put(sequence)
-        self.sequence_map[request_id] = sequence
-        return request_id
-    
-    def get_next_batch(self, is_streaming: bool = False) -> List[Sequence]:
-        if is_streaming:
-            while len(self.active_streaming_sequences) < self.batch_size and not self.incoming_streaming_queue.empty():
-                sequence = self.incoming_streaming_queue.get()
-                self.active_streaming_sequences.append(sequence)
-        
-            return self.active_streaming_sequences
+    def add_streaming_request(self, prompt_token_ids: List[int], client_stream, loop,
+                              sampling_params: Optional[SamplingParams] = None,
+                              limits: Optional[AdmissionLimits] = None,
+                              scheduling_params: Optional[SchedulingParams] = None) -> str:
+        return self._add_sequences([Sequence(str(uuid.uuid4()), prompt_token_ids, client_stream, loop,
+                                             sampling_params=sampling_params,
+                                             scheduling_params=scheduling_params)], limits)[0]
+    
+    def _add_sequences(self, sequences: List[Sequence], limits: Optional[AdmissionLimits]) -> List[str]:
+        for sequence in sequences:
+            if self.config.prefill_chunk_size is None and \
+                    len(sequence.prompt_token_ids) > self.config.max_num_batched_tokens:
+                raise ValueError(
+                    f"Prompt has {len(sequence.prompt_token_ids)} tokens, more than "
+                    f"max_num_batched_tokens={self.config.max_num_batched_tokens}"
+                )
+            if self.block_managers and not any(
+                manager.num_blocks * manager.block_size > len(sequence.prompt_token_ids)
+                for manager in self.block_managers
+            ):
+                raise ValueError(f"Prompt has {len(sequence.prompt_token_ids)} tokens, more than any worker's KV cache holds")
+        with self.lock:
+            self._admit(sequences, limits)
+            for sequence in sequences:
+                self.sequence_map[sequence.id] = sequence
+                self.waiting.append(sequence)
+            self.has_work.notify()
+        return [sequence.id for sequence in sequences]
+    
+    def _admit(self, sequences: List[Sequence], limits: Optional[AdmissionLimits]):
+        """Check new sequences against the admission limits and count them as queued."""
+        num_prompt_tokens = sum(len(sequence.prompt_token_ids) for sequence in sequences)
+        num_decode_tokens = sum(sequence.sampling_params.max_tokens for sequence in sequences)
+        self.admission.check(limits, self.num_queued_prompt_tokens, self.num_pending_decode_tokens,
+                             num_prompt_tokens, num_decode_tokens)
+        self.num_queued_prompt_tokens += num_prompt_tokens
+        self.num_pending_decode_tokens += num_decode_tokens
+    
+    def _dequeue(self, sequence: Sequence):
+        self.num_queued_prompt_tokens -= len(sequence.prompt_token_ids) + len(sequence.output_token_ids)
+    
+    def _retire(self, sequence: Sequence):
+        """Mark a sequence finished and drop the output tokens it will no longer generate."""
+        if not sequence.finished:
+            sequence.finished = True
+            self.num_pending_decode_tokens -= max(0, sequence.sampling_params.max_tokens - sequence.token_count)
+    
+    def wait_for_work(self, timeout: Optional[float] = None) -> bool:
+        """Block until there is a waiting or running sequence; returns False on timeout."""
+        with self.lock:
+            return self.has_work.wait_for(
+                lambda: self.waiting or self.running or self.swapped or self.aborted, timeout
+            )
+    
+    def schedule(self) -> SchedulerOutput:
+        """Pick the sequences for the next engine step and reserve their KV blocks."""
+        output = SchedulerOutput()
+        budget = self.config.max_num_batched_tokens
+        with self.lock:
+            self._drop_aborted(output)
+            if self.policy.reorders:
+                # Deadlines draw nearer and first tokens come out, so urgency
+                # is only known now
+                self.running = self.policy.sort(self.running)
+                self.swapped = deque(self.policy.sort(self.swapped))
+                self.waiting = deque(self.policy.sort(self.waiting))
+                self._preempt_for_waiting(output)
+            num_priority_preempted = output.num_preempted
+            
+            # Running sequences decode one token each and go first, most
+            # urgent (under FCFS oldest) first, so preemption victims come
+            # from the back of the list
+            prefilling = []
+            for sequence in list(self.running):
+                if sequence not in self.running:
+                    # Already preempted for an older sequence in this step
+                    continue
+                token_ids = sequence.next_token_ids()
+                if len(token_ids) > 1:
+                    # Part of its prompt is still to be fed; that comes after every decode
+                    prefilling.append(sequence)
+                    continue
+                if output.num_batched_tokens + len(token_ids) > budget:
+                    break
+                if self._reserve(sequence, len(token_ids), output, self.running):
+                    self._schedule_sequence(sequence, sequence.replica, token_ids, output)
+                    output.num_decode_tokens += len(token_ids)
+            
+            # The next chunk of partly prefilled prompts; decodes are scheduled
+            # already, so only these sequences may give way for each other
+            for sequence in prefilling:
+                if sequence not in self.running:
+                    continue
+                token_ids = sequence.next_token_ids()
+                num_tokens = self._num_prefill_tokens(len(token_ids), output)
+                if not num_tokens:
+                    break
+                candidates = [candidate for candidate in prefilling if candidate in self.running]
+                if self._reserve(sequence, num_tokens, output, candidates):
+                    self._schedule_sequence(sequence, sequence.replica, token_ids[:num_tokens], output)
+                    output.num_prefill_tokens += num_tokens
+            
+            # Swapped sequences come back before anything new is admitted
+            while not output.num_preempted and self.swapped and len(self.running) < self.config.max_num_seqs:
+                sequence = self.swapped[0]
+                if self.waiting and self.policy.preempts(self.waiting[0], sequence):
+                    # It would only take back the room kept for a more urgent one
+                    break
+                token_ids = sequence.next_token_ids()
+                # Swapped out halfway through its prompt, it goes on chunk by chunk
+                is_prefill = len(token_ids) > 1
+                num_tokens = self._num_prefill_tokens(len(token_ids), output) if is_prefill else len(token_ids)
+                manager = self.block_managers[sequence.replica]
+                if not num_tokens or output.num_batched_tokens + num_tokens > budget or \
+                        not manager.can_swap_in(sequence.id, sequence.num_computed_tokens + num_tokens):
+                    break
+                self.swapped.popleft()
+                output.blocks_to_swap_in.setdefault(sequence.replica, []).extend(manager.swap_in(sequence.id))
+                self.running.append(sequence)
+                self._schedule_sequence(sequence, sequence.replica, token_ids[:num_tokens], output)
+                if is_prefill:
+                    output.num_prefill_tokens += num_tokens
+                else:
+                    output.num_decode_tokens += num_tokens
+            
+            # Admit waiting sequences in policy order while there is room;
+            # a sequence longer than the budget still runs alone. Running
+            # sequences short of blocks and swapped ones come first, unless
+            # the policy ranks the waiting sequence above them.
+            while self.waiting and output.num_preempted == num_priority_preempted \
+                    and (not self.swapped or self.policy.preempts(self.waiting[0], self.swapped[0])) \
+                    and len(self.running) < self.config.max_num_seqs:
+                sequence = self.waiting[0]
+                all_token_ids = sequence.get_token_ids()
+                replica, cached_blocks = self._place(sequence, all_token_ids)
+                if replica is None and self.block_managers:
+                    if not any(self._fits(sequence, index, len(all_token_ids)) for index in range(len(self.block_managers))):
+                        self.waiting.popleft()
+                        self._dequeue(sequence)
+                        self._finish_oversized(sequence, output)
+                        continue
+                    break
+                # Cached blocks are not fed again, but the last token always
+                # is because its logits pick the next one
+                num_cached_tokens = min(len(cached_blocks) * self.cache_config.block_size, len(all_token_ids) - 1) if cached_blocks else 0
+                token_ids = all_token_ids[num_cached_tokens:]
+                num_tokens = self._num_prefill_tokens(len(token_ids), output)
+                if not num_tokens or output.sequences and output.num_batched_tokens + num_tokens > budget:
+                    break
+                self.waiting.popleft()
+                self._dequeue(sequence)
+                self.running.append(sequence)
+                sequence.num_computed_tokens = num_cached_tokens
+                self._schedule_sequence(sequence, replica, token_ids[:num_tokens], output, cached_blocks, all_token_ids)
+                output.num_prefill_tokens += num_tokens
+                self.num_prefix_query_tokens += len(all_token_ids)
+                self.num_prefix_hit_tokens += num_cached_tokens
+            
+            if self.speculative_config.method is not None:
+                self._speculate(output)
+            
+            if output.num_batched_tokens:
+                self.admission.record_step(output.num_batched_tokens)
+        return output
+    
+    def _speculate(self, output: SchedulerOutput):
+        """Let decoding sequences verify proposed tokens with the budget and free blocks left over."""
+        config = self.speculative_config
+        for sequence, prompt in zip(output.sequences, output.prompts):
+            room = self.config.max_num_batched_tokens - output.num_batched_tokens
+            if room <= 0:
+                break
+            if not prompt['do_sample'] or not prompt['context_len'] or len(prompt['token_ids']) != 1 \
+                    or sequence.sampling_params.has_penalties:
+                continue
+            # The step yields up to k + 1 tokens; more than the sequence may still have are wasted
+            k = min(config.num_speculative_tokens, room, sequence.sampling_params.max_tokens - sequence.token_count - 1)
+            if self.max_model_len is not None:
+                k = min(k, self.max_model_len - sequence.num_computed_tokens)
+            if k <= 0:
+                continue
+            proposals = []
+            if self.proposer is not None:
+                proposals = self.proposer.propose(np.concatenate((
+                    np.frombuffer(sequence.prompt_token_ids, dtype=np.int32),
+                    np.frombuffer(sequence.output_token_ids, dtype=np.int32)
+                )), k)
+                k = len(proposals)
+                if not k:
+                    continue
+            if self.block_managers:
+                manager = self.block_managers[sequence.replica]
+                if not manager.can_allocate(sequence.id, sequence.num_computed_tokens + k):
+                    continue
+                prompt['block_table'] = manager.allocate(sequence.id, sequence.num_computed_tokens + k)
+            prompt['num_speculative_tokens'] = k
+            if proposals:
+                prompt['proposal_token_ids'] = proposals
+            output.num_decode_tokens += k
+            sequence.num_proposed_tokens += k
+            self.num_proposed_tokens += k
+    
+    def _num_prefill_tokens(self, num_tokens: int, output: SchedulerOutput) -> int:
+        """How many of a sequence's num_tokens uncomputed tokens this step feeds."""
+        if self.config.prefill_chunk_size is None:
+            return num_tokens
+        room = min(self.config.prefill_chunk_size - output.num_prefill_tokens,
+                   self.config.max_num_batched_tokens - output.num_batched_tokens)
+        return max(0, min(num_tokens, room))
+    
+    def _reserve(self, sequence: Sequence, num_new_tokens: int, output: SchedulerOutput,
+                 candidates: List[Sequence]) -> bool:
+        """Make room for a running sequence's new tokens, preempting the last of
+        candidates on its replica; False if the sequence itself had to go."""
+        if not self._fits(sequence, sequence.replica, num_new_tokens):
+            self._finish_oversized(sequence, output)
+            return False
+        while not self._can_allocate(sequence, sequence.replica, num_new_tokens):
+            victim = self._preemption_victim(sequence.replica, candidates)
+            self._preempt(victim, output)
+            if victim is sequence:
+                return False
+        return True
+    
+    def _can_allocate(self, sequence: Sequence, replica: Optional[int], num_new_tokens: int) -> bool:
+        if not self.block_managers:
+            return True
+        return self.block_managers[replica].can_allocate(sequence.id, sequence.num_computed_tokens + num_new_tokens)
+    
+    def _fits(self, sequence: Sequence, replica: Optional[int], num_new_tokens: int) -> bool:
+        """Whether the replica's whole KV cache could hold the sequence."""
+        if not self.block_managers:
+            return True
+        manager = self.block_managers[replica]
+        return sequence.num_computed_tokens + num_new_tokens <= manager.num_blocks * manager.block_size
+    
+    def _finish_oversized(self, sequence: Sequence, output: SchedulerOutput):
+        if sequence in self.running:
+            self.running.remove(sequence)
+        self._free_blocks(sequence)
+        self._retire(sequence)
+        output.finished.append(sequence)
+    
+    def _place(self, sequence: Sequence, token_ids: List[int],
+               reserve_growth: bool = False) -> Tuple[Optional[int], List[int]]:
+        """The replica with the longest cached prefix, then the most free blocks, that fits the sequence.
+
+        With `reserve_growth` the blocks its running sequences need for
+        their next token this step stay free.
+        """
+        best, best_key, best_blocks = None, None, []
+        for index, manager in enumerate(self.block_managers):
+            cached_blocks = manager.lookup(token_ids)
+            num_reserved = sum(
+                manager.num_required_blocks(running.id, len(running.prompt_token_ids) + running.token_count)
+                for running in self.running if running.replica == index
+            ) if reserve_growth else 0
+            if not manager.can_allocate(sequence.id, len(token_ids), cached_blocks, num_reserved):
+                continue
+            key = (len(cached_blocks), manager.num_free_blocks)
+            if best_key is None or key > best_key:
+                best, best_key, best_blocks = index, key, cached_blocks
+        return best, best_blocks
+    
+    def _preemption_victim(self, replica: Optional[int], candidates: List[Sequence]) -> Sequence:
+        # Running is in policy order: the last sequence on the replica is the least urgent
+        return next(
+            sequence for sequence in reversed(candidates) if sequence.replica == replica and sequence in self.running
+        )
+    
+    def _preempt_for_waiting(self, output: SchedulerOutput):
+        """Preempt running sequences the most urgent waiting one outranks until it has a slot and blocks.
+
+        This runs before the running sequences are scheduled, so the blocks
+        they grow by this step are kept out of the room made. Victims come
+        from one replica, the first that could hold the sequence, least
+        urgent first.
+        """
+        if not self.block_managers or not self.waiting:
+            return
+        sequence = self.waiting[0]
+        if not any(self.policy.preempts(sequence, running) for running in self.running):
+            return
+        all_token_ids = sequence.get_token_ids()
+        replica = None
+        while len(self.running) >= self.config.max_num_seqs or \
+                self._place(sequence, all_token_ids, reserve_growth=True)[0] is None:
+            victim = next((
+                running for running in reversed(self.running)
+                if self.policy.preempts(sequence, running) and replica in (None, running.replica)
+                and self._fits(sequence, running.replica, len(all_token_ids))
+            ), None)
+            if victim is None:
+                break
+            replica = victim.replica
+            self._preempt(victim, output)
+        if output.num_preempted:
+            # Recomputed victims were put back at the front
+            self.waiting = deque(self.policy.sort(self.waiting))
+    
+    def _preempt(self, sequence: Sequence, output: SchedulerOutput):
+        manager = self.block_managers[sequence.replica]
+        self.running.remove(sequence)
+        if self.cache_config.preemption_mode == "swap" and manager.can_swap_out(sequence.id):
+            output.blocks_to_swap_out.setdefault(sequence.replica, []).extend(manager.swap_out(sequence.id))
+            self.swapped.append(sequence)
         else:
-            while len(self.active_sequences) < self.batch_size and not self.incoming_queue.empty():
-                sequence = self.incoming_queue.get()
-                self.active_sequences.append(sequence)
-                
-            return self.active_sequences
+            # Recompute: drop the blocks, the tokens are fed again on
+            # readmission unless their blocks are still cached by then
+            self._free_blocks(sequence)
+            sequence.num_computed_tokens = 0
+            sequence.replica = None
+            self.waiting.appendleft(sequence)
+            self.num_queued_prompt_tokens += len(sequence.prompt_token_ids) + len(sequence.output_token_ids)
+        output.num_preempted += 1
+        self.num_preemptions += 1
     
-    def remove_active_sequence(self, seq_id: str):
-        if seq_id in self.sequence_map:
-            sequence = self.sequence_map[seq_id]
-            if sequence in self.active_sequences:
-                self.active_sequences.remove(sequence)
-            if sequence in self.active_streaming_sequences:
-                self.active_streaming_sequences.remove(sequence)
+    def _schedule_sequence(self, sequence: Sequence, replica: Optional[int], token_ids: List[int],
+                           output: SchedulerOutput, cached_blocks: List[int] = (),
+                           all_token_ids: Optional[List[int]] = None):
+        block_table: List[int] = []
+        if self.block_managers:
+            manager = self.block_managers[replica]
+            self._cache_blocks(sequence, manager)
+            block_table = manager.allocate(sequence.id, sequence.num_computed_tokens + len(token_ids), cached_blocks)
+        sequence.replica = replica
+        output.sequences.append(sequence)
+        prompt = {
+            'request_id': sequence.id,
+            'token_ids': token_ids,
+            'context_len': sequence.num_computed_tokens,
+            'block_table': block_table,
+            'replica': replica,
+            'sampling_params': sequence.sampling_params,
+            # Only a step that feeds the last uncomputed token gets a next token
+            'do_sample': sequence.num_computed_tokens + len(token_ids) ==
+                         len(sequence.prompt_token_ids) + sequence.token_count,
+        }
+        if all_token_ids is not None:
+            prompt['all_token_ids'] = all_token_ids
+            prompt['num_prompt_tokens'] = len(sequence.prompt_token_ids)
+        output.prompts.append(prompt)
+        # The worker caches these tokens while running the step
+        sequence.num_computed_tokens += len(token_ids)
+    
+    def _cache_blocks(self, sequence: Sequence, manager: BlockManager):
+        # Blocks filled by earlier steps hold written KV and can be shared
+        if manager.has_uncached_full_blocks(sequence.id, sequence.num_computed_tokens):
+            manager.cache_full_blocks(sequence.id, sequence.get_token_ids(), sequence.num_computed_tokens)
+    
+    def _free_blocks(self, sequence: Sequence):
+        if self.block_managers and sequence.replica is not None:
+            manager = self.block_managers[sequence.replica]
+            self._cache_blocks(sequence, manager)
+            manager.free(sequence.id)
+    
+    def finish_sequence(self, seq_id: str):
+        """Evict a finished sequence from the running set; it stays readable until removed."""
+        with self.lock:
+            sequence = self.sequence_map.get(seq_id)
+            if sequence is None:
+                return
+            if not sequence.finished and sequence.deadline is not None and time.monotonic() > sequence.deadline:
+                self.num_deadline_missed += 1
+            self._retire(sequence)
+            if sequence in self.running:
+                self.running.remove(sequence)
+            self._free_blocks(sequence)
+    
+    def abort_sequence(self, seq_id: str):
+        """Cancel a sequence whose client went away; the next `schedule()` drops it."""
+        with self.lock:
+            if seq_id in self.sequence_map:
+                self.aborted[seq_id] = None
+                self.has_work.notify()
+    
+    def _drop_aborted(self, output: SchedulerOutput):
+        for seq_id in self.aborted:
+            sequence = self.sequence_map.pop(seq_id, None)
+            if sequence is None:
+                # Finished in the meantime
+                continue
+            if sequence in self.running:
+                self.running.remove(sequence)
+            elif sequence in self.waiting:
+                self.waiting.remove(sequence)
+                self._dequeue(sequence)
+            elif sequence in self.swapped:
+                self.swapped.remove(sequence)
+            self._free_blocks(sequence)
+            self._retire(sequence)
+            self._count_aborted(sequence)
+            output.aborted.append(sequence)
+        self.aborted.clear()
+    
+    def _count_aborted(self, sequence: Sequence):
+        self.num_aborted += 1
+        num_tokens = len(sequence.prompt_token_ids) + sequence.sampling_params.max_tokens - 1
+        self.num_aborted_saved_tokens += max(0, num_tokens - sequence.num_computed_tokens)
     
     def remove_finished_sequence(self, seq_id: str):
-        if seq_id in self.sequence_map:
-            sequence = self.sequence_map[seq_id]
-            if sequence in self.active_sequences:
-                self.active_sequences.remove(sequence)
-            if sequence in self.active_streaming_sequences:
-                self.active_streaming_sequences.remove(sequence)
-            del self.sequence_map[seq_id]
-            
+        with self.lock:
+            sequence = self.sequence_map.pop(seq_id, None)
+            if sequence is None:
+                return
+            if sequence in self.running:
+                self.running.remove(sequence)
+            elif sequence in self.waiting:
+                self.waiting.remove(sequence)
+                self._dequeue(sequence)
+            elif sequence in self.swapped:
+                self.swapped.remove(sequence)
+            self._free_blocks(sequence)
+            self._retire(sequence)
+
+    def fail_sequences(self, seq_ids: List[str]) -> List[Sequence]:
+        """Drop the sequences of a step that failed; returns those still known.
+
+        `schedule()` counted the step's tokens as computed, so the sequences
+        could never be scheduled again. The KV of those tokens may not be
+        written, so their blocks are freed without entering the prefix cache.
+        """
+        failed = []
+        with self.lock:
+            for seq_id in seq_ids:
+                sequence = self.sequence_map.pop(seq_id, None)
+                if sequence is None:
+                    continue
+                if sequence in self.running:
+                    self.running.remove(sequence)
+                if self.block_managers and sequence.replica is not None:
+                    self.block_managers[sequence.replica].free(sequence.id)
+                self._retire(sequence)
+                failed.append(sequence)
+        return failed
+
     def is_sequence_finished(self, seq_id: str) -> bool:
         if seq_id in self.sequence_map:
             sequence = self.sequence_map[seq_id]
@@ -79,12 +686,62 @@ class WorkloadManager:
     def get_sequence(self, seq_id: str) -> Optional[Sequence]:
         return self.sequence_map.get(seq_id)
     
-    def update_sequence_output(self, seq_id: str, token: str, is_finished: bool = False):
-        if seq_id in self.sequence_map:
-            sequence = self.sequence_map[seq_id]
-            sequence.output.append(token)
-            sequence.prompt += token
-            sequence.token_count += 1
-            sequence.finished = is_finished
+    def update_sequence_output(self, seq_id: str, token_ids: List[int], is_finished: bool = False,
+                               num_accepted: int = 0):
+        """Append a step's output tokens; num_accepted of them were speculative
+        tokens the worker verified, so their KV is cached as well."""
+        with self.lock:
+            sequence = self.sequence_map.get(seq_id)
+            if sequence is None:
+                return None
+            if not sequence.finished:
+                num_remaining = max(0, sequence.sampling_params.max_tokens - sequence.token_count)
+                self.num_pending_decode_tokens -= min(len(token_ids), num_remaining)
+            if not sequence.output_token_ids and sequence.ttft_deadline is not None \
+                    and time.monotonic() > sequence.ttft_deadline:
+                self.num_ttft_slo_missed += 1
+            sequence.output_token_ids.extend(token_ids)
+            sequence.num_computed_tokens += num_accepted
+            sequence.num_accepted_tokens += num_accepted
+            sequence.num_output_steps += 1
+            self.num_accepted_tokens += num_accepted
+            self.num_output_tokens += len(token_ids)
+            self.num_output_steps += 1
+            if is_finished:
+                self._retire(sequence)
             return sequence
-        return None 
\ No newline at end of file
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Queue lengths, preemptions, aborts, admission load, missed SLOs, speculative decoding,
+        prefix cache hits and KV block usage per worker replica."""
+        with self.lock:
+            return {
+                'num_running': len(self.running),
+                'num_waiting': len(self.waiting),
+                'num_swapped': len(self.swapped),
+                'num_preemptions': self.num_preemptions,
+                'prefix_cache_hit_rate': (
+                    self.num_prefix_hit_tokens / self.num_prefix_query_tokens if self.num_prefix_query_tokens else 0.0
+                ),
+                'prefix_cache_saved_tokens': self.num_prefix_hit_tokens,
+                'num_aborted': self.num_aborted,
+                'aborted_saved_tokens': self.num_aborted_saved_tokens,
+                'queued_prompt_tokens': self.num_queued_prompt_tokens,
+                'pending_decode_tokens': self.num_pending_decode_tokens,
+                'throughput_tokens_per_s': self.admission.throughput() or 0.0,
+                'estimated_queue_time_s': self.admission.estimate_wait(
+                    self.num_queued_prompt_tokens + self.num_pending_decode_tokens
+                ) or 0.0,
+                'num_rejected': self.admission.num_rejected,
+                'policy': self.config.policy,
+                'num_ttft_slo_missed': self.num_ttft_slo_missed,
+                'num_deadline_missed': self.num_deadline_missed,
+                'speculative_method': self.speculative_config.method,
+                'spec_acceptance_rate': (
+                    self.num_accepted_tokens / self.num_proposed_tokens if self.num_proposed_tokens else 0.0
+                ),
+                'spec_proposed_tokens': self.num_proposed_tokens,
+                'spec_accepted_tokens': self.num_accepted_tokens,
+                'tokens_per_step': self.num_output_tokens / self.num_output_steps if self.num_output_steps else 0.0,
+                'kv_cache': [manager.get_stats() for manager in self.block_managers],
+            }
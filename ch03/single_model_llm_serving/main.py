@@ -1,11 +1,12 @@
-from fastapi import FastAPI, BackgroundTasks, Depends
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, BackgroundTasks, Depends, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from llm import LLMEngine
-from typing import List
+from llm import AdmissionLimits, LLMEngine, EngineConfig, QueueFullError, SamplingParams, SchedulingParams
+from typing import Any, Awaitable, Dict, List, Optional, TypeVar
 import asyncio
 import multiprocessing
 import atexit
+import os
 import signal
 
 # Create FastAPI app
@@ -28,30 +29,86 @@ def get_llm():
     global _llm
     with _llm_lock:
         if _llm is None:
-            _llm = LLMEngine()
+            _llm = LLMEngine(EngineConfig.load(os.getenv("LLM_ENGINE_CONFIG", "config/engine.json")))
             # Register cleanup
             atexit.register(cleanup)
         return _llm
 
+@app.exception_handler(QueueFullError)
+async def queue_full_handler(request: Request, exc: QueueFullError):
+    """Overload: reject right away instead of queueing, and say when to come back."""
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc)},
+        headers={"Retry-After": exc.retry_after_header}
+    )
+
+def admission_limits(http_request: Request, llm: LLMEngine) -> AdmissionLimits:
+    return llm.config.admission.limits_for(http_request.url.path)
+
+T = TypeVar("T")
+
+# How often non-streaming handlers check that their client is still there
+DISCONNECT_POLL_INTERVAL = 0.5
+
+async def cancel_on_disconnect(http_request: Request, awaitable: Awaitable[T]) -> T:
+    """Await an engine call, cancelling it, which aborts its sequences, if the client disconnects."""
+    task = asyncio.ensure_future(awaitable)
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+        if done:
+            return task.result()
+        if await http_request.is_disconnected():
+            task.cancel()
+            # Nobody reads the response; 499 is the usual "client closed request"
+            raise HTTPException(status_code=499, detail="Client disconnected")
+
 class GenerateRequest(BaseModel):
     prompt: str
+    sampling_params: SamplingParams = SamplingParams()
+    scheduling_params: SchedulingParams = SchedulingParams()
+
+class SpeculativeStats(BaseModel):
+    proposed_tokens: int
+    accepted_tokens: int
+    acceptance_rate: float
+    tokens_per_step: float
 
 class GenerateResponse(BaseModel):
     generated_text: str
+    # Set when speculative decoding proposed tokens for the prompt
+    speculative: Optional[SpeculativeStats] = None
 
 class BatchGenerateRequest(BaseModel):
     prompts: List[str]
+    sampling_params: SamplingParams = SamplingParams()
+    scheduling_params: SchedulingParams = SchedulingParams()
 
 class BatchGenerateResponse(BaseModel):
     generated_texts: List[str]
+    # One per prompt, like generated_texts
+    speculative: Optional[List[Optional[SpeculativeStats]]] = None
+
+class ProfilerRequest(BaseModel):
+    enabled: bool
 
 @app.post("/generate_stream")
-async def generate_stream(request: GenerateRequest, llm: LLMEngine = Depends(get_llm)):
+async def generate_stream(request: GenerateRequest, http_request: Request, llm: LLMEngine = Depends(get_llm)):
+    # Queue the request before the response starts, so overload is still a 429
+    events = llm.open_stream(
+        asyncio.get_event_loop(), request.prompt, request.sampling_params, admission_limits(http_request, llm),
+        request.scheduling_params
+    )
+    
     async def event_generator():
-        loop = asyncio.get_event_loop()
-        async for token in llm.event_generator(loop, request.prompt):
-            # token = 'data: {"token": " a", "sequence_id": "8310f5e1-6f6f-480e-b2f9-c8144a12cc17"}\n\n'
-            yield token
+        try:
+            async for token in events:
+                # token = 'data: {"token": " a", "sequence_id": "8310f5e1-6f6f-480e-b2f9-c8144a12cc17"}\n\n'
+                yield token
+        finally:
+            # Starlette stops iterating when the client disconnects; close the
+            # engine stream right away so the sequence is aborted
+            await events.aclose()
     
     return StreamingResponse(
         event_generator(),
@@ -60,15 +117,49 @@ async def generate_stream(request: GenerateRequest, llm: LLMEngine = Depends(get
 
 # process 1 request with only one prompt at a time.
 @app.post("/basic_generate", response_model=GenerateResponse)
-async def basic_generate(request: GenerateRequest, llm: LLMEngine = Depends(get_llm)):
-    generated_text = llm.basic_generate(request.prompt)
-    return GenerateResponse(generated_text=generated_text)
+async def basic_generate(request: GenerateRequest, http_request: Request, llm: LLMEngine = Depends(get_llm)):
+    outputs = await cancel_on_disconnect(
+        http_request,
+        llm.generate_outputs_async(
+            [request.prompt], request.sampling_params, admission_limits(http_request, llm), request.scheduling_params
+        )
+    )
+    return GenerateResponse(generated_text=outputs[0]['text'], speculative=outputs[0]['speculative'])
 
 # process multiple prompts in a request
 @app.post("/generate", response_model=BatchGenerateResponse)
-async def generate(request: BatchGenerateRequest, llm: LLMEngine = Depends(get_llm)):
-    generated_texts = llm.generate(request.prompts)
-    return BatchGenerateResponse(generated_texts=generated_texts)
+async def generate(request: BatchGenerateRequest, http_request: Request, llm: LLMEngine = Depends(get_llm)):
+    outputs = await cancel_on_disconnect(
+        http_request,
+        llm.generate_outputs_async(
+            request.prompts, request.sampling_params, admission_limits(http_request, llm), request.scheduling_params
+        )
+    )
+    return BatchGenerateResponse(generated_texts=[output['text'] for output in outputs],
+                                 speculative=[output['speculative'] for output in outputs])
+
+@app.get("/stats")
+async def stats(llm: LLMEngine = Depends(get_llm)) -> Dict[str, Any]:
+    """Scheduler queues, preemptions, aborts, admission load, missed SLOs, prefix cache hits and per-worker KV-cache utilization."""
+    return llm.get_stats()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics(llm: LLMEngine = Depends(get_llm)) -> PlainTextResponse:
+    """TTFT, TPOT, inter-token, end-to-end and queue latency histograms, token counters and load gauges for Prometheus."""
+    return PlainTextResponse(llm.render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# Plain functions: FastAPI runs them in its threadpool, so the worker
+# round trips they wait on never block the event loop
+@app.post("/admin/profiler")
+def set_profiler(request: ProfilerRequest, llm: LLMEngine = Depends(get_llm)) -> Dict[str, bool]:
+    """Start recording engine step stages and request lifecycles, dropping the previous trace, or stop."""
+    llm.set_profiling(request.enabled)
+    return {"enabled": request.enabled}
+
+@app.get("/admin/profiler/trace")
+def profiler_trace(llm: LLMEngine = Depends(get_llm)) -> Dict[str, Any]:
+    """The recorded events as Chrome trace JSON; open it in chrome://tracing or ui.perfetto.dev."""
+    return llm.get_trace()
 
 @app.post("/generate_vllm", response_model=BatchGenerateResponse)
 async def generate_vllm(request: BatchGenerateRequest, llm: LLMEngine = Depends(get_llm)):
@@ -0,0 +1,57 @@
+import pytest
+from llm.admission import AdmissionController, QueueFullError
+from llm.config import AdmissionConfig, AdmissionLimits, SchedulerConfig
+from llm.sampling_params import SamplingParams
+from llm.workload_manager import WorkloadManager
+
+def test_token_limits_reject_with_time_to_drain():
+    controller = AdmissionController()
+    limits = AdmissionLimits(max_queued_prompt_tokens=100)
+    controller.check(limits, 0, 0, 500, 20)  # alone over the limit, but nothing is queued
+    controller.check(limits, 50, 20, 50, 20)
+
+    # Without a throughput estimate the configured default applies
+    with pytest.raises(QueueFullError) as error:
+        controller.check(limits, 50, 20, 51, 20)
+    assert error.value.retry_after == 1.0
+
+    # 100 tokens per second: 30 excess tokens drain in 0.3s
+    for second in range(11):
+        controller.record_step(100, now=float(second))
+    with pytest.raises(QueueFullError) as error:
+        controller.check(limits, 80, 0, 50, 20, now=10.0)
+    assert error.value.retry_after == pytest.approx(0.3)
+    assert error.value.retry_after_header == "1"
+    assert controller.num_rejected == 2
+
+def test_queue_time_limit_uses_recent_throughput():
+    controller = AdmissionController(AdmissionConfig(throughput_window_s=5))
+    limits = AdmissionLimits(max_queue_time_s=2)
+    controller.record_step(1000, now=0.0)
+    for second in range(10, 16):
+        controller.record_step(100, now=float(second))
+    # The burst at t=0 left the window: 100 tokens per second
+    assert controller.throughput(now=15.0) == pytest.approx(100)
+    controller.check(limits, 150, 0, 10, 10, now=15.0)
+    with pytest.raises(QueueFullError) as error:
+        controller.check(limits, 200, 100, 10, 10, now=15.0)
+    assert error.value.retry_after == pytest.approx((300 - 2 * 100) / 100)
+
+def test_workload_manager_tracks_queued_and_pending_tokens():
+    manager = WorkloadManager(
+        SchedulerConfig(max_num_seqs=1, max_num_batched_tokens=100),
+        admission_config=AdmissionConfig(default=AdmissionLimits(max_pending_decode_tokens=15))
+    )
+    first = manager.add_request([1, 2, 3], sampling_params=SamplingParams(max_tokens=10))
+    manager.add_request([4, 5], sampling_params=SamplingParams(max_tokens=5))
+    assert (manager.num_queued_prompt_tokens, manager.num_pending_decode_tokens) == (5, 15)
+    with pytest.raises(QueueFullError):
+        manager.add_requests([[6], [7]], [None, None], SamplingParams(max_tokens=1))
+
+    manager.schedule()
+    manager.update_sequence_output(first, [8, 9])
+    assert (manager.num_queued_prompt_tokens, manager.num_pending_decode_tokens) == (2, 13)
+    manager.finish_sequence(first)
+    manager.remove_finished_sequence(first)
+    assert manager.num_pending_decode_tokens == 5
+    manager.add_request([6], sampling_params=SamplingParams(max_tokens=10))
@@ -47,6 +47,17 @@ def test_generate(client):
     assert isinstance(data["generated_text"], str)
     assert len(data["generated_text"]) > 0
 
+def test_basic_generate_schedules_with_its_params(client):
+    missed = client.get("/stats").json()["num_deadline_missed"]
+    response = client.post(
+        "/basic_generate",
+        json={"prompt": "Hello, I am", "sampling_params": {"max_tokens": 5, "ignore_eos": True},
+              "scheduling_params": {"deadline_s": 1e-6}}
+    )
+    assert response.status_code == 200
+    # The deadline reached the scheduler, which counts it as missed
+    assert client.get("/stats").json()["num_deadline_missed"] == missed + 1
+
 def test_generate_batch(client):
     # Test with multiple prompts
     test_prompts = [
@@ -76,6 +87,28 @@ def test_generate_batch(client):
         assert isinstance(generated_text, str)
         assert len(generated_text) > 0
 
+def test_metrics(client):
+    assert client.post("/generate", json={"prompts": ["Hello, I am"]}).status_code == 200
+    
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    samples = dict(line.rsplit(" ", 1) for line in response.text.splitlines() if not line.startswith("#"))
+    assert float(samples["llm_time_to_first_token_seconds_count"]) >= 1
+    assert float(samples["llm_generation_tokens_total"]) > 0
+    assert 'llm_kv_cache_usage_ratio{replica="0"}' in samples
+
+def test_profiler_trace(client):
+    assert client.post("/admin/profiler", json={"enabled": True}).json() == {"enabled": True}
+    assert client.post("/generate", json={"prompts": ["Hello, I am"]}).status_code == 200
+    client.post("/admin/profiler", json={"enabled": False})
+    
+    events = client.get("/admin/profiler/trace").json()["traceEvents"]
+    spans = {event["name"] for event in events if event["ph"] == "X"}
+    # Engine loop and worker stages alike
+    assert {"schedule", "forward", "wait", "read_batch", "sample"} <= spans
+    assert any(event.get("cat") == "request" for event in events)
+
 @pytest.mark.asyncio
 async def test_generate_stream(async_client):
     print("Starting test_generate_stream...")
@@ -155,4 +188,22 @@ async def test_generate_stream_concurrent(async_client):
     assert len(generated_text2) > 0, "Empty generated text for second prompt"
     
     # Verify the generated texts are different
-    assert generated_text1 != generated_text2, "Generated texts should be different for different prompts" 
\ No newline at end of file
+    assert generated_text1 != generated_text2, "Generated texts should be different for different prompts" 
+
+@pytest.mark.asyncio
+async def test_generate_concurrent_clients(async_client):
+    # Handlers await the engine, so many clients are served side by side
+    async def make_request(i):
+        if i % 2:
+            response = await async_client.post("/basic_generate", json={"prompt": f"Request {i}: Hello, I am"})
+            assert response.status_code == 200
+            return [response.json()["generated_text"]]
+        response = await async_client.post("/generate", json={"prompts": [f"Request {i}: The weather is", "I want to"]})
+        assert response.status_code == 200
+        return response.json()["generated_texts"]
+    
+    results = await asyncio.gather(*(make_request(i) for i in range(50)))
+    
+    assert len(results) == 50
+    for generated_texts in results:
+        assert all(len(text) > 0 for text in generated_texts)
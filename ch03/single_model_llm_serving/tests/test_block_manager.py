@@ -0,0 +1,68 @@
+import pytest
+from llm.block_manager import BlockManager
+
+def test_allocate_grows_block_table_one_block_at_a_time():
+    manager = BlockManager(num_blocks=4, block_size=4)
+    assert manager.allocate("a", 5) == [0, 1]
+    # Tokens that fit the last block need no new one
+    assert manager.allocate("a", 8) == [0, 1]
+    assert manager.allocate("a", 9) == [0, 1, 2]
+    assert manager.can_allocate("b", 4)
+    assert not manager.can_allocate("b", 5)
+    with pytest.raises(MemoryError):
+        manager.allocate("b", 5)
+    
+    manager.free("a")
+    assert len(manager.free_blocks) == 4
+    assert manager.get_stats()['used_blocks'] == 0
+
+def test_stats_report_utilization_and_fragmentation():
+    manager = BlockManager(num_blocks=4, block_size=4)
+    manager.allocate("a", 5)
+    manager.allocate("b", 4)
+    stats = manager.get_stats()
+    assert stats['utilization'] == 0.75
+    # 9 tokens in 3 blocks of 4 slots
+    assert stats['fragmentation'] == pytest.approx(1 - 9 / 12)
+
+def test_swap_out_and_in_moves_blocks():
+    manager = BlockManager(num_blocks=2, block_size=4, num_swap_blocks=2)
+    manager.allocate("a", 8)
+    assert manager.can_swap_out("a")
+    assert manager.swap_out("a") == [(0, 0), (1, 1)]
+    assert len(manager.free_blocks) == 2
+    
+    manager.allocate("b", 4)
+    assert not manager.can_swap_in("a", 8)
+    manager.free("b")
+    assert manager.can_swap_in("a", 8)
+    mapping = manager.swap_in("a")
+    assert [swap_block for swap_block, _ in mapping] == [0, 1]
+    assert manager.block_tables["a"] == [block for _, block in mapping]
+    assert len(manager.free_swap_blocks) == 2
+
+def test_prefix_blocks_are_shared_and_evicted_lru():
+    manager = BlockManager(num_blocks=4, block_size=2)
+    tokens = [1, 2, 3, 4, 5]
+    manager.allocate("a", 5)
+    manager.cache_full_blocks("a", tokens, 5)
+    assert manager.lookup([1, 2, 3, 4, 9]) == [0, 1]
+    assert manager.lookup([1, 2, 9, 9]) == [0]
+    # A block is only found after the blocks before it
+    assert manager.lookup([9, 9, 3, 4]) == []
+    
+    manager.allocate("b", 5, cached_blocks=[0, 1])
+    assert manager.block_tables["b"] == [0, 1, 3]
+    assert manager.ref_counts[:2] == [2, 2]
+    
+    # Unused cached blocks count as free but keep their contents
+    manager.free("a")
+    manager.free("b")
+    assert manager.num_free_blocks == 4
+    assert manager.lookup(tokens) == [0, 1]
+    
+    # Fresh blocks come from the free list first, then the least recently used cached block
+    manager.allocate("c", 6)
+    assert manager.block_tables["c"] == [2, 3, 0]
+    assert manager.lookup(tokens) == []
+    assert manager.get_stats()['cached_blocks'] == 1
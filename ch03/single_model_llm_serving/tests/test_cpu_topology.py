@@ -0,0 +1,28 @@
+import os
+from llm.cpu_topology import Core, discover_cores, parse_cpu_list, plan_placement
+
+def _two_socket_host():
+    # 2 NUMA nodes of 4 cores, hyperthread siblings numbered +8
+    return [Core(node, (cpu, cpu + 8)) for node in (0, 1) for cpu in range(4 * node, 4 * node + 4)]
+
+def test_parse_cpu_list():
+    assert parse_cpu_list("0-3,8,10-11\n") == [0, 1, 2, 3, 8, 10, 11]
+    assert parse_cpu_list("") == []
+
+def test_workers_get_disjoint_equal_node_local_cores():
+    placement = plan_placement(_two_socket_host(), num_workers=2, reserved_cores=1)
+    # The API keeps core 0; node 0 has 3 cores left, so each worker gets 3
+    # of one node, and node 1's spare core goes to the API too
+    assert placement.worker_cpus == [[1, 2, 3, 9, 10, 11], [4, 5, 6, 12, 13, 14]]
+    assert placement.worker_threads == [3, 3]
+    assert placement.api_cpus == [0, 7, 8, 15]
+
+def test_placement_degrades_with_too_few_cores():
+    # No room for the reserved core: the API is left unpinned
+    placement = plan_placement(_two_socket_host(), num_workers=8, reserved_cores=1)
+    assert placement.worker_threads == [1] * 8 and placement.api_cpus == []
+    assert plan_placement(_two_socket_host(), num_workers=9, reserved_cores=1) is None
+
+def test_discovered_cores_cover_the_allowed_cpus():
+    cpus = [cpu for core in discover_cores() for cpu in core.cpus]
+    assert sorted(cpus) == sorted(os.sched_getaffinity(0))
@@ -0,0 +1,22 @@
+from llm.detokenizer import IncrementalDetokenizer
+from llm.model_manager import ModelManager
+from llm.workload_manager import Sequence
+
+def test_streamed_deltas_add_up_to_the_decoded_text():
+    tokenizer = ModelManager().load_tokenizer("facebook/opt-125m")
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    prompt = tokenizer("Say it:").input_ids
+    outputs = [tokenizer(text, add_special_tokens=False).input_ids for text in (" héllo wörld", " 世界 🙂 ok")]
+    sequences = [Sequence(str(i), prompt, None, None) for i in range(len(outputs))]
+
+    streamed = ["", ""]
+    for step in range(max(len(token_ids) for token_ids in outputs)):
+        active = [(seq, token_ids) for seq, token_ids in zip(sequences, outputs) if step < len(token_ids)]
+        for seq, token_ids in active:
+            seq.output_token_ids.append(token_ids[step])
+        for (seq, _), text in zip(active, detokenizer.step([seq for seq, _ in active])):
+            # Characters split over several tokens never show up half done
+            assert "�" not in text
+            streamed[int(seq.id)] += text
+
+    assert streamed == [" héllo wörld", " 世界 🙂 ok"]
@@ -0,0 +1,113 @@
+import asyncio
+import threading
+import time
+import pytest
+from llm import SamplingParams
+from main import get_llm
+
+async def test_streams_make_progress_while_a_basic_request_runs():
+    llm = get_llm()
+    loop = asyncio.get_running_loop()
+    basic_done = None
+
+    async def basic():
+        nonlocal basic_done
+        text = await llm.basic_generate_async("Hello, I am", SamplingParams(max_tokens=300, ignore_eos=True))
+        basic_done = time.monotonic()
+        return text
+    task = asyncio.ensure_future(basic())
+    await asyncio.sleep(0.05)
+
+    # Started after the long basic request, the stream still gets every
+    # token and finishes first
+    events = [event async for event in llm.event_generator(loop, "The weather is",
+                                                           SamplingParams(max_tokens=5, ignore_eos=True))]
+    stream_done = time.monotonic()
+    assert len(events) > 0
+    assert basic_done is None
+    await task
+    assert basic_done > stream_done
+
+async def test_failed_step_fails_its_requests_and_the_engine_goes_on(monkeypatch):
+    llm = get_llm()
+    loop = asyncio.get_running_loop()
+    execute_forward_batch = llm.model_executor.execute_forward_batch
+
+    def failing(prompts):
+        raise RuntimeError("Worker failed: injected")
+    monkeypatch.setattr(llm.model_executor, 'execute_forward_batch', failing)
+
+    with pytest.raises(RuntimeError, match="injected"):
+        await asyncio.wait_for(llm.generate_async(["Hello, I am"]), timeout=10)
+    # The stream ends instead of waiting for tokens forever
+    events = [event async for event in llm.event_generator(loop, "Hello, I am")]
+    assert events == []
+
+    stats = llm.workload_manager.get_stats()
+    assert stats['num_running'] == 0
+    assert all(kv_cache['used_blocks'] == 0 for kv_cache in stats['kv_cache'])
+    # Idle again rather than spinning on sequences it can never schedule
+    assert not llm.workload_manager.wait_for_work(timeout=0.1)
+
+    monkeypatch.setattr(llm.model_executor, 'execute_forward_batch', execute_forward_batch)
+    texts = await asyncio.wait_for(llm.generate_async(["Hello, I am"]), timeout=30)
+    assert len(texts) == 1
+
+async def test_stop_inside_a_speculative_step_keeps_the_cache_accounting(monkeypatch):
+    llm = get_llm()
+    execute_forward_batch = llm.model_executor.execute_forward_batch
+
+    def speculating(prompts):
+        # As if two proposals were accepted before the token of the model's own,
+        # with a stop token second
+        results = execute_forward_batch(prompts)
+        for result in results:
+            if result['token_ids']:
+                result['token_ids'] = [7, 5, 8, 9]
+        return results
+    monkeypatch.setattr(llm.model_executor, 'execute_forward_batch', speculating)
+
+    futures = llm._submit(["Hello, I am"], SamplingParams(max_tokens=20, stop_token_ids=[5]))
+    sequence = await asyncio.wait_for(asyncio.wrap_future(next(iter(futures.values()))), timeout=30)
+    assert sequence.output_token_ids.tolist() == [7]
+    # Only the token kept counts as accepted and cached
+    assert sequence.num_accepted_tokens == 1
+    assert sequence.num_computed_tokens == len(sequence.get_token_ids())
+
+async def test_request_cancelled_as_it_finishes_leaves_its_step_alone(monkeypatch):
+    llm = get_llm()
+    loop = asyncio.get_running_loop()
+    execute_forward_batch = llm.model_executor.execute_forward_batch
+    params = SamplingParams(max_tokens=1, ignore_eos=True)
+    release = threading.Event()
+    num_steps = 0
+    cancelled = None
+
+    def stepping(prompts):
+        nonlocal num_steps
+        num_steps += 1
+        if num_steps == 1:
+            # Hold the engine until both requests are queued for the next step
+            release.wait(timeout=10)
+        elif num_steps == 2:
+            # The client goes away while the step that finishes its request runs
+            loop.call_soon_threadsafe(cancelled.cancel)
+            futures = [llm.workload_manager.get_sequence(p['request_id']).future for p in prompts]
+            deadline = time.monotonic() + 5
+            while not any(future.cancelled() for future in futures) and time.monotonic() < deadline:
+                time.sleep(0.01)
+        return execute_forward_batch(prompts)
+    monkeypatch.setattr(llm.model_executor, 'execute_forward_batch', stepping)
+
+    blocker = asyncio.ensure_future(llm.generate_async(["Hi"], params))
+    await asyncio.sleep(0.2)
+    cancelled = asyncio.ensure_future(llm.generate_async(["Hello, I am"], params))
+    other = asyncio.ensure_future(llm.generate_async(["The weather is"], params))
+    await asyncio.sleep(0.05)
+    release.set()
+
+    assert len(await asyncio.wait_for(other, timeout=30)) == 1
+    with pytest.raises(asyncio.CancelledError):
+        await cancelled
+    await blocker
+    assert num_steps == 2
@@ -0,0 +1,77 @@
+from llm.block_manager import BlockManager
+from llm.config import SchedulerConfig, SpeculativeConfig
+from llm.metrics import EngineMetrics, Histogram
+from llm.sampling_params import SamplingParams
+from llm.workload_manager import WorkloadManager
+
+def _samples(text):
+    return {line.rsplit(' ', 1)[0]: float(line.rsplit(' ', 1)[1])
+            for line in text.splitlines() if not line.startswith('#')}
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("latency_seconds", "Latency.", [0.1, 1.0])
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value)
+    samples = _samples("\n".join(histogram.render()))
+    assert samples['latency_seconds_bucket{le="0.1"}'] == 2
+    assert samples['latency_seconds_bucket{le="1.0"}'] == 3
+    assert samples['latency_seconds_bucket{le="+Inf"}'] == samples['latency_seconds_count'] == 4
+    assert samples['latency_seconds_sum'] == 3.65
+
+def test_engine_steps_record_request_latencies():
+    manager = WorkloadManager(SchedulerConfig(max_num_seqs=4, max_num_batched_tokens=100),
+                              block_managers=[BlockManager(8, 16)])
+    metrics = EngineMetrics(max_num_seqs=4, max_num_batched_tokens=100)
+    seq_id = manager.add_request([1, 2, 3])
+    sequence = manager.get_sequence(seq_id)
+    # Round times keep the sums exact
+    start = sequence.arrival_time = 100.0
+
+    # Scheduled after 1s, the prefill gives the first token at 2s, then two decode steps take 0.5s each
+    for scheduled, done in ((1.0, 2.0), (2.0, 2.5), (2.5, 3.0)):
+        output = manager.schedule()
+        metrics.record_step(output.sequences, output.num_prefill_tokens, output.num_decode_tokens, start + scheduled)
+        metrics.record_tokens(sequence, 1, start + done)
+        manager.update_sequence_output(seq_id, [7])
+    manager.finish_sequence(seq_id)
+    metrics.record_finished(sequence, start + 3.0)
+
+    samples = _samples(metrics.render(manager.get_stats()))
+    assert samples['llm_request_queue_time_seconds_sum'] == 1.0
+    assert samples['llm_time_to_first_token_seconds_sum'] == 2.0
+    assert samples['llm_inter_token_latency_seconds_count'] == 2
+    assert samples['llm_inter_token_latency_seconds_sum'] == 1.0
+    assert samples['llm_time_per_output_token_seconds_sum'] == 0.5
+    assert samples['llm_e2e_request_latency_seconds_sum'] == 3.0
+    assert samples['llm_prompt_tokens_total'] == 3
+    assert samples['llm_generation_tokens_total'] == 3
+    assert samples['llm_request_success_total'] == 1
+    assert samples['llm_batch_occupancy_ratio'] == 0.25
+    assert samples['llm_num_requests_running'] == 0
+    assert samples['llm_kv_cache_usage_ratio{replica="0"}'] == 0.0
+
+def test_speculative_proposals_are_counted_per_request():
+    manager = WorkloadManager(
+        SchedulerConfig(max_num_seqs=8, max_num_batched_tokens=7),
+        block_managers=[BlockManager(num_blocks=8, block_size=4)],
+        speculative_config=SpeculativeConfig(method="ngram", num_speculative_tokens=3)
+    )
+    metrics = EngineMetrics(max_num_seqs=8, max_num_batched_tokens=7)
+    seq_id = manager.add_request([1, 2, 3, 4, 1, 2], sampling_params=SamplingParams(max_tokens=20))
+    sequence = manager.get_sequence(seq_id)
+    manager.schedule()
+    manager.update_sequence_output(seq_id, [3])
+    # "4 1 2" is proposed; two are accepted, then a token of the model's own
+    manager.schedule()
+    manager.update_sequence_output(seq_id, [4, 1, 9], num_accepted=2)
+    manager.finish_sequence(seq_id)
+    metrics.record_finished(sequence, sequence.arrival_time + 1.0)
+
+    assert sequence.speculative_stats() == {
+        'proposed_tokens': 3, 'accepted_tokens': 2, 'acceptance_rate': 2 / 3, 'tokens_per_step': 2.0
+    }
+    samples = _samples(metrics.render(manager.get_stats()))
+    assert samples['llm_spec_decode_proposed_tokens_total'] == 3
+    assert samples['llm_spec_decode_accepted_tokens_total'] == 2
+    assert samples['llm_request_tokens_per_step_bucket{le="2.0"}'] == 1
+    assert samples['llm_request_tokens_per_step_sum'] == 2.0
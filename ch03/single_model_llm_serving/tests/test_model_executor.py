@@ -0,0 +1,73 @@
+import random
+import time
+from llm.config import ExecutorConfig, SchedulerConfig
+from llm.model_executor import ModelExecutor
+from llm.model_worker import ModelWorker
+
+def _echo_run(model_name, channel, num_threads=None, cache_config=None, max_padding_fraction=None,
+              speculative_config=None, precision_config=None, model_cache_config=None,
+              compile_config=None, cpus=None, num_interop_threads=None):
+    # Stand-in worker: answers with the last new token + 1 after a random delay,
+    # so replicas finish out of order.
+    num_forwards = 0
+    channel.reply(('ready', 100, 0, {'num_forwards': num_forwards}))
+    while True:
+        task = channel.recv_task()
+        if task is None:
+            break
+        if task[0] == 'forward':
+            _, _, token_id_lists, _, _, _ = channel.read_batch(task[1], task[2])
+            time.sleep(random.uniform(0, 0.01))
+            num_forwards += 1
+            channel.send_tokens([[token_ids[-1] + 1] for token_ids in token_id_lists], {'num_forwards': num_forwards})
+        elif task[0] == 'generate':
+            channel.reply(('complete', [{'request_id': p['request_id'], 'token_ids': []} for p in task[1]]))
+        elif task[0] == 'attach':
+            channel.attach_requests(task[1])
+
+def test_forward_batch_spreads_sequences_and_correlates_results(monkeypatch):
+    monkeypatch.setattr(ModelWorker, 'run', staticmethod(_echo_run))
+    executor = ModelExecutor(ExecutorConfig(num_workers=3, threads_per_worker=1))
+    executor.setup_workers("echo")
+    try:
+        prompts = [{'request_id': f"req-{i}", 'token_ids': [10 * i, 10 * i + 1]} for i in range(9)]
+        for _ in range(5):
+            results = executor.execute_forward_batch(prompts)
+            assert [r['request_id'] for r in results] == [p['request_id'] for p in prompts]
+            for p, r in zip(prompts, results):
+                assert r['token_ids'] == [p['token_ids'][-1] + 1]
+            prompts = [{'request_id': r['request_id'], 'token_ids': r['token_ids']} for r in results]
+        
+        # Stats come with the steps; reading them needs neither the lock nor the workers
+        with executor.lock:
+            assert executor.get_stats() == [{'num_forwards': 5}] * 3
+        
+        # New sequences go to the least-loaded replica
+        assert [replica.num_sequences for replica in executor.replicas] == [3, 3, 3]
+        executor.release_sequences(["req-0", "req-3", "req-6"])
+        loads = [replica.num_sequences for replica in executor.replicas]
+        assert sum(loads) == 6
+        executor.execute_forward_batch([{'request_id': "new", 'token_ids': [1]}])
+        assert executor.assignments["new"].num_sequences == min(loads) + 1
+        
+        # The scheduler's placement wins over the executor's
+        executor.execute_forward_batch([{'request_id': "placed", 'token_ids': [1], 'replica': 2}])
+        assert executor.assignments["placed"] is executor.replicas[2]
+    finally:
+        for replica in executor.replicas:
+            replica.channel.send(None)
+
+def test_request_ring_holds_a_step_of_shared_prefixes(monkeypatch):
+    monkeypatch.setattr(ModelWorker, 'run', staticmethod(_echo_run))
+    executor = ModelExecutor(ExecutorConfig(threads_per_worker=1), SchedulerConfig(max_num_seqs=64))
+    executor.setup_workers("echo", max_model_len=1536)
+    try:
+        # Every sequence names the same 95 blocks of a 1512-token prefix, of 100 in the pool
+        shared_prefix = list(range(95))
+        prompts = [{'request_id': f"req-{i}", 'token_ids': [i], 'context_len': 1512, 'block_table': shared_prefix}
+                   for i in range(64)]
+        results = executor.execute_forward_batch(prompts)
+        assert [r['token_ids'] for r in results] == [[i + 1] for i in range(64)]
+    finally:
+        for replica in executor.replicas:
+            replica.channel.send(None)
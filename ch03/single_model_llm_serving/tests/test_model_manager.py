@@ -0,0 +1,59 @@
+import pytest
+import torch
+from transformers import AutoModelForCausalLM
+from llm.model_manager import ModelManager
+
+def test_reduced_precisions_stay_close_to_fp32():
+    manager = ModelManager()
+    input_ids = torch.tensor([[2, 100, 200, 300, 42, 7, 19]])
+    logits = {}
+    for precision in ("fp32", "bf16", "int8"):
+        model, _ = manager.load_model("facebook/opt-125m", precision)
+        with torch.no_grad():
+            logits[precision] = model(input_ids).logits[0].float()
+        if precision == "bf16":
+            assert model.get_input_embeddings().weight.dtype == torch.bfloat16
+        if precision == "int8":
+            linear_layers = [module for module in model.modules() if isinstance(module, torch.nn.Linear)]
+            # Only the output projection is left unquantized
+            assert linear_layers == [model.get_output_embeddings()]
+    for precision in ("bf16", "int8"):
+        similarity = torch.nn.functional.cosine_similarity(logits["fp32"], logits[precision])
+        assert similarity.min() > 0.99
+
+def test_unknown_precision_is_rejected():
+    with pytest.raises(ValueError):
+        ModelManager().load_model("facebook/opt-125m", "fp8")
+
+def test_snapshot_is_saved_once_and_memory_mapped(tmp_path):
+    input_ids = torch.tensor([[2, 100, 200, 300, 42, 7, 19]])
+    reference, _ = ModelManager(cache_dir=None).load_model("facebook/opt-125m")
+    manager = ModelManager(cache_dir=str(tmp_path))
+    for _ in range(2):
+        model, tokenizer = manager.load_model("facebook/opt-125m")
+        with torch.no_grad():
+            assert torch.equal(model(input_ids).logits, reference(input_ids).logits)
+    # The second load maps the snapshot the first one saved
+    assert 'snapshot' not in manager.timings and 'map_weights' in manager.timings
+    assert not model.training
+    assert model.get_output_embeddings().weight is model.get_input_embeddings().weight
+    # Engine-side config and tokenizer come from the snapshot too
+    assert manager.load_tokenizer("facebook/opt-125m").name_or_path == manager.snapshot_dir("facebook/opt-125m")
+    assert tokenizer("hello world").input_ids == manager.load_tokenizer("facebook/opt-125m")("hello world").input_ids
+
+def test_bf16_snapshot_is_converted_from_the_local_fp32_one(tmp_path, monkeypatch):
+    manager = ModelManager(cache_dir=str(tmp_path))
+    manager.load_model("facebook/opt-125m", "fp32")
+    from_pretrained = AutoModelForCausalLM.from_pretrained
+    sources = []
+
+    def recording(name, *args, **kwargs):
+        sources.append(name)
+        return from_pretrained(name, *args, **kwargs)
+    monkeypatch.setattr(AutoModelForCausalLM, 'from_pretrained', recording)
+
+    model, _ = manager.load_model("facebook/opt-125m", "bf16")
+    assert model.get_input_embeddings().weight.dtype == torch.bfloat16
+    assert 'snapshot' in manager.timings
+    # Nothing comes from the hub
+    assert sources == [manager.snapshot_dir("facebook/opt-125m")]
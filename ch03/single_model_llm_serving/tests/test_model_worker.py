@@ -0,0 +1,103 @@
+import numpy as np
+from llm.config import CacheConfig, CompileConfig, SpeculativeConfig
+from llm.model_worker import ModelWorker, bucket_by_length
+from llm.sampling_params import SamplingParams
+from llm.spec_decode import NgramProposer
+
+def test_buckets_bound_the_padding_of_each_batch():
+    lengths = [300, 12, 9, 290, 10, 40, 310]
+    buckets = bucket_by_length(lengths, 0.25)
+    assert buckets == [[2, 4, 1], [5], [3, 0, 6]]
+    for bucket in buckets:
+        num_positions = len(bucket) * max(lengths[i] for i in bucket)
+        assert num_positions - sum(lengths[i] for i in bucket) <= 0.25 * num_positions
+    # 1 keeps everything in one batch
+    assert len(bucket_by_length(lengths, 1.0)) == 1
+
+def test_bucketed_prefill_samples_the_same_tokens():
+    prompts = [list(range(4, 4 + length)) for length in (3, 40, 5, 37)]
+    results = []
+    for max_padding_fraction in (1.0, 0.25):
+        worker = ModelWorker("facebook/opt-125m", CacheConfig(memory_bytes=64 * 2**20), max_padding_fraction)
+        for handle, token_ids in enumerate(prompts):
+            worker.add_sequences([(handle, SamplingParams(temperature=0), token_ids, len(token_ids))])
+        blocks_per_prompt = 40 // worker.block_size + 1
+        results.append(worker.generate_forward_batch([
+            {'request_id': handle, 'context_len': 0, 'token_ids': token_ids,
+             'block_table': list(range(handle * blocks_per_prompt, (handle + 1) * blocks_per_prompt))}
+            for handle, token_ids in enumerate(prompts)
+        ]))
+        stats = worker.get_stats()
+    assert results[0] == results[1]
+    assert stats['num_forwards'] == 2
+    assert stats['prefill_padding_efficiency'] > 0.9
+
+def _greedy_decode(worker, prompt, num_tokens, num_speculative=0, proposer=None):
+    worker.add_sequences([(0, SamplingParams(temperature=0), prompt, len(prompt))])
+    block_table = list(range((len(prompt) + num_tokens + num_speculative) // worker.block_size + 1))
+    tokens, new_token_ids, num_computed = list(prompt), list(prompt), 0
+    while len(tokens) - len(prompt) < num_tokens:
+        p = {'request_id': 0, 'context_len': num_computed, 'token_ids': new_token_ids, 'block_table': block_table}
+        if num_computed and num_speculative:
+            p['num_speculative_tokens'] = num_speculative
+            if proposer is not None:
+                p['proposal_token_ids'] = proposer.propose(np.array(tokens, dtype=np.int32), num_speculative)
+                p['num_speculative_tokens'] = len(p['proposal_token_ids'])
+        output = worker.generate_forward_batch([p])[0]['token_ids']
+        # Accepted proposals were computed along with the new tokens
+        num_computed += len(new_token_ids) + len(output) - 1
+        tokens += output
+        new_token_ids = output[-1:]
+    return tokens[len(prompt):len(prompt) + num_tokens]
+
+def test_speculative_decoding_keeps_greedy_output():
+    prompt = [5, 6, 7, 8, 5, 6, 7, 8, 5, 6]
+    cache_config = CacheConfig(memory_bytes=64 * 2**20)
+    expected = _greedy_decode(ModelWorker("facebook/opt-125m", cache_config), prompt, 24)
+    
+    proposer = NgramProposer(1, 3)
+    assert _greedy_decode(ModelWorker("facebook/opt-125m", cache_config), prompt, 24, 4, proposer) == expected
+    
+    # A draft identical to the model has every proposal accepted
+    worker = ModelWorker("facebook/opt-125m", cache_config, speculative_config=SpeculativeConfig(
+        method="draft", draft_model="facebook/opt-125m", num_speculative_tokens=3
+    ))
+    assert _greedy_decode(worker, prompt, 24, 3) == expected
+    stats = worker.get_stats()
+    assert stats['num_forwards'] == 1 + 6
+    # Per step one forward per proposal, and one for the last proposal once all were accepted
+    assert stats['num_draft_forwards'] == 1 + 6 * 4
+
+def test_compiled_buckets_match_eager_decode():
+    prompts = [[5, 6, 7, 8, 9], [10, 11], [12, 13, 14, 15, 16, 17, 18]]
+    cache_config = CacheConfig(memory_bytes=64 * 2**20)
+    compile_config = CompileConfig(mode="torchscript", batch_sizes=[1, 4], context_lengths=[16, 32])
+    outputs = []
+    for worker in (ModelWorker("facebook/opt-125m", cache_config),
+                   ModelWorker("facebook/opt-125m", cache_config, compile_config=compile_config)):
+        batch = []
+        for handle, token_ids in enumerate(prompts):
+            worker.add_sequences([(handle, SamplingParams(temperature=0), token_ids, len(token_ids))])
+            batch.append({'request_id': handle, 'context_len': 0, 'token_ids': token_ids,
+                          'block_table': [2 * handle, 2 * handle + 1]})
+        tokens = []
+        for _ in range(12):
+            results = worker.generate_forward_batch(batch)
+            tokens.append([r['token_ids'] for r in results])
+            for p, r in zip(batch, results):
+                p['context_len'] += len(p['token_ids'])
+                p['token_ids'] = r['token_ids']
+        outputs.append(tokens)
+    assert outputs[0] == outputs[1]
+    stats = worker.get_stats()['compile']
+    # Three rows run padded to four, contexts up to 19 tokens to 32
+    assert set(stats['step_latency_ms']) == {'other', '4x1x16', '4x1x32'}
+    assert 'compile' in worker.get_stats()['startup_s']
+    
+    # Verifying forwards are padded to the proposals of the configured length
+    prompt = [5, 6, 7, 8, 5, 6, 7, 8, 5, 6]
+    expected = _greedy_decode(ModelWorker("facebook/opt-125m", cache_config), prompt, 24)
+    worker = ModelWorker("facebook/opt-125m", cache_config, speculative_config=SpeculativeConfig(method="ngram"),
+                         compile_config=compile_config)
+    assert _greedy_decode(worker, prompt, 24, 4, NgramProposer(1, 3)) == expected
+    assert any(label.startswith('1x5x') for label in worker.get_stats()['compile']['step_latency_ms'])
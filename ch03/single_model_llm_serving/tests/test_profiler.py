@@ -0,0 +1,40 @@
+import threading
+from llm.profiler import StepProfiler
+from llm.workload_manager import Sequence
+
+def test_spans_are_recorded_only_while_enabled():
+    profiler = StepProfiler()
+    with profiler.span('schedule'):
+        pass
+    assert not profiler.events
+
+    profiler.start()
+    with profiler.span('forward', sequences=2):
+        pass
+    profiler.stop()
+    with profiler.span('schedule'):
+        pass
+
+    events = profiler.trace_events("engine")
+    spans = [event for event in events if event['ph'] == 'X']
+    assert [(span['name'], span['args']) for span in spans] == [('forward', {'sequences': 2})]
+    assert spans[0]['tid'] == threading.get_native_id() and spans[0]['dur'] >= 0
+    names = {event['name']: event['args']['name'] for event in events if event['ph'] == 'M'}
+    assert names == {'process_name': 'engine', 'thread_name': threading.current_thread().name}
+
+def test_request_phases_nest_under_the_request():
+    profiler = StepProfiler()
+    profiler.start()
+    sequence = Sequence("seq", [1, 2, 3], None, None)
+    sequence.arrival_time, sequence.first_scheduled_time, sequence.first_token_time = 1.0, 1.5, 2.0
+    sequence.output_token_ids.extend([4, 5])
+    profiler.request(sequence, 'finished')
+
+    events = profiler.trace_events()
+    assert [(event['ph'], event['name']) for event in events] == [
+        ('b', 'request'), ('b', 'queued'), ('e', 'queued'), ('b', 'prefill'), ('e', 'prefill'),
+        ('b', 'decode'), ('e', 'decode'), ('e', 'request'),
+    ]
+    assert {event['id'] for event in events} == {"seq"}
+    assert [event['ts'] for event in events[:6]] == [1e6, 1e6, 1.5e6, 1.5e6, 2e6, 2e6]
+    assert events[0]['args'] == {'outcome': 'finished', 'prompt_tokens': 3, 'output_tokens': 2}
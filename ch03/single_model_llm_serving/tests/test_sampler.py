@@ -0,0 +1,50 @@
+import torch
+from llm.sampler import Sampler, apply_top_k_top_p
+from llm.sampling_params import SamplingParams
+
+def _logits(batch_size, vocab_size=8):
+    torch.manual_seed(0)
+    return torch.randn(batch_size, vocab_size)
+
+def test_greedy_and_truncated_rows_pick_the_most_likely_token():
+    sampler = Sampler(vocab_size=8, device="cpu")
+    sampler.add(0, SamplingParams(temperature=0), [1, 2], 2)
+    sampler.add(1, SamplingParams(temperature=1.0, top_k=1), [1, 2], 2)
+    sampler.add(2, SamplingParams(temperature=1.0, top_p=0.01), [1, 2], 2)
+    logits = _logits(3)
+    for _ in range(10):
+        tokens = sampler(logits, torch.tensor([0, 1, 2]))
+        assert tokens.tolist() == logits.argmax(dim=-1).tolist()
+
+def test_top_k_top_p_keeps_rows_independent():
+    logits = torch.log(torch.tensor([[0.5, 0.3, 0.15, 0.05]] * 3))
+    masked = apply_top_k_top_p(logits, torch.tensor([2, -1, -1]), torch.tensor([1.0, 0.7, 1.0]))
+    assert torch.isinf(masked).tolist() == [
+        [False, False, True, True],
+        [False, False, True, True],
+        [False, False, False, False],
+    ]
+
+def test_penalties_use_the_sequence_history():
+    sampler = Sampler(vocab_size=4, device="cpu")
+    logits = torch.tensor([[4.0, 3.0, 0.0, 0.0]])
+    # Token 0 was generated twice already
+    sampler.add(0, SamplingParams(temperature=0, frequency_penalty=1.0), [2, 0, 0], 1)
+    assert sampler(logits, torch.tensor([0])).tolist() == [1]
+    # Sampled tokens count from then on
+    sampler.add(1, SamplingParams(temperature=0, presence_penalty=2.0), [3], 1)
+    assert sampler(logits, torch.tensor([1])).tolist() == [0]
+    assert sampler(logits, torch.tensor([1])).tolist() == [1]
+    # Repetition penalty also covers prompt tokens
+    sampler.add(2, SamplingParams(temperature=0, repetition_penalty=2.0), [0], 1)
+    assert sampler(logits, torch.tensor([2])).tolist() == [1]
+
+def test_mixed_batch_and_slots_beyond_capacity():
+    sampler = Sampler(vocab_size=8, device="cpu", capacity=2)
+    sampler.add(100, SamplingParams(temperature=0), [1], 1)
+    sampler.add(3, SamplingParams(temperature=1.5, top_k=3, min_p=0.1), [1], 1)
+    assert sampler.capacity >= 101
+    logits = _logits(2)
+    tokens = sampler(logits, torch.tensor([100, 3]))
+    assert tokens[0] == logits[0].argmax()
+    assert tokens[1] in logits[1].topk(3).indices
@@ -0,0 +1,41 @@
+import numpy as np
+import torch
+from llm.spec_decode import NgramProposer, rejection_sample
+
+def test_ngram_proposer_continues_the_latest_longest_match():
+    proposer = NgramProposer(min_n=1, max_n=3)
+    tokens = np.array([5, 1, 2, 3, 9, 8, 1, 2, 3, 7, 6, 4, 1, 2, 3], dtype=np.int32)
+    # The trigram 1 2 3 occurred twice; the later occurrence wins
+    assert proposer.propose(tokens, 2) == [7, 6]
+    # Falls back to shorter n-grams, and finds nothing for a new token
+    assert proposer.propose(np.array([4, 9, 9, 2, 4], dtype=np.int32), 3) == [9, 9, 2]
+    assert proposer.propose(np.array([1, 2, 3], dtype=np.int32), 3) == []
+
+def test_rejection_sampling_keeps_the_target_distribution():
+    torch.manual_seed(0)
+    num_rows, vocab_size = 20000, 4
+    target = torch.tensor([0.1, 0.2, 0.3, 0.4])
+    draft = torch.tensor([0.4, 0.3, 0.2, 0.1])
+    draft_tokens = torch.multinomial(draft, num_rows, replacement=True)[:, None]
+    num_accepted, next_tokens = rejection_sample(
+        target.expand(num_rows, 2, vocab_size), draft_tokens, torch.ones(num_rows, dtype=torch.long),
+        draft.expand(num_rows, 1, vocab_size)
+    )
+    # The first token is the draft's when accepted, the resampled one otherwise
+    first = torch.where(num_accepted == 1, draft_tokens[:, 0], next_tokens)
+    assert torch.allclose(torch.bincount(first, minlength=vocab_size) / num_rows, target, atol=0.015)
+    # Expected acceptance is the overlap of the two distributions
+    assert abs(num_accepted.float().mean().item() - torch.minimum(target, draft).sum().item()) < 0.015
+
+def test_greedy_verification_accepts_up_to_the_first_mismatch():
+    # One-hot targets: argmax 3, 1, 2 at the three positions
+    target = torch.nn.functional.one_hot(torch.tensor([[3, 1, 2], [3, 1, 2]]), 5).float()
+    draft_tokens = torch.tensor([[3, 1], [3, 4]])
+    num_accepted, next_tokens = rejection_sample(target, draft_tokens, torch.tensor([2, 2]))
+    assert num_accepted.tolist() == [2, 1]
+    # A bonus token after full acceptance, the correction after a mismatch
+    assert next_tokens.tolist() == [2, 1]
+    # Rows may propose fewer tokens than others
+    num_accepted, next_tokens = rejection_sample(target, draft_tokens, torch.tensor([1, 0]))
+    assert num_accepted.tolist() == [1, 0]
+    assert next_tokens.tolist() == [1, 3]
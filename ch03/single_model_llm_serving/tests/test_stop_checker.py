@@ -0,0 +1,30 @@
+from llm.stop_checker import StopStringMatcher, get_matcher
+
+def test_finds_first_stop_string_across_deltas():
+    matcher = StopStringMatcher(["\n\n", "END", "bend it"])
+    text, state, match = "", 0, -1
+    for delta in ["The b", "en", "d of the E", "N", "D!"]:
+        start = len(text)
+        text += delta
+        state, match = matcher.feed(state, text, start)
+        if match >= 0:
+            break
+    assert text[:match] == "The bend of the "
+
+def test_overlapping_patterns_match_where_they_begin():
+    matcher = StopStringMatcher(["abcd", "bc"])
+    assert matcher.feed(0, "xabcd")[1] == 2
+    matcher = StopStringMatcher(["she", "he", "hers"])
+    assert matcher.feed(0, "ushers")[1] == 1
+
+def test_held_back_covers_a_possible_stop_string_prefix():
+    matcher = StopStringMatcher(["<|end|>"])
+    state, match = matcher.feed(0, "hello <|e")
+    assert match == -1
+    assert matcher.held_back(state) == 3
+    state, match = matcher.feed(state, "hello <|ex", 9)
+    assert matcher.held_back(state) == 0
+
+def test_matchers_are_shared_per_stop_list():
+    assert get_matcher(("a", "b")) is get_matcher(("a", "b"))
+    assert get_matcher(("",)).feed(0, "anything") == (0, -1)
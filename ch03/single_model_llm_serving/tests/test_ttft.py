@@ -0,0 +1,95 @@
+import asyncio
+import random
+import statistics
+import threading
+import time
+from llm import SamplingParams
+from llm.workload_manager import WorkloadManager
+from main import get_llm
+
+def _print_histogram(title, samples_ms, bucket_ms=10):
+    """Print a text histogram so the TTFT distribution shows up in `pytest -s`."""
+    print(f"\n{title}: n={len(samples_ms)} p50={statistics.median(samples_ms):.2f}ms max={max(samples_ms):.2f}ms")
+    buckets = {}
+    for sample in samples_ms:
+        bucket = int(sample // bucket_ms) * bucket_ms
+        buckets[bucket] = buckets.get(bucket, 0) + 1
+    for bucket in sorted(buckets):
+        print(f"  {bucket:>5}-{bucket + bucket_ms:<5}ms | {'#' * buckets[bucket]}")
+
+def _measure_pickup_latency(engine_loop, num_requests=20):
+    """Time from add_request until the engine loop schedules the sequence."""
+    manager = WorkloadManager()
+    picked_up = {}
+    stop = threading.Event()
+    thread = threading.Thread(target=engine_loop, args=(manager, picked_up, stop), daemon=True)
+    thread.start()
+    
+    samples_ms = []
+    for _ in range(num_requests):
+        # Let the loop go idle before each request, like an idle-to-busy transition
+        time.sleep(random.uniform(0.01, 0.05))
+        start = time.perf_counter()
+        seq_id = manager.add_request([1, 2, 3])
+        while seq_id not in picked_up:
+            time.sleep(0.0001)
+        samples_ms.append((picked_up[seq_id] - start) * 1000)
+        manager.finish_sequence(seq_id)
+    stop.set()
+    manager.add_request([1])  # wake the loop so it can exit
+    thread.join(timeout=1)
+    return samples_ms
+
+def _polling_loop(manager, picked_up, stop):
+    # The previous engine loop: sleep 100 ms whenever no batch is ready
+    while not stop.is_set():
+        output = manager.schedule()
+        if not output.sequences:
+            time.sleep(0.1)
+            continue
+        for seq in output.sequences:
+            picked_up.setdefault(seq.id, time.perf_counter())
+
+def _event_loop(manager, picked_up, stop):
+    # The current engine loop: block until add_request signals new work
+    while not stop.is_set():
+        output = manager.schedule()
+        if not output.sequences:
+            manager.wait_for_work()
+            continue
+        for seq in output.sequences:
+            picked_up.setdefault(seq.id, time.perf_counter())
+
+def test_event_driven_pickup_beats_polling():
+    polling = _measure_pickup_latency(_polling_loop)
+    event_driven = _measure_pickup_latency(_event_loop)
+    _print_histogram("Polling loop pickup latency", polling)
+    _print_histogram("Event-driven loop pickup latency", event_driven, bucket_ms=1)
+    
+    assert statistics.median(event_driven) < 5
+    assert statistics.median(event_driven) < statistics.median(polling) / 5
+
+async def test_stream_ttft_histogram():
+    # In-process HTTP clients buffer the whole response, so read the engine's
+    # stream directly to see when the first token really arrives.
+    llm = get_llm()
+    loop = asyncio.get_running_loop()
+    # Greedy and past EOS, so every stream yields text; a sampled EOS or
+    # a token that decodes to nothing on its own could leave one empty
+    params = SamplingParams(temperature=0, ignore_eos=True, max_tokens=8)
+    # Warm up so worker startup is not counted as TTFT
+    async for _ in llm.event_generator(loop, "Hello", params):
+        pass
+    
+    samples_ms = []
+    for _ in range(10):
+        await asyncio.sleep(0.05)  # idle gap so every request hits an idle engine
+        start = time.perf_counter()
+        first_token_ms = None
+        async for event in llm.event_generator(loop, "Hello, I am", params):
+            if first_token_ms is None:
+                assert event.startswith("data: ")
+                first_token_ms = (time.perf_counter() - start) * 1000
+        samples_ms.append(first_token_ms)
+    _print_histogram("Streaming TTFT", samples_ms)
+    assert len(samples_ms) == 10
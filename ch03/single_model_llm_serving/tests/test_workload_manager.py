@@ -0,0 +1,238 @@
+import pytest
+from llm.block_manager import BlockManager
+from llm.config import CacheConfig, SchedulerConfig, SpeculativeConfig
+from llm.sampling_params import SamplingParams
+from llm.scheduling_params import SchedulingParams
+from llm.workload_manager import WorkloadManager
+
+def test_schedule_respects_max_num_seqs():
+    manager = WorkloadManager(SchedulerConfig(max_num_seqs=2, max_num_batched_tokens=100))
+    ids = [manager.add_request([1, 2, 3]) for _ in range(3)]
+    
+    output = manager.schedule()
+    assert [seq.id for seq in output.sequences] == ids[:2]
+    assert output.num_prefill_tokens == 6
+    assert output.num_decode_tokens == 0
+    
+    # Finishing a sequence frees its slot on the very next step
+    manager.update_sequence_output(ids[1], [7])
+    manager.finish_sequence(ids[0])
+    output = manager.schedule()
+    assert [seq.id for seq in output.sequences] == ids[1:]
+    assert output.num_decode_tokens == 1
+    assert output.num_prefill_tokens == 3
+
+def test_schedule_respects_token_budget():
+    manager = WorkloadManager(SchedulerConfig(max_num_seqs=8, max_num_batched_tokens=5, prefill_chunk_size=None))
+    first = manager.add_request([1, 2, 3])
+    second = manager.add_request([4, 5, 6])
+    
+    output = manager.schedule()
+    assert [seq.id for seq in output.sequences] == [first]
+    
+    manager.update_sequence_output(first, [7])
+    output = manager.schedule()
+    assert [seq.id for seq in output.sequences] == [first, second]
+    assert output.num_batched_tokens == 4
+
+def test_prompt_longer_than_budget_is_rejected():
+    manager = WorkloadManager(SchedulerConfig(max_num_batched_tokens=4, prefill_chunk_size=None))
+    with pytest.raises(ValueError):
+        manager.add_request([1, 2, 3, 4, 5])
+
+def test_long_prompts_are_prefilled_in_chunks_between_decodes():
+    manager = WorkloadManager(
+        SchedulerConfig(max_num_seqs=8, max_num_batched_tokens=6, prefill_chunk_size=4),
+        block_managers=[BlockManager(num_blocks=8, block_size=4)]
+    )
+    decoding = manager.add_request([1, 2])
+    manager.schedule()
+    manager.update_sequence_output(decoding, [3])
+    
+    # Longer than the whole budget; fed 4 tokens a step after the decode
+    long = manager.add_request(list(range(10, 20)))
+    chunks = []
+    while not chunks or not chunks[-1]['do_sample']:
+        output = manager.schedule()
+        assert output.prompts[0]['request_id'] == decoding
+        assert output.num_prefill_tokens <= 4
+        chunks.append(output.prompts[-1])
+        manager.update_sequence_output(decoding, [3])
+    assert [(chunk['context_len'], chunk['token_ids']) for chunk in chunks] == [
+        (0, list(range(10, 14))), (4, list(range(14, 18))), (8, [18, 19])
+    ]
+    assert [chunk['do_sample'] for chunk in chunks] == [False, False, True]
+    
+    # Its first token then decodes like any other
+    manager.update_sequence_output(long, [20])
+    output = manager.schedule()
+    assert output.prompts[-1]['token_ids'] == [20]
+    assert output.num_prefill_tokens == 0
+
+def test_running_out_of_blocks_preempts_the_newest_sequence():
+    manager = WorkloadManager(
+        SchedulerConfig(max_num_seqs=8, max_num_batched_tokens=100),
+        block_managers=[BlockManager(num_blocks=2, block_size=4)]
+    )
+    first = manager.add_request([1, 2, 3, 4])
+    second = manager.add_request([5, 6, 7, 8])
+    output = manager.schedule()
+    assert [p['block_table'] for p in output.prompts] == [[0], [1]]
+    
+    # Both need a second block for their next token; the newest gives way
+    manager.update_sequence_output(first, [9])
+    manager.update_sequence_output(second, [10])
+    output = manager.schedule()
+    assert [seq.id for seq in output.sequences] == [first]
+    assert output.prompts[0]['context_len'] == 4
+    assert output.prompts[0]['block_table'] == [0, 1]
+    assert output.num_preempted == 1
+    assert [seq.id for seq in manager.waiting] == [second]
+    
+    # Recompute feeds the prompt and the output so far once blocks free up
+    manager.finish_sequence(first)
+    output = manager.schedule()
+    assert output.prompts[0]['request_id'] == second
+    assert output.prompts[0]['token_ids'] == [5, 6, 7, 8, 10]
+    assert output.prompts[0]['context_len'] == 0
+
+def test_swap_preemption_resumes_before_new_admissions():
+    manager = WorkloadManager(
+        SchedulerConfig(max_num_seqs=8, max_num_batched_tokens=100),
+        CacheConfig(preemption_mode="swap"),
+        [BlockManager(num_blocks=2, block_size=4, num_swap_blocks=2)]
+    )
+    first = manager.add_request([1, 2, 3, 4])
+    second = manager.add_request([5, 6, 7, 8])
+    manager.schedule()
+    manager.update_sequence_output(first, [9])
+    manager.update_sequence_output(second, [10])
+    output = manager.schedule()
+    assert output.blocks_to_swap_out == {0: [(1, 0)]}
+    assert [seq.id for seq in manager.swapped] == [second]
+    
+    third = manager.add_request([11])
+    manager.finish_sequence(first)
+    output = manager.schedule()
+    assert [seq.id for seq in output.sequences] == [second]
+    assert output.blocks_to_swap_in[0][0][0] == 0
+    # Swapped sequences keep their cache and only feed the last token
+    assert output.prompts[0]['token_ids'] == [10]
+    assert output.prompts[0]['context_len'] == 4
+    assert manager.get_sequence(third) in manager.waiting
+
+def test_admission_skips_cached_prefix():
+    manager = WorkloadManager(
+        SchedulerConfig(max_num_seqs=8, max_num_batched_tokens=100),
+        block_managers=[BlockManager(num_blocks=8, block_size=2)]
+    )
+    first = manager.add_request([1, 2, 3, 4, 5])
+    manager.schedule()
+    manager.update_sequence_output(first, [6])
+    manager.finish_sequence(first)
+    
+    second = manager.add_request([1, 2, 3, 4, 7])
+    output = manager.schedule()
+    assert output.prompts[0]['request_id'] == second
+    assert output.prompts[0]['token_ids'] == [7]
+    assert output.prompts[0]['context_len'] == 4
+    
+    # A fully cached prompt still feeds its last token
+    third = manager.add_request([1, 2, 3, 4])
+    output = manager.schedule()
+    assert output.prompts[-1]['request_id'] == third
+    assert output.prompts[-1]['token_ids'] == [4]
+    assert output.prompts[-1]['context_len'] == 3
+    
+    stats = manager.get_stats()
+    assert stats['prefix_cache_saved_tokens'] == 7
+    assert stats['prefix_cache_hit_rate'] == 7 / 14
+
+def test_aborted_sequences_are_dropped_on_the_next_step():
+    block_manager = BlockManager(num_blocks=8, block_size=2, enable_prefix_caching=False)
+    manager = WorkloadManager(SchedulerConfig(max_num_seqs=8, max_num_batched_tokens=100), block_managers=[block_manager])
+    running = manager.add_request([1, 2, 3])
+    manager.schedule()
+    waiting = manager.add_request([4, 5])
+    
+    # Marked only; the step in flight still sees the sequence
+    manager.abort_sequence(running)
+    manager.abort_sequence(waiting)
+    assert manager.get_sequence(running) is not None
+    
+    output = manager.schedule()
+    assert [seq.id for seq in output.aborted] == [running, waiting]
+    assert not output.sequences
+    assert manager.get_sequence(running) is None
+    assert block_manager.num_free_blocks == 8
+    stats = manager.get_stats()
+    assert stats['num_aborted'] == 2
+    # 3 + 2 prompt tokens and 20 output tokens each, minus the 3 computed and the last one
+    assert stats['aborted_saved_tokens'] == (3 + 19 - 3) + (2 + 19)
+
+def test_priority_policy_preempts_lower_priority_for_urgent_requests():
+    manager = WorkloadManager(
+        SchedulerConfig(policy="priority", max_num_seqs=8, max_num_batched_tokens=100),
+        block_managers=[BlockManager(num_blocks=2, block_size=4, enable_prefix_caching=False)]
+    )
+    batch = [manager.add_request([1, 2, 3, 4], scheduling_params=SchedulingParams(priority=1)) for _ in range(2)]
+    manager.schedule()
+    
+    # Both batch jobs need their second block this step, so neither block
+    # would be left for the interactive request: both give way
+    interactive = manager.add_request([5, 6], scheduling_params=SchedulingParams(priority=0))
+    for seq_id in batch:
+        manager.update_sequence_output(seq_id, [9])
+    output = manager.schedule()
+    assert output.num_preempted == 2
+    assert [seq.id for seq in output.sequences] == [interactive]
+    assert [seq.id for seq in manager.waiting] == batch
+    
+    # Equal priorities never preempt each other; the deadline orders them
+    late = manager.add_request([7], scheduling_params=SchedulingParams(priority=1, deadline_s=60))
+    soon = manager.add_request([8], scheduling_params=SchedulingParams(priority=1, deadline_s=1))
+    manager.update_sequence_output(interactive, [10])
+    output = manager.schedule()
+    assert not output.num_preempted
+    assert [seq.id for seq in output.sequences] == [interactive, soon]
+    assert [seq.id for seq in manager.waiting] == [late] + batch
+
+def test_edf_policy_admits_the_nearest_deadline_first():
+    manager = WorkloadManager(SchedulerConfig(policy="edf", max_num_seqs=1, max_num_batched_tokens=100))
+    no_slo = manager.add_request([1])
+    deadline = manager.add_request([2], scheduling_params=SchedulingParams(deadline_s=5))
+    ttft = manager.add_request([3], scheduling_params=SchedulingParams(priority=9, ttft_slo_s=1))
+    output = manager.schedule()
+    assert [seq.id for seq in output.sequences] == [ttft]
+    assert [seq.id for seq in manager.waiting] == [deadline, no_slo]
+
+def test_ngram_proposals_use_leftover_budget_and_blocks():
+    manager = WorkloadManager(
+        SchedulerConfig(max_num_seqs=8, max_num_batched_tokens=7),
+        block_managers=[BlockManager(num_blocks=8, block_size=4)],
+        speculative_config=SpeculativeConfig(method="ngram", num_speculative_tokens=3)
+    )
+    seq_id = manager.add_request([1, 2, 3, 4, 1, 2], sampling_params=SamplingParams(max_tokens=20))
+    manager.schedule()
+    manager.update_sequence_output(seq_id, [3])
+    
+    # "2 3" occurred before, followed by 4 1 2
+    output = manager.schedule()
+    prompt = output.prompts[0]
+    assert prompt['token_ids'] == [3]
+    assert prompt['proposal_token_ids'] == [4, 1, 2]
+    assert prompt['num_speculative_tokens'] == 3
+    assert len(prompt['block_table']) == 3
+    assert output.num_decode_tokens == 4
+    
+    # Two proposals accepted, then a token of the model's own
+    manager.update_sequence_output(seq_id, [4, 1, 9], num_accepted=2)
+    sequence = manager.get_sequence(seq_id)
+    assert sequence.num_computed_tokens == 9
+    assert sequence.next_token_ids() == [9]
+    
+    # A new prompt's prefill leaves no budget for proposals
+    manager.add_request([5, 6, 7, 8, 9, 10])
+    output = manager.schedule()
+    assert 'proposal_token_ids' not in output.prompts[0]
+    assert manager.get_stats()['spec_acceptance_rate'] == 2 / 3